@@ -0,0 +1,142 @@
+import hashlib
+import itertools
+import os
+import threading
+import time
+
+from loguru import logger
+
+from db_connection import DbConnection as Db
+
+
+class AccountImporter:
+    """
+    Imports accounts from a `username,password` file into the accounts table.
+
+    The file is streamed in chunks of `chunk_size` lines: each chunk's usernames are looked up in one query and only
+    new accounts or accounts with a changed password are written - archived accounts are skipped, they're only brought
+    back by restoring them. The file's checksum is recorded in the
+    account_import table after a successful import, so unchanged files are skipped - unless the import is forced.
+
+    New accounts are added to the account `pool`. Usernames are unique across pools: accounts that already belong to
+    another pool are skipped and counted as `other_pool`.
+
+    Several processes may import the same file at once (e.g. every gunicorn worker on startup) - accounts inserted by
+    another process in the meantime are left as they are.
+    """
+
+    def __init__(self, file="accounts.txt", chunk_size=1000, pool=Db.pool_name):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.pool = pool
+        self._lock = threading.Lock()
+        # (mtime, size) of the file at the last check - the watcher only hashes the file after it changed
+        self._stat = None
+
+    def checksum(self):
+        digest = hashlib.sha256()
+        with open(self.file, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def changed_on_disk(self):
+        """
+        Cheap check for the file watcher - True if the file's modification time or size changed since the last check.
+        """
+        try:
+            stat = os.stat(self.file)
+        except OSError:
+            return False
+        current = (stat.st_mtime_ns, stat.st_size)
+        changed, self._stat = current != self._stat, current
+        return changed
+
+    def parse(self, lines):
+        """
+        Yields (username, password) for every valid line and None for every invalid one.
+        """
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            split = line.split(",")
+            if len(split) != 2 or not split[0] or not split[1]:
+                logger.warning(f"Invalid account entry: {line}")
+                yield None
+                continue
+            yield split[0], split[1]
+
+    def run(self, force=False, on_change=None):
+        """
+        Import the file if it changed since the last import, or if `force`d. `on_change` is called with the list of
+        (username, password) of every chunk's new and changed accounts. Returns the counts of added, updated,
+        unchanged, archived, other_pool and invalid entries or None if the file is missing or unchanged.
+        """
+        if not os.path.isfile(self.file):
+            logger.warning(f"{self.file} not found - not adding accounts")
+            return None
+        with self._lock:
+            self.changed_on_disk()
+            checksum = self.checksum()
+            if not force and checksum == self.imported_checksum():
+                logger.info(f"{self.file} is unchanged since the last import - skipping it")
+                return None
+
+            start = time.monotonic()
+            counts = {"added": 0, "updated": 0, "unchanged": 0, "archived": 0, "other_pool": 0, "invalid": 0}
+            with open(self.file, "r") as f:
+                entries = self.parse(f)
+                while True:
+                    chunk = list(itertools.islice(entries, self.chunk_size))
+                    if not chunk:
+                        break
+                    counts["invalid"] += chunk.count(None)
+                    added, updated = self.import_chunk(dict(entry for entry in chunk if entry is not None), counts)
+                    if on_change is not None and (added or updated):
+                        on_change(added + updated)
+            self.record(checksum)
+        logger.info(f"Imported {self.file} in {time.monotonic() - start:.2f}s: {counts}")
+        return counts
+
+    def import_chunk(self, accounts, counts):
+        if not accounts:
+            return [], []
+        with Db() as conn:
+            conn.begin()
+            conn.cur.execute(f"SELECT username, password, pool FROM accounts WHERE username IN "
+                             f"({Db.placeholders(len(accounts))})", tuple(accounts))
+            rows = conn.cur.fetchall()
+            existing = {username: password for username, password, pool in rows if pool == self.pool}
+            other_pool = {username for username, _, pool in rows if pool != self.pool}
+            new = [username for username in accounts if username not in existing and username not in other_pool]
+            archived = Db.archived_usernames(conn, new) if new else set()
+            added = [(username, accounts[username], self.pool) for username in new if username not in archived]
+            updated = [(username, password) for username, password in accounts.items()
+                       if username in existing and existing[username] != password]
+            if added:
+                conn.cur.executemany(Db.backend().upsert_sql("accounts", ("username", "password", "pool"),
+                                                             ("username",)), added)
+            if updated:
+                conn.cur.executemany("UPDATE accounts SET password = %s WHERE username = %s",
+                                     [(password, username) for username, password in updated])
+        counts["added"] += len(added)
+        counts["updated"] += len(updated)
+        counts["archived"] += len(archived)
+        counts["other_pool"] += len(other_pool)
+        counts["unchanged"] += len(accounts) - len(added) - len(updated) - len(archived) - len(other_pool)
+        if other_pool:
+            logger.warning(f"{len(other_pool)} accounts of {self.file} belong to another account pool - skipped them")
+        return [(username, password) for username, password, _ in added], updated
+
+    def imported_checksum(self):
+        with Db() as conn:
+            conn.cur.execute("SELECT checksum FROM account_import WHERE file = %s", (self.file,))
+            row = conn.cur.fetchone()
+        return row[0] if row else None
+
+    def record(self, checksum):
+        with Db() as conn:
+            conn.cur.execute(Db.backend().upsert_sql("account_import", ("file", "checksum", "imported_at"), ("file",),
+                                                     update=("checksum", "imported_at")),
+                             (self.file, checksum, int(time.time())))
@@ -0,0 +1,362 @@
+import atexit
+import heapq
+import itertools
+import threading
+
+from loguru import logger
+
+import clock
+from db_connection import DbConnection as Db
+
+
+class Account:
+    __slots__ = ("username", "password", "level", "last_use", "in_use_by", "last_returned", "last_burned",
+                 "lease_expires", "burn_count", "version")
+
+    def __init__(self, username, password, level=0, last_use=0, in_use_by=None, last_returned=0, last_burned=0,
+                 lease_expires=None, burn_count=0):
+        self.username = username
+        self.password = password
+        self.level = level or 0
+        self.last_use = last_use or 0
+        self.in_use_by = in_use_by
+        self.last_returned = last_returned or 0
+        self.last_burned = last_burned or 0
+        self.lease_expires = lease_expires
+        self.burn_count = burn_count or 0
+        self.version = 0
+
+    @property
+    def cooldown_start(self):
+        return max(self.last_returned, self.last_burned)
+
+    def row(self):
+        return (self.in_use_by, self.last_use, self.last_returned, self.last_burned, self.level, self.lease_expires,
+                self.burn_count, self.username)
+
+
+class AccountPool:
+    """
+    In-memory account pool answering checkouts and account lookups without touching the database.
+
+    Free accounts are kept in one heap per level, ordered by last_use. Accounts released or burned within the cooldown
+    wait in a heap ordered by their cooldown start and move back to the free heaps as soon as they've cooled down.
+    Heap entries are invalidated lazily: each change of an account bumps its version and entries with an outdated
+    version get dropped when they reach the top of a heap.
+
+    Changes are persisted to the accounts table by a background thread that writes all accounts changed since the
+    last flush in one batch. Holds the accounts of the named account pool of `db` only.
+    """
+
+    persist_sql = ("UPDATE accounts SET in_use_by = %s, last_use = %s, last_returned = %s, last_burned = %s, "
+                   "level = %s, lease_expires = %s, burn_count = %s WHERE username = %s")
+    load_sql = ("SELECT username, password, level, last_use, in_use_by, last_returned, last_burned, lease_expires, "
+                "burn_count FROM accounts WHERE pool = %s")
+
+    def __init__(self, flush_interval=1, db=Db):
+        self.db = db
+        self.accounts: dict = {}
+        self.devices: dict = {}
+        self._free: dict = {}
+        self._cooling: list = []
+        self._versions = itertools.count(1)
+        self._dirty: set = set()
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._flush_interval = flush_interval
+        self._flusher = None
+        self._stop = threading.Event()
+
+    def load(self):
+        with Db() as conn:
+            conn.cur.execute(self.load_sql, (self.db.pool_name,))
+            rows = conn.cur.fetchall()
+        with self._lock:
+            self.accounts.clear()
+            self.devices.clear()
+            self._free.clear()
+            self._cooling.clear()
+            for row in rows:
+                self._add(Account(*row))
+        logger.info(f"Loaded {len(self.accounts)} accounts of account pool {self.db.pool_name} into the in-memory pool")
+
+    def start(self):
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_loop, name=f"pool-write-behind-{self.db.pool_name}",
+                                             daemon=True)
+            self._flusher.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+    def _add(self, acc):
+        self.accounts[acc.username] = acc
+        if acc.in_use_by is not None:
+            self.devices[acc.in_use_by] = acc.username
+        self._index(acc)
+
+    def _index(self, acc):
+        acc.version = next(self._versions)
+        if acc.in_use_by is None:
+            heapq.heappush(self._cooling, (acc.cooldown_start, acc.version, acc.username))
+
+    def _changed(self, acc):
+        self._index(acc)
+        self._dirty.add(acc.username)
+
+    def _valid(self, entry):
+        acc = self.accounts.get(entry[2])
+        return acc is not None and acc.version == entry[1] and acc.in_use_by is None
+
+    def _promote(self, cooldown_ts):
+        # move every account that has cooled down from the cooldown heap to the free heap of its level
+        while self._cooling and self._cooling[0][0] < cooldown_ts:
+            entry = heapq.heappop(self._cooling)
+            if self._valid(entry):
+                acc = self.accounts[entry[2]]
+                heapq.heappush(self._free.setdefault(acc.level, []), (acc.last_use, acc.version, acc.username))
+
+    def _top(self, level):
+        heap = self._free[level]
+        while heap and not self._valid(heap[0]):
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    def _pick(self, level, cooldown_ts):
+        self._promote(cooldown_ts)
+        best = None
+        for bucket in self._free:
+            if bucket < level:
+                continue
+            top = self._top(bucket)
+            if top is not None and (best is None or top < best[1]):
+                best = (bucket, top)
+        if best is None:
+            return None
+        heapq.heappop(self._free[best[0]])
+        return self.accounts[best[1][2]]
+
+    def checkout(self, device, mark_last_use=True, level=None, cooldown_ts=None, username=None, current=False):
+        now = int(clock.now())
+        with self._lock:
+            if username is not None:
+                acc = self.accounts.get(username)
+            elif current:
+                acc = self.accounts.get(self.devices.get(device))
+            else:
+                acc = self._pick(int(level), int(cooldown_ts))
+            if acc is None or not acc.password:
+                return None, None
+
+            previous = self.accounts.get(self.devices.pop(device, None))
+            if previous is not None:
+                previous.in_use_by = None
+                previous.last_returned = now
+                previous.lease_expires = None
+                self._changed(previous)
+            if acc.in_use_by is not None and acc.in_use_by != device:
+                self.devices.pop(acc.in_use_by, None)
+            acc.in_use_by = device
+            acc.lease_expires = self.db.lease_expiry(now)
+            if mark_last_use:
+                acc.last_use = now
+            self.devices[device] = acc.username
+            self._changed(acc)
+            return acc.username, acc.password
+
+    def checkout_many(self, requests):
+        picked: dict = {}
+        with self._lock:
+            # highest levels first, like DbConnection.checkout_many
+            for device, mark_last_use, pick in sorted(requests, key=lambda request: -request[2].get("level", 0)):
+                username, password = self.checkout(device, mark_last_use=mark_last_use, **pick)
+                if username:
+                    picked[device] = (username, password)
+        return picked
+
+    def current_accounts(self, devices):
+        with self._lock:
+            return {device: self.devices[device] for device in devices if device in self.devices}
+
+    def set_burned_many(self, usernames, ts):
+        with self._lock:
+            existing = {username for username in usernames if username in self.accounts}
+            for username in existing:
+                self.set_burned(username, ts)
+        return existing
+
+    def set_level_many(self, levels):
+        with self._lock:
+            existing = {username for username in levels if username in self.accounts}
+            for username in existing:
+                self.set_level(username, levels[username])
+        return existing
+
+    def add_or_update(self, username, password):
+        with self._lock:
+            acc = self.accounts.get(username)
+            if acc is None:
+                self._add(Account(username, password))
+            else:
+                acc.password = password
+
+    def add_or_update_many(self, accounts):
+        with self._lock:
+            for username, password in accounts:
+                self.add_or_update(username, password)
+
+    def current_account(self, device):
+        with self._lock:
+            return self.devices.get(device)
+
+    def device_last_uses(self):
+        with self._lock:
+            return {device: self.accounts[username].last_use for device, username in self.devices.items()}
+
+    def account_states(self, usernames):
+        with self._lock:
+            return {username: (self.accounts[username].last_burned, self.accounts[username].level)
+                    for username in usernames if username in self.accounts}
+
+    def set_level(self, username, level):
+        with self._lock:
+            acc = self.accounts.get(username)
+            if acc is not None:
+                acc.level = int(level)
+                self._changed(acc)
+
+    def set_burned(self, username, ts):
+        with self._lock:
+            acc = self.accounts.get(username)
+            if acc is not None:
+                if acc.last_burned < int(ts):
+                    acc.burn_count += 1
+                acc.last_burned = int(ts)
+                self._changed(acc)
+
+    def force_release(self, before_ts):
+        now = int(clock.now())
+        released = []
+        with self._lock:
+            for device, username in list(self.devices.items()):
+                acc = self.accounts[username]
+                if acc.last_returned < before_ts:
+                    released.append((username, device, acc.last_use, acc.last_returned, acc.level, acc.last_burned))
+                    del self.devices[device]
+                    acc.in_use_by = None
+                    acc.last_returned = now
+                    acc.lease_expires = None
+                    self._changed(acc)
+        return released
+
+    def heartbeat(self, device):
+        with self._lock:
+            acc = self.accounts.get(self.devices.get(device))
+            if acc is None:
+                return None
+            acc.lease_expires = self.db.lease_expiry(int(clock.now()))
+            self._dirty.add(acc.username)
+            return acc.lease_expires
+
+    def release_expired(self, now):
+        released = []
+        with self._lock:
+            for device, username in list(self.devices.items()):
+                acc = self.accounts[username]
+                if acc.lease_expires is not None and acc.lease_expires < now:
+                    released.append((username, device, acc.last_use, acc.last_returned, acc.level, acc.last_burned))
+                    del self.devices[device]
+                    acc.in_use_by = None
+                    acc.last_returned = now
+                    acc.lease_expires = None
+                    self._changed(acc)
+        return released
+
+    def grant_missing_leases(self, now):
+        granted = 0
+        with self._lock:
+            for username in self.devices.values():
+                acc = self.accounts[username]
+                if acc.lease_expires is None:
+                    acc.lease_expires = self.db.lease_expiry(now)
+                    self._dirty.add(username)
+                    granted += 1
+        return granted
+
+    def stats_snapshot(self, cooldown_ts):
+        with self._lock:
+            cooling = {acc.username: acc.cooldown_start for acc in self.accounts.values()
+                       if acc.cooldown_start >= cooldown_ts}
+            return dict(self.devices), cooling, len(self.accounts)
+
+    def archive_candidates(self, burn_count, unused_before, limit):
+        candidates = []
+        with self._lock:
+            for acc in self.accounts.values():
+                if len(candidates) >= limit:
+                    break
+                if acc.in_use_by is not None:
+                    continue
+                if burn_count is not None and acc.burn_count >= burn_count:
+                    candidates.append((acc.username, "burned"))
+                elif unused_before is not None and 0 < acc.last_use < unused_before:
+                    candidates.append((acc.username, "unused"))
+        return candidates
+
+    def archive(self, usernames, reason, now):
+        # drop the accounts from memory, write their pending changes and move them in the database
+        with self._lock:
+            removed = [self.accounts.pop(username) for username in usernames
+                       if username in self.accounts and self.accounts[username].in_use_by is None]
+            self._dirty.difference_update(acc.username for acc in removed)
+        archived: set = set()
+        if not removed:
+            return archived
+        try:
+            with Db() as conn:
+                conn.cur.executemany(self.persist_sql, [acc.row() for acc in removed])
+            archived = self.db.archive([acc.username for acc in removed], reason, now)
+        finally:
+            # accounts that couldn't be archived stay in the pool
+            with self._lock:
+                for acc in removed:
+                    if acc.username not in archived:
+                        self._add(acc)
+                        self._dirty.add(acc.username)
+        return archived
+
+    def restore(self, usernames, now):
+        restored = self.db.restore(usernames, now)
+        if restored:
+            with Db() as conn:
+                conn.cur.execute(f"{self.load_sql} AND username IN ({Db.placeholders(len(restored))})",
+                                 (self.db.pool_name, *restored))
+                rows = conn.cur.fetchall()
+            with self._lock:
+                for row in rows:
+                    self._add(Account(*row))
+        return restored
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return 0
+                rows = [self.accounts[username].row() for username in self._dirty if username in self.accounts]
+                self._dirty.clear()
+            try:
+                with Db() as conn:
+                    conn.cur.executemany(self.persist_sql, rows)
+            except Exception as e:
+                logger.error(f"Failed persisting {len(rows)} account changes - retrying with next flush: {e}")
+                with self._lock:
+                    self._dirty.update(row[-1] for row in rows)
+                return 0
+            logger.trace(f"persisted {len(rows)} account changes")
+            return len(rows)
+
+    def _flush_loop(self):
+        while not self._stop.wait(self._flush_interval):
+            self.flush()
@@ -0,0 +1,154 @@
+import asyncio
+import contextvars
+import functools
+import time
+
+from loguru import logger
+
+import clock
+from config import Config
+from db_connection import DbConnection as Db
+from metrics import db_query_duration, query_kind
+import profiler
+from statements import STATEMENTS
+
+
+def run_sync(func, *args, **kwargs):
+    """
+    Run a blocking function in the default executor, with the current context - the request's trace records its
+    database statements.
+    """
+    call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+    return asyncio.get_running_loop().run_in_executor(None, call)
+
+
+class AsyncDb:
+    """
+    Coroutine counterpart of the DbConnection methods used while serving requests, backed by an aiomysql pool.
+    Statements are shared with DbConnection - `db` is the store of the account pool, the AsyncDb of another account
+    pool can be passed as `shared` to share its connections.
+    """
+
+    def __init__(self, db=Db, shared=None):
+        self.db = db
+        self.shared = shared
+        self.pool = None
+
+    async def open(self):
+        if self.shared is not None:
+            self.pool = self.shared.pool
+            return
+        import aiomysql
+        self.pool = await aiomysql.create_pool(host=Config.db_host, port=Config.db_port, user=Config.db_user,
+                                               password=Config.db_pw, db=Config.db, autocommit=True, minsize=1,
+                                               maxsize=Config.db_pool_size,
+                                               pool_recycle=Config.db_pool_recycle_seconds)
+        logger.info(f"opened async database pool with up to {Config.db_pool_size} connections")
+
+    async def close(self):
+        if self.pool is not None and self.shared is None:
+            self.pool.close()
+            await self.pool.wait_closed()
+
+    @staticmethod
+    async def timed(cur, sql, params):
+        start = time.perf_counter()
+        try:
+            await cur.execute(sql, params)
+        finally:
+            elapsed, kind = time.perf_counter() - start, query_kind(sql)
+            db_query_duration.observe(elapsed, kind)
+            profiler.span("db", kind, start, elapsed)
+
+    async def fetchone(self, sql, params=()):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await self.timed(cur, sql, params)
+                return await cur.fetchone()
+
+    async def fetchall(self, sql, params=()):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await self.timed(cur, sql, params)
+                return await cur.fetchall()
+
+    async def execute(self, sql, params=()):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await self.timed(cur, sql, params)
+
+    async def checkout(self, device, mark_last_use=True, level=None, cooldown_ts=None, username=None, current=False):
+        select, params = self.db.checkout_select(device, level, cooldown_ts, username, current)
+        select = STATEMENTS[select]
+        now = int(clock.now())
+        async with self.pool.acquire() as conn:
+            await conn.begin()
+            try:
+                async with conn.cursor() as cur:
+                    await self.timed(cur, select, params)
+                    row = await cur.fetchone()
+                    if not row or not row[0] or not row[1]:
+                        await conn.rollback()
+                        return None, None
+                    picked, password = row
+                    await self.timed(cur, Db.release_sql, (now, self.db.pool_name, device))
+                    if mark_last_use:
+                        await self.timed(cur, Db.assign_sql, (device, now, self.db.lease_expiry(now), picked))
+                    else:
+                        await self.timed(cur, Db.assign_keep_last_use_sql, (device, self.db.lease_expiry(now), picked))
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+        return picked, password
+
+    async def current_account(self, device):
+        row = await self.fetchone(Db.current_account_sql, (self.db.pool_name, device))
+        return row[0] if row else None
+
+    async def account_states(self, usernames):
+        if not usernames:
+            return {}
+        rows = await self.fetchall(Db.account_states_sql(len(usernames)), tuple(usernames))
+        return {username: (last_burned, level) for username, last_burned, level in rows}
+
+    async def set_level(self, username, level):
+        await self.execute(Db.set_level_sql, (int(level), username, self.db.pool_name))
+
+    async def set_burned(self, username, ts):
+        await self.execute(Db.set_burned_sql, (int(ts), int(ts), username, self.db.pool_name))
+
+    async def heartbeat(self, device):
+        expires = self.db.lease_expiry(int(clock.now()))
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await self.timed(cur, Db.heartbeat_sql, (expires, self.db.pool_name, device))
+                found = cur.rowcount > 0
+        return expires if found else None
+
+
+class AwaitableStore:
+    """
+    Exposes a synchronous store with the coroutine interface of AsyncDb. Calls of a `blocking` store - one querying the
+    database, like the sqlite store or a ReservingStore - run in the default executor, calls of the in-memory
+    AccountPool on the event loop.
+    """
+
+    def __init__(self, store, blocking=False):
+        self.store = store
+        self.blocking = blocking
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def __getattr__(self, name):
+        func = getattr(self.store, name)
+
+        async def call(*args, **kwargs):
+            if self.blocking:
+                return await run_sync(func, *args, **kwargs)
+            return func(*args, **kwargs)
+        return call
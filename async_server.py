@@ -0,0 +1,346 @@
+import asyncio
+import base64
+import binascii
+import hmac
+import json
+import re
+import time
+
+from aiohttp import web
+from loguru import logger
+
+import metrics
+from account_pool import AccountPool
+from async_db import AsyncDb, AwaitableStore, run_sync
+import clock
+from db_connection import DbConnection as Db
+from events import KEEPALIVE, server_sent_event
+import profiler
+from rate_limit import RateLimit
+from read_cache import MISSING
+from reservations import ReservingStore
+from server import AccountServer, PoolServer, route_label
+from utils import can_be_type
+
+
+class AsyncAccountServer(AccountServer):
+    """
+    AccountServer serving the same routes on aiohttp, with database access through an aiomysql pool - a single
+    event loop handles all concurrent requests without a thread per request.
+
+    Startup (migrations, account import, stats) and the periodic jobs keep using the synchronous DbConnection.
+    """
+
+    def create_pool(self, name):
+        return AsyncPoolServer(self, name)
+
+    def create_async_store(self, shared=None):
+        # reservations are claimed through the synchronous connection pool - checkouts on aiomysql search directly
+        if isinstance(self.store, ReservingStore) and Db.backend().name == "mysql":
+            self.store = self.store.store
+        # aiomysql is for MySQL only - the in-memory pool and the embedded sqlite database are used directly
+        if not Db.is_store(self.store) or Db.backend().name != "mysql":
+            self.async_store = AwaitableStore(self.store, blocking=not isinstance(self.store, AccountPool))
+        else:
+            self.async_store = AsyncDb(self.store, shared=shared)
+
+    def launch_server(self):
+        self.create_async_store()
+        # the named pools share the default pool's aiomysql connections
+        shared = self.async_store if isinstance(self.async_store, AsyncDb) else None
+        for server in self.pools.values():
+            if server is not self:
+                server.create_async_store(shared)
+        self.app = web.Application(middlewares=[self.observe_request, self.basic_auth],
+                                   client_max_size=16 * 1000 * 1000)
+        self.app.on_startup.append(self.open_store)
+        self.app.on_cleanup.append(self.close_store)
+
+        # registered first - routes match in the order they're registered, and the pool names take precedence over
+        # device and account names
+        named = [name for name in self.pools if name != self.config.pool_name]
+        if named:
+            pattern = "{pool:" + "|".join(re.escape(name) for name in named) + "}"
+            for path, handler in self.pool_routes:
+                methods = ("GET",) if handler == "cached_stats" else ("GET", "POST")
+                handler = "async_stats" if handler == "cached_stats" else handler
+                for method in methods:
+                    self.app.router.add_route(method, path.replace("<pool>", pattern).replace("<", "{")
+                                              .replace(">", "}"), self.respond_pool(handler))
+
+        routes = [
+            ("/get-current/{device}", self.get_current_account),
+            ("/heartbeat/{device}", self.heartbeat),
+            ("/get/{device}", self.get_account),
+            ("/get/{device}/{level}", self.get_account),
+            ("/set/level/by-device/{device}/{level}", self.set_level_by_device),
+            ("/set/level/by-account/{account}/{level}", self.set_level_by_account),
+            ("/set/burned/by-device/{device}", self.set_burned_by_device),
+            ("/set/burned/by-device/{device}/{ts}", self.set_burned_by_device),
+            ("/set/burned/by-account/{account}", self.set_burned_by_account),
+            ("/set/burned/by-account/{account}/{ts}", self.set_burned_by_account),
+        ]
+        for path, handler in routes:
+            self.app.router.add_route("GET", path, self.respond(handler))
+            self.app.router.add_route("POST", path, self.respond(handler))
+        self.app.router.add_route("GET", "/stats", self.respond(self.async_stats))
+        self.app.router.add_route("GET", "/metrics", self.async_metrics)
+        self.app.router.add_route("GET", "/events", self.async_event_stream)
+        # the batch routes run their set-based transactions on the synchronous store in the default executor
+        self.app.router.add_route("POST", "/batch/get", self.respond_json(self.in_pool("get_accounts")))
+        self.app.router.add_route("POST", "/batch/set/level", self.respond_json(self.in_pool("set_levels")))
+        self.app.router.add_route("POST", "/batch/set/burned", self.respond_json(self.in_pool("set_burned_many")))
+        self.app.router.add_route("POST", "/admin/reload-accounts",
+                                  self.respond_json(self.in_pool("admin_reload_accounts")))
+        self.app.router.add_route("GET", "/admin/archive", self.respond_query(self.archived_accounts))
+        self.app.router.add_route("POST", "/admin/archive", self.respond_json(self.in_pool("admin_archive")))
+        self.app.router.add_route("POST", "/admin/archive/restore", self.respond_json(self.in_pool("admin_restore")))
+        if self.tracer is not None:
+            self.app.router.add_route("GET", "/debug/traces", self.respond_query(self.debug_traces))
+            self.app.router.add_route("GET", "/debug/traces/slowest", self.respond_query(self.debug_slowest_traces))
+            self.app.router.add_route("GET", "/debug/profile", self.async_debug_profile)
+        self.app.router.add_route("*", "/{tail:.*}", self.fallback)
+
+        logger.info(f"start listening on port {self.port} (async)")
+        web.run_app(self.app, host=self.host, port=self.port, print=None, access_log=None)
+
+    async def open_store(self, app):
+        # the default pool's first - the others share its connections
+        for server in self.pools.values():
+            await server.async_store.open()
+
+    async def close_store(self, app):
+        for server in self.pools.values():
+            await server.async_store.close()
+
+    def respond(self, handler):
+        async def wrapped(request):
+            data, code, headers = await handler(**request.match_info)
+            return web.json_response(data, status=code, headers=headers)
+        return wrapped
+
+    def respond_pool(self, handler):
+        # like respond, with the handler of the pool named in the path
+        async def wrapped(request):
+            params = dict(request.match_info)
+            data, code, headers = await getattr(self.pools[params.pop("pool")], handler)(**params)
+            return web.json_response(data, status=code, headers=headers)
+        return wrapped
+
+    @staticmethod
+    def run_sync(func, *args):
+        return run_sync(func, *args)
+
+    def respond_json(self, handler):
+        async def wrapped(request):
+            try:
+                payload = await request.json()
+            except ValueError:
+                payload = None
+            data, code, headers = await self.run_sync(handler, payload)
+            return web.json_response(data, status=code, headers=headers)
+        return wrapped
+
+    def respond_query(self, handler):
+        async def wrapped(request):
+            data, code, headers = await self.run_sync(handler, dict(request.query))
+            return web.json_response(data, status=code, headers=headers)
+        return wrapped
+
+    @web.middleware
+    async def observe_request(self, request, handler):
+        ts = time.time()
+        start = time.perf_counter()
+        trace = self.tracer.start(request.method, request.path) if self.tracer is not None else None
+        status = 500
+        response = None
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            # the rule in Flask's notation, as labelled by the Flask server
+            match = request.match_info.route
+            if match.resource is None or match.handler == self.fallback:
+                route = "unmatched"
+            else:
+                route = route_label(match.resource.canonical)
+            latency = time.perf_counter() - start
+            if trace is not None:
+                server_timing = self.finish_trace(trace, route, status)
+                # streamed responses (the event stream) have sent their headers already
+                if response is not None and not response.prepared:
+                    response.headers["Server-Timing"] = server_timing
+            metrics.http_request_duration.observe(latency, route)
+            metrics.http_requests.inc(route, request.method, str(status))
+            if self.capture is not None:
+                await self.capture_request(request, ts, route, status, latency, response)
+
+    async def capture_request(self, request, ts, route, status, latency, response):
+        body = None
+        if request.can_read_body:
+            try:
+                body = await request.json()
+            except ValueError:
+                pass
+        data = None
+        if isinstance(response, web.Response) and response.content_type == "application/json":
+            data = json.loads(response.body)
+        params = {key: value for key, value in request.match_info.items() if key != "tail"}
+        self.capture.record(ts, request.method, route, params, body, status, latency, data)
+
+    @web.middleware
+    async def basic_auth(self, request, handler):
+        # same check as flask_basicauth: HTTP basic auth with the configured credentials on every route
+        try:
+            scheme, encoded = request.headers.get("Authorization", "").split(" ", 1)
+            username, password = base64.b64decode(encoded).decode().split(":", 1)
+        except (ValueError, binascii.Error, UnicodeDecodeError):
+            username = password = None
+        if (username is None or scheme.lower() != "basic"
+                or not hmac.compare_digest(username, self.config.auth_username or "")
+                or not hmac.compare_digest(password, self.config.auth_password or "")):
+            return web.Response(status=401, headers={"WWW-Authenticate": 'Basic realm=""'})
+        return await handler(request)
+
+    async def fallback(self, request):
+        logger.warning("Fallback called")
+        logger.warning(f"{request.method} request to fallback at {request.path}")
+        data, code, headers = self.invalid_request()
+        return web.json_response(data, status=code, headers=headers)
+
+    async def async_stats(self):
+        return self.cached_stats(), 200, self.resp_headers
+
+    async def async_metrics(self, request):
+        # the shared request log's size is read from the database
+        text, code, headers = await self.run_sync(self.export_metrics)
+        headers.pop("Content-Type")
+        return web.Response(text=text, status=code, headers=headers, content_type="text/plain",
+                            charset="utf-8")
+
+    async def async_debug_profile(self, request):
+        # runs for the whole sampling window, in the default executor
+        data, code, headers = await self.run_sync(self.debug_profile, dict(request.query))
+        if isinstance(data, str):
+            headers.pop("Content-Type")
+            return web.Response(text=data, status=code, headers=headers, content_type="text/plain", charset="utf-8")
+        return web.json_response(data, status=code, headers=headers)
+
+    async def async_event_stream(self, request):
+        pools = self.event_types(request.query.get("pools"))
+        subscription = self.events.subscribe(self.event_types(request.query.get("types")),
+                                             loop=asyncio.get_running_loop(), pools=pools)
+        response = web.StreamResponse(headers={**self.resp_headers, "Content-Type": "text/event-stream",
+                                               "Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+        try:
+            await response.prepare(request)
+            for event in self.pool_events(pools):
+                await response.write(server_sent_event(event).encode())
+            while True:
+                events = await subscription.wait(self.config.event_keepalive_seconds)
+                if not events:
+                    await response.write(KEEPALIVE.encode())
+                for event in events:
+                    await response.write(server_sent_event(event).encode())
+        except ConnectionResetError:
+            logger.debug("event stream client disconnected")
+        finally:
+            subscription.close()
+        return response
+
+    async def get_account(self, device=None, level=30):
+        if not device or not can_be_type(level, int):
+            return self.invalid_request()
+        # the rate limiter and the request log are shared through the database with shared_state, and the request log
+        # writes its journal - their steps run in the default executor instead of blocking the event loop
+        with profiler.phase("rate_limit"):
+            rate_limit_state = await self.run_sync(self.is_rate_limited, device)
+        with profiler.phase("account_states"):
+            if rate_limit_state:
+                usernames = await self.run_sync(self.rate_limiter.logged_usernames, device)
+                states = await self.async_store.account_states(usernames)
+            else:
+                states = {}
+        with profiler.phase("choose_account"):
+            rate_limit_state, pick = await self.run_sync(self.choose_account, device, level, rate_limit_state, states)
+        with profiler.phase("checkout"):
+            username, pw = await self.async_store.checkout(device, mark_last_use=rate_limit_state != RateLimit.burst,
+                                                           **pick)
+        with profiler.phase("checked_out"):
+            return await self.run_sync(self.checked_out, device, rate_limit_state, username, pw)
+
+    async def set_level_by_account(self, account=None, level=None):
+        logger.info(f"Set level by account: {account=} to {level=}")
+        if not (level and account) or not can_be_type(level, int):
+            return self.invalid_request()
+        await self.async_store.set_level(account, level)
+        self.events.publish("level", username=account, level=int(level))
+        return self.resp_ok()
+
+    async def set_level_by_device(self, device=None, level=None):
+        device_logger = logger.bind(name=device)
+        device_logger.info(f"Set level by device to {level=}")
+        if not (device and level) or not can_be_type(level, int):
+            return self.invalid_request()
+        username = await self.async_store.current_account(device)
+        if username:
+            return await self.set_level_by_account(account=username, level=level)
+        return self.invalid_request()
+
+    async def set_burned_by_account(self, account=None, ts=None):
+        ts = int(clock.now()) if ts is None else ts
+        logger.info(f"Set burned by account: {account=} at {ts=}")
+        if not (account and ts) or not can_be_type(ts, int):
+            return self.invalid_request()
+        await self.async_store.set_burned(account, ts)
+        self.pool_stats.on_burned(account, ts)
+        self.stats_cache.clear()
+        self.events.publish("burned", username=account, ts=int(ts))
+        self.check_pool()
+        return self.resp_ok()
+
+    async def set_burned_by_device(self, device=None, ts=None):
+        ts = int(clock.now()) if ts is None else ts
+        device_logger = logger.bind(name=device)
+        device_logger.info(f"Set burned by device at {ts=}")
+        if not (device and ts) or not can_be_type(ts, int):
+            return self.invalid_request()
+        username = await self.async_store.current_account(device)
+        if username:
+            return await self.set_burned_by_account(account=username, ts=ts)
+        return self.invalid_request()
+
+    async def get_current_account(self, device=None):
+        device_logger = logger.bind(name=device)
+        device_logger.info("Get current account")
+        if not device:
+            return self.invalid_request()
+        username = self.current_account_cache.get(device)
+        if username is MISSING:
+            token = self.current_account_cache.token()
+            username = await self.async_store.current_account(device)
+            self.current_account_cache.set(device, username, token)
+        if username:
+            if self.config.lease_seconds > 0:
+                await self.async_store.heartbeat(device)
+            data = {"username": username}
+            device_logger.info(f"Return current account: {data}")
+            return self.resp_ok(data)
+        return self.invalid_request()
+
+    async def heartbeat(self, device=None):
+        if not device:
+            return self.invalid_request()
+        if self.config.lease_seconds <= 0:
+            return self.resp_ok({"lease_expires": None})
+        return self.heartbeat_response(device, await self.async_store.heartbeat(device))
+
+
+class AsyncPoolServer(PoolServer, AsyncAccountServer):
+    """
+    PoolServer with the coroutine handlers of the AsyncAccountServer - its async_store is created by the server.
+    """
@@ -0,0 +1,199 @@
+import functools
+import os
+import re
+import sqlite3
+
+from config import Config
+
+
+class PreparedCursor:
+    """
+    Cursor bound to a single statement - executed with nothing but its parameters.
+    """
+
+    __slots__ = ("cursor", "sql")
+
+    def __init__(self, cursor, sql):
+        self.cursor = cursor
+        self.sql = sql
+
+    def execute(self, params):
+        return self.cursor.execute(self.sql, params)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def close(self):
+        self.cursor.close()
+
+
+class MysqlPreparedCursor(PreparedCursor):
+    __slots__ = ()
+
+    def fetchall(self):
+        # depending on the connector version, the binary protocol returns text columns as bytearrays
+        return [tuple(value.decode() if isinstance(value, (bytes, bytearray)) else value for value in row)
+                for row in self.cursor.fetchall()]
+
+
+class MysqlBackend:
+    """
+    MySQL / MariaDB through mysql.connector. Statements are written in MySQL syntax and passed through unchanged.
+    """
+
+    name = "mysql"
+    sql_dir = "sql"
+
+    def __init__(self):
+        import mysql.connector
+        self.driver = mysql.connector
+        self.connection_errors = (mysql.connector.errors.InterfaceError, mysql.connector.errors.OperationalError)
+        self.connect_args = {
+            "host": Config.db_host,
+            "port": Config.db_port,
+            "user": Config.db_user,
+            "passwd": Config.db_pw,
+            "database": Config.db,
+            # autocommit to always wait for queries to finish?
+            # https://stackoverflow.com/a/54752005
+            "autocommit": True
+        }
+        # connections idling for longer than this get pinged before they're handed out again
+        self.ping_seconds = Config.db_pool_ping_seconds
+
+    def connect(self):
+        return self.driver.connect(**self.connect_args)
+
+    def ping(self, conn):
+        # no reconnect - a new session has none of the connection's prepared statements, the pool replaces it instead
+        conn.ping(reconnect=False)
+
+    def begin(self, conn):
+        conn.start_transaction()
+
+    def lock_migrations(self, conn, timeout):
+        # a named lock of the session - MySQL commits every schema change right away, a transaction can't cover them
+        cursor = conn.cursor()
+        cursor.execute("SELECT GET_LOCK('pogo_migrate', %s)", (timeout,))
+        locked = cursor.fetchone()[0]
+        cursor.close()
+        if locked != 1:
+            raise RuntimeError(f"another process is still migrating the database after {timeout}s")
+
+    def unlock_migrations(self, conn):
+        cursor = conn.cursor()
+        cursor.execute("SELECT RELEASE_LOCK('pogo_migrate')")
+        cursor.fetchall()
+        cursor.close()
+
+    def prepare(self, conn, sql):
+        # server-side prepared statement - parsed by MySQL once, on the first execution
+        return MysqlPreparedCursor(conn.cursor(prepared=True), sql)
+
+    def translate(self, sql):
+        return sql
+
+    def upsert_sql(self, table, columns, keys, update=(), keep_greatest=()):
+        """
+        INSERT statement that updates the `update` columns to the new values and the `keep_greatest` columns to the
+        greater of the old and new value if a row with the same `keys` exists - and leaves the row as it is without
+        any of them.
+        """
+        assignments = [f"{column} = VALUES({column})" for column in update]
+        assignments += [f"{column} = GREATEST({column}, VALUES({column}))" for column in keep_greatest]
+        # a no-op assignment instead of INSERT IGNORE, which would turn other errors into warnings as well
+        assignments = assignments or [f"{keys[0]} = {keys[0]}"]
+        return (f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))}) "
+                f"ON DUPLICATE KEY UPDATE {', '.join(assignments)}")
+
+    def table_exists_sql(self):
+        return "SELECT count(*) FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s"
+
+
+class SqliteBackend:
+    """
+    Embedded SQLite database in WAL mode - no database server required, suitable for single-node setups.
+
+    Statements written in MySQL syntax are translated: %s placeholders become ?, GREATEST() becomes the multi-argument
+    MAX() and row locks (FOR UPDATE [SKIP LOCKED]) are dropped - transactions are started with BEGIN IMMEDIATE,
+    which takes the database's write lock up front, so concurrent checkouts are serialized instead.
+    """
+
+    name = "sqlite"
+    sql_dir = os.path.join("sql", "sqlite")
+    connection_errors = (sqlite3.InterfaceError, sqlite3.OperationalError)
+    ping_seconds = None
+
+    pragmas = (
+        "PRAGMA journal_mode = WAL",
+        "PRAGMA synchronous = NORMAL",
+        "PRAGMA busy_timeout = 10000",
+        "PRAGMA foreign_keys = OFF",
+        "PRAGMA temp_store = MEMORY",
+        "PRAGMA cache_size = -65536",
+        "PRAGMA mmap_size = 268435456",
+    )
+
+    def __init__(self):
+        self.path = Config.db_path
+
+    def connect(self):
+        # isolation_level None: autocommit unless a transaction is started explicitly
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False,
+                               cached_statements=256)
+        for pragma in self.pragmas:
+            conn.execute(pragma)
+        return conn
+
+    def ping(self, conn):
+        pass
+
+    def begin(self, conn):
+        conn.execute("BEGIN IMMEDIATE")
+
+    def lock_migrations(self, conn, timeout):
+        # the write lock of a single transaction applying all migrations - schema changes are transactional in SQLite
+        conn.execute(f"PRAGMA busy_timeout = {int(timeout * 1000)}")
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+        finally:
+            conn.execute("PRAGMA busy_timeout = 10000")
+
+    def unlock_migrations(self, conn):
+        # the transaction ends with the connection's commit - or rollback, if a migration failed
+        pass
+
+    def prepare(self, conn, sql):
+        # the connection's statement cache keeps the compiled statement for the translated SQL
+        return PreparedCursor(conn.cursor(), self.translate(sql))
+
+    @functools.lru_cache(maxsize=512)
+    def translate(self, sql):
+        sql = re.sub(r"\s+FOR UPDATE(\s+SKIP LOCKED)?", "", sql, flags=re.IGNORECASE)
+        sql = re.sub(r"\bGREATEST\(", "MAX(", sql, flags=re.IGNORECASE)
+        return sql.replace("%s", "?")
+
+    def upsert_sql(self, table, columns, keys, update=(), keep_greatest=()):
+        assignments = [f"{column} = excluded.{column}" for column in update]
+        assignments += [f"{column} = MAX({column}, excluded.{column})" for column in keep_greatest]
+        action = f"DO UPDATE SET {', '.join(assignments)}" if assignments else "DO NOTHING"
+        return (f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))}) "
+                f"ON CONFLICT ({', '.join(keys)}) {action}")
+
+    def table_exists_sql(self):
+        return "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = %s"
+
+
+BACKENDS = {backend.name: backend for backend in (MysqlBackend, SqliteBackend)}
+
+
+def create_backend(name=None):
+    name = name or Config.db_backend
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise ValueError(f"unknown database backend {name!r} - choose one of {', '.join(BACKENDS)}")
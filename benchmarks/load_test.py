@@ -0,0 +1,258 @@
+"""
+Load test simulating a fleet of devices against a locally started AccountServer.
+
+The server is started in-process with the settings from config.ini and served by a threaded werkzeug server. N
+accounts are seeded through the AccountImporter, with levels matching the levels the devices ask for (0, 10 and the
+default 30), then M simulated devices request accounts, poll their current account, report burned accounts and
+occasionally retry quickly to trigger the burst rate limit.
+
+Use a dedicated database - --reset deletes all accounts and request log state before seeding!
+
+Run from the repository root: python benchmarks/load_test.py --accounts 2000 --devices 100 --duration 60
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loguru import logger  # noqa: E402
+from werkzeug.serving import make_server  # noqa: E402
+
+from account_import import AccountImporter  # noqa: E402
+from db_connection import DbConnection as Db  # noqa: E402
+import metrics  # noqa: E402
+from server import AccountServer  # noqa: E402
+
+# levels of the seeded accounts, in turns - about as many accounts for each level as devices ask for it: half of the
+# requests use the default level 30, the others ask for 0, 10 or 30
+SEED_LEVELS = (0, 10, 30, 30, 32, 35)
+
+
+class Fleet:
+    def __init__(self, base_url, username, password, devices, duration, think, burn_rate, burst_rate, seed,
+                 lease_seconds=0):
+        self.base_url = base_url
+        self.auth = "Basic " + base64.b64encode(f"{username}:{password}".encode()).decode()
+        self.devices = [f"bench-device-{i}" for i in range(devices)]
+        self.duration = duration
+        self.think = think
+        self.burn_rate = burn_rate
+        self.burst_rate = burst_rate
+        self.random = random.Random(seed)
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lease_seconds = lease_seconds
+        self.assigned: dict = {}
+        self.holders: dict = {}
+        # devices with a checkout in flight, and when the request that last renewed a device's lease started
+        self.checking_out: set = set()
+        self.renewed: dict = {}
+        self.violations: list = []
+        self.lock = threading.Lock()
+
+    def call(self, endpoint, path):
+        request = urllib.request.Request(self.base_url + path, headers={"Authorization": self.auth})
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                body = json.loads(response.read())
+                status = response.status
+        except urllib.error.HTTPError as e:
+            body = None
+            status = e.code
+        except Exception as e:
+            logger.debug(f"{path} failed: {e}")
+            body = None
+            status = 0
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.latencies[endpoint].append(elapsed)
+            if status != 200:
+                self.errors[endpoint] += 1
+        return body
+
+    def checkout(self, device, endpoint, path):
+        with self.lock:
+            self.checking_out.add(device)
+        start = time.monotonic()
+        self.got_account(device, self.call(endpoint, path), start)
+
+    def hold_active(self, device, now):
+        """
+        Whether the device certainly still holds its account - its account can have been released by a checkout in
+        flight or by the expiry of its lease.
+        """
+        if device in self.checking_out:
+            return False
+        # the lease was renewed at the earliest when the renewing request started
+        return self.lease_seconds <= 0 or now < self.renewed[device] + self.lease_seconds
+
+    def got_account(self, device, body, start):
+        with self.lock:
+            self.checking_out.discard(device)
+            if not body or "data" not in body:
+                return
+            username = body["data"]["username"]
+            # correctness: an account must never be held by two devices at the same time
+            holder = self.holders.get(username)
+            if holder is not None and holder != device and self.hold_active(holder, time.monotonic()):
+                self.violations.append({"account": username, "devices": [holder, device]})
+            previous = self.assigned.get(device)
+            if previous is not None and self.holders.get(previous) == device:
+                del self.holders[previous]
+            self.assigned[device] = username
+            self.holders[username] = device
+            self.renewed[device] = start
+
+    def got_current(self, device, body, start):
+        # asking for the current account renews the lease
+        if body and "data" in body:
+            with self.lock:
+                self.renewed[device] = start
+
+    def run_device(self, device, rnd):
+        deadline = time.monotonic() + self.duration
+        # spread the initial requests like devices coming online after a restart
+        time.sleep(rnd.uniform(0, self.think))
+        while time.monotonic() < deadline:
+            if rnd.random() < 0.5:
+                self.checkout(device, "get", f"/get/{device}")
+            else:
+                self.checkout(device, "get_level", f"/get/{device}/{rnd.choice([0, 10, 30])}")
+            if rnd.random() < self.burst_rate:
+                # persistent retry right after the first request - hits RateLimit.burst
+                self.checkout(device, "get", f"/get/{device}")
+            for _ in range(rnd.randint(1, 3)):
+                time.sleep(rnd.uniform(0, self.think))
+                start = time.monotonic()
+                self.got_current(device, self.call("get_current", f"/get-current/{device}"), start)
+            if rnd.random() < self.burn_rate:
+                self.call("set_burned", f"/set/burned/by-device/{device}")
+            time.sleep(rnd.uniform(0, self.think))
+
+    def run(self):
+        threads = [threading.Thread(target=self.run_device, args=(device, random.Random(self.random.random())),
+                                    daemon=True) for device in self.devices]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def statements():
+    # statements executed by the server's database stores, including its background jobs
+    return sum(count for _, _, count in metrics.db_query_duration.values().values())
+
+
+def seed_levels(count):
+    levels = {f"bench_{i}": SEED_LEVELS[i % len(SEED_LEVELS)] for i in range(count)}
+    usernames = list(levels)
+    for i in range(0, len(usernames), 500):
+        Db.set_level_many({username: levels[username] for username in usernames[i:i + 500]})
+
+
+def reset_database():
+    with Db() as conn:
+        for table in ("accounts", "request_log", "device_state"):
+            conn.cur.execute(f"DELETE FROM {table}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pogoAccountServer load test")
+    parser.add_argument("--accounts", type=int, default=2000)
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=60, help="seconds to run the fleet")
+    parser.add_argument("--think", type=float, default=0.5, help="max. seconds between a device's requests")
+    parser.add_argument("--burn-rate", type=float, default=0.1, help="share of checkouts followed by a burn")
+    parser.add_argument("--burst-rate", type=float, default=0.1, help="share of checkouts retried right away")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--port", type=int, default=0, help="port to serve on (default: random free port)")
+    parser.add_argument("--reset", action="store_true", help="DELETE all accounts and request log state first")
+    parser.add_argument("--output", default="load_test_results.json")
+    args, _ = parser.parse_known_args()
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    server = AccountServer(launch=False)
+    if args.reset:
+        reset_database()
+        if hasattr(server.request_log, "compact"):
+            server.request_log.data.clear()
+            server.request_log.compact()
+        server.rate_limiter.last_grant.clear()
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as accounts:
+        for i in range(args.accounts):
+            accounts.write(f"bench_{i},pw_{i}\n")
+    try:
+        AccountImporter(accounts.name).run(force=True)
+    finally:
+        os.unlink(accounts.name)
+    seed_levels(args.accounts)
+    if hasattr(server.store, "load"):
+        server.store.load()
+    server.reconcile_stats()
+
+    http = make_server("127.0.0.1", args.port, server.create_app(), threaded=True)
+    threading.Thread(target=http.serve_forever, daemon=True).start()
+    fleet = Fleet(f"http://127.0.0.1:{http.server_port}", server.config.auth_username, server.config.auth_password,
+                  args.devices, args.duration, args.think, args.burn_rate, args.burst_rate, args.seed,
+                  server.config.lease_seconds)
+
+    statements_before = statements()
+    elapsed = fleet.run()
+    statements_after = statements()
+    http.shutdown()
+
+    requests = sum(len(values) for values in fleet.latencies.values())
+    results = {
+        "config": vars(args),
+        "memory_pool": server.config.memory_pool,
+        "shared_state": server.config.shared_state,
+        "elapsed_seconds": round(elapsed, 3),
+        "requests": requests,
+        "throughput_rps": round(requests / elapsed, 1) if elapsed else None,
+        "db_statements_per_request": round((statements_after - statements_before) / requests, 2) if requests else None,
+        "endpoints": {
+            endpoint: {
+                "requests": len(values),
+                "errors": fleet.errors[endpoint],
+                "mean_ms": round(statistics.mean(values) * 1000, 3),
+                "p50_ms": round(percentile(values, 50) * 1000, 3),
+                "p95_ms": round(percentile(values, 95) * 1000, 3),
+                "p99_ms": round(percentile(values, 99) * 1000, 3),
+            } for endpoint, values in sorted(fleet.latencies.items())
+        },
+        "correctness": {
+            "double_assignments": len(fleet.violations),
+            "examples": fleet.violations[:10],
+        },
+        "stats": server.stats(),
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+Replay a request trace captured with the [capture] section of config.ini against an AccountServer, and compare the
+replayed latencies and handed out accounts with the captured ones.
+
+By default, the server is started in-process with the settings from config.ini and requests go through the Flask test
+client - --url replays against a running server instead. --speed 1 keeps the trace's original timing, --speed 10
+replays ten times faster and --speed 0 replays as fast as possible, one request after the other in trace order.
+Timed replays send requests from --workers threads, so requests that overlapped in the trace overlap again.
+
+Accounts handed out only match the capture if the database and request log start in the state they were in when
+capturing started - e.g. replay against a copy of the database taken at that time.
+
+Run from the repository root: python benchmarks/replay.py traffic.jsonl --speed 0
+"""
+import argparse
+import base64
+import json
+import os
+import re
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loguru import logger  # noqa: E402
+
+from capture import assigned_accounts, read_trace  # noqa: E402
+from config import Config  # noqa: E402
+
+# route parameters of Flask (<device>, <path:rest>) and aiohttp ({device}) rules
+ROUTE_PARAM = re.compile(r"<(?:\w+:)?(\w+)>|{(\w+)}")
+
+
+def request_path(record):
+    params = record["params"]
+    return ROUTE_PARAM.sub(lambda match: urllib.request.quote(str(params[match.group(1) or match.group(2)]), safe=""),
+                           record["route"])
+
+
+class InProcessClient:
+    def __init__(self, auth):
+        from server import AccountServer
+        # don't capture the replay into the trace being replayed
+        Config.capture_file = ""
+        self.server = AccountServer(launch=False)
+        self.client = self.server.create_app().test_client()
+        self.auth = auth
+
+    def send(self, method, path, body):
+        response = self.client.open(path, method=method, json=body, headers={"Authorization": self.auth})
+        return response.status_code, response.get_json(silent=True)
+
+
+class HttpClient:
+    def __init__(self, base_url, auth):
+        self.base_url = base_url.rstrip("/")
+        self.auth = auth
+
+    def send(self, method, path, body):
+        headers = {"Authorization": self.auth}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+        request = urllib.request.Request(self.base_url + path, data=data, method=method, headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, None
+        except Exception as e:
+            logger.debug(f"{path} failed: {e}")
+            return 0, None
+
+
+class Replay:
+    def __init__(self, client, records):
+        self.client = client
+        self.records = records
+        self.latencies = defaultdict(list)
+        self.captured_latencies = defaultdict(list)
+        self.status_mismatches: list = []
+        self.assignment_mismatches: list = []
+        self.lock = threading.Lock()
+
+    def send(self, index, record):
+        start = time.perf_counter()
+        status, data = self.client.send(record["method"], request_path(record), record.get("body"))
+        elapsed = time.perf_counter() - start
+        accounts = assigned_accounts(data)
+        with self.lock:
+            self.latencies[record["route"]].append(elapsed)
+            self.captured_latencies[record["route"]].append(record["latency_ms"] / 1000)
+            if status != record["status"]:
+                self.status_mismatches.append({"index": index, "route": record["route"], "params": record["params"],
+                                               "captured": record["status"], "replayed": status})
+            if accounts != record.get("accounts", []):
+                self.assignment_mismatches.append({"index": index, "device": record.get("device"),
+                                                   "captured": record.get("accounts", []), "replayed": accounts})
+
+    def run(self, speed, workers):
+        start = time.perf_counter()
+        if speed <= 0:
+            for index, record in enumerate(self.records):
+                self.send(index, record)
+            return time.perf_counter() - start
+        first = self.records[0]["ts"] if self.records else 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for index, record in enumerate(self.records):
+                delay = (record["ts"] - first) / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(self.send, index, record)
+        return time.perf_counter() - start
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def summary(values):
+    return {
+        "mean_ms": round(statistics.mean(values) * 1000, 3),
+        "p50_ms": round(percentile(values, 50) * 1000, 3),
+        "p95_ms": round(percentile(values, 95) * 1000, 3),
+        "p99_ms": round(percentile(values, 99) * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pogoAccountServer trace replay")
+    parser.add_argument("trace", help="JSON lines trace written by the request capture")
+    parser.add_argument("--speed", type=float, default=1, help="1: original timing, N: N times faster, 0: no delays")
+    parser.add_argument("--workers", type=int, default=32, help="threads sending requests of timed replays")
+    parser.add_argument("--url", default=None, help="replay against a running server instead of in-process")
+    parser.add_argument("--limit", type=int, default=None, help="replay only the first N requests")
+    parser.add_argument("--output", default="replay_results.json")
+    args, _ = parser.parse_known_args()
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    records = [record for record in read_trace(args.trace) if record["route"] != "unmatched"][:args.limit]
+    if not records:
+        sys.exit(f"no requests to replay in {args.trace}")
+    records.sort(key=lambda record: record["ts"])
+    auth = "Basic " + base64.b64encode(f"{Config.auth_username}:{Config.auth_password}".encode()).decode()
+    client = HttpClient(args.url, auth) if args.url else InProcessClient(auth)
+    replay = Replay(client, records)
+    elapsed = replay.run(args.speed, args.workers)
+
+    captured_seconds = records[-1]["ts"] - records[0]["ts"]
+    results = {
+        "config": vars(args),
+        "requests": len(records),
+        "captured_seconds": round(captured_seconds, 3),
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_rps": round(len(records) / elapsed, 1) if elapsed else None,
+        "routes": {
+            route: {
+                "requests": len(values),
+                "captured": summary(replay.captured_latencies[route]),
+                "replayed": summary(values),
+            } for route, values in sorted(replay.latencies.items())
+        },
+        "status_mismatches": {
+            "count": len(replay.status_mismatches),
+            "examples": sorted(replay.status_mismatches, key=lambda m: m["index"])[:10],
+        },
+        "assignment_mismatches": {
+            "count": len(replay.assignment_mismatches),
+            "examples": sorted(replay.assignment_mismatches, key=lambda m: m["index"])[:10],
+        },
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Compare the write cost of the request log journal against re-pickling the whole log on every change.
+
+Run from the repository root (config.ini is required): python benchmarks/request_log_bench.py
+"""
+import argparse
+import os
+import pickle
+import sys
+import tempfile
+import time
+
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loguru import logger  # noqa: E402
+
+from request_log import RequestLog  # noqa: E402
+
+
+def populate(data, devices, maxlen):
+    for i in range(devices):
+        data[f"device{i}"] = deque(({"ts": int(time.time()), "username": f"account{i}_{n}"} for n in range(maxlen)),
+                                   maxlen=maxlen)
+
+
+def bench_pickle(directory, devices, writes, maxlen):
+    # the previous implementation: pickle the whole dict in place on every log()
+    data: dict = {}
+    populate(data, devices, maxlen)
+    filename = os.path.join(directory, "bench.pickle")
+    start = time.perf_counter()
+    for i in range(writes):
+        device = f"device{i % devices}"
+        data[device].append({"ts": int(time.time()), "username": f"new{i}"})
+        with open(filename, "wb") as datafile:
+            pickle.dump(data, datafile, -1)
+    return time.perf_counter() - start
+
+
+def bench_journal(directory, devices, writes, maxlen):
+    log = RequestLog(filename=os.path.join(directory, "bench.snapshot"),
+                     journal=os.path.join(directory, "bench.journal"))
+    populate(log.data, devices, maxlen)
+    log.compact()
+    start = time.perf_counter()
+    for i in range(writes):
+        log.log(f"device{i % devices}", {"ts": int(time.time()), "username": f"new{i}"})
+    log.sync()
+    elapsed = time.perf_counter() - start
+    log.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="request log write benchmark")
+    parser.add_argument("--writes", type=int, default=2000)
+    parser.add_argument("--devices", type=int, nargs="+", default=[10, 1000, 10000])
+    args, _ = parser.parse_known_args()
+    logger.remove()
+
+    print(f"{'devices':>8} {'pickle us/write':>16} {'journal us/write':>17} {'speedup':>8}")
+    for devices in args.devices:
+        with tempfile.TemporaryDirectory() as directory:
+            maxlen = 3
+            pickled = bench_pickle(directory, devices, args.writes, maxlen)
+            journaled = bench_journal(directory, devices, args.writes, maxlen)
+        print(f"{devices:>8} {pickled / args.writes * 1e6:>16.1f} {journaled / args.writes * 1e6:>17.1f} "
+              f"{pickled / journaled:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+"""
+Discrete-event simulation of a device fleet against the real account selection and rate limit logic, to tune
+cooldown, rate_limit_minutes, rate_limit_number, strict_rate_limit_minutes and force_release_days before changing them
+in production.
+
+The server's handlers run on a virtual clock (see clock.py) against an in-memory account pool and request log - the
+database and the request log files are never touched, so weeks of virtual time take seconds. Scanning devices hold an
+account until it gets burned or the device restarts, leveling devices level accounts below --level up to it. The
+settings default to config.ini and can be overridden per run.
+
+The report has the pool's exhaustion (samples without an available account), starvation (checkouts answered with "No
+accounts available" and the time devices spent without an account), the utilization of the accounts and the rate
+limit outcomes.
+
+Run from the repository root: python benchmarks/simulate.py --accounts 500 --devices 50 --days 28 --cooldown-hours 48
+"""
+import argparse
+import heapq
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+from collections import Counter, UserDict, deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loguru import logger  # noqa: E402
+
+import clock  # noqa: E402
+import metrics  # noqa: E402
+from account_pool import AccountPool  # noqa: E402
+from config import Config  # noqa: E402
+from events import EventBroadcaster, PoolEvents  # noqa: E402
+from pool_stats import PoolStats  # noqa: E402
+from rate_limit import RateLimiter  # noqa: E402
+from server import AccountServer  # noqa: E402
+
+
+class MemoryRequestLog(UserDict):
+    """
+    RequestLog without the snapshot and journal files.
+    """
+
+    def log(self, name, request):
+        self.data.setdefault(name, deque(maxlen=Config.rate_limit_number)).append(request)
+        return True
+
+    def rotate(self, device):
+        self.data[device].rotate(-1)
+        return True
+
+    def size(self):
+        return len(self.data), sum(len(entries) for entries in self.data.values())
+
+    def get_logged_usernames(self, device):
+        return [entry["username"] for entry in self.data[device]] if device in self.data else []
+
+
+class SimulatedServer(AccountServer):
+    """
+    AccountServer on in-memory state only - no migrations, account import, periodic jobs or web app. The simulation
+    runs the periodic jobs itself, on the virtual clock.
+    """
+
+    def __init__(self, levels):
+        self.config = Config()
+        self.resp_headers = {"Server": "pogoAccountServer"}
+        self.app = None
+        self.capture = None
+        self.request_log = MemoryRequestLog()
+        # never started, so nothing is written to the database
+        self.store = AccountPool()
+        self.store.add_or_update_many((f"sim_{i}", "pw") for i in range(len(levels)))
+        self.store.set_level_many({f"sim_{i}": level for i, level in enumerate(levels)})
+        self.rate_limiter = RateLimiter(self.request_log)
+        self.pool_stats = PoolStats()
+        self.create_caches()
+        self.events = PoolEvents(EventBroadcaster(), self.config.pool_name)
+        self.pool_state = None
+        self.pools = {self.config.pool_name: self}
+        self.reconcile_stats()
+
+
+class Simulation:
+    def __init__(self, server, args, virtual_clock):
+        self.server = server
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.clock = virtual_clock
+        self.start = virtual_clock.time()
+        self.end = self.start + args.days * 86400
+        self.events: list = []
+        self.order = itertools.count()
+        self.devices: dict = {}
+        self.checkouts: Counter = Counter()
+        self.handed_out: Counter = Counter()
+        self.events_run: Counter = Counter()
+        self.starvation_events = 0
+        self.starved_seconds = 0.0
+        self.first_starvation = None
+        self.samples: list = []
+
+    def schedule(self, ts, kind, device=None, generation=None):
+        if ts < self.end:
+            heapq.heappush(self.events, (ts, next(self.order), kind, device, generation))
+
+    def later(self, per_day):
+        # exponentially distributed time until an event happening per_day times a day on average
+        return self.random.expovariate(per_day / 86400) if per_day > 0 else float("inf")
+
+    def checkout(self, device):
+        state = self.devices[device]
+        state["generation"] += 1
+        now = self.clock.time()
+        level = 0 if state["leveler"] else self.args.level
+        data, code, _ = self.server.get_account(device, level)
+        if code != 200:
+            self.starvation_events += 1
+            if self.first_starvation is None:
+                self.first_starvation = now
+            if state["without_since"] is None:
+                state["without_since"] = now
+            self.schedule(now + self.args.retry_minutes * 60, "checkout", device, state["generation"])
+            return
+        if state["without_since"] is not None:
+            self.starved_seconds += now - state["without_since"]
+            state["without_since"] = None
+        username = data["data"]["username"]
+        self.checkouts[device] += 1
+        self.handed_out[username] += 1
+        restart = now + self.later(self.args.restarts_per_day)
+        if state["leveler"]:
+            done = now + self.args.leveling_hours * 3600
+            self.schedule(*((done, "level_up") if done < restart else (restart, "restart")), device,
+                          state["generation"])
+        else:
+            burn = now + self.later(self.args.burns_per_day)
+            self.schedule(*((burn, "burn") if burn < restart else (restart, "restart")), device, state["generation"])
+
+    def handle(self, kind, device):
+        if kind == "burn":
+            self.server.set_burned_by_device(device)
+        elif kind == "level_up":
+            self.server.set_level_by_device(device, self.args.level)
+        if kind in ("checkout", "burn", "level_up", "restart"):
+            self.checkout(device)
+        elif kind == "force_release":
+            self.server.force_release()
+            self.schedule(self.clock.time() + Config.force_release_interval_seconds, kind)
+        elif kind == "sample":
+            stats = self.server.stats()
+            self.samples.append((self.clock.time(), stats["available"], stats["in_use"], stats["cooldown"]))
+            self.schedule(self.clock.time() + self.args.sample_minutes * 60, kind)
+
+    def run(self):
+        start = self.start
+        for i in range(self.args.devices + self.args.levelers):
+            device = f"sim_device_{i}"
+            self.devices[device] = {"leveler": i >= self.args.devices, "generation": 0, "without_since": None}
+            # devices come online over the first --startup-minutes
+            self.schedule(start + self.random.uniform(0, self.args.startup_minutes * 60), "checkout", device, 0)
+        self.schedule(start, "force_release")
+        self.schedule(start, "sample")
+        while self.events:
+            ts, _, kind, device, generation = heapq.heappop(self.events)
+            # events of a device's previous account are obsolete
+            if device is not None and generation != self.devices[device]["generation"]:
+                continue
+            self.clock.advance_to(ts)
+            self.events_run[kind] += 1
+            self.handle(kind, device)
+        self.clock.advance_to(self.end)
+        for state in self.devices.values():
+            if state["without_since"] is not None:
+                self.starved_seconds += self.end - state["without_since"]
+
+    def report(self):
+        start = self.start
+        accounts = len(self.server.store.accounts)
+        exhausted = [ts for ts, available, _, _ in self.samples if available <= 0]
+        in_use = [in_use / accounts for _, _, in_use, _ in self.samples] if accounts else [0]
+        never_used = accounts - len(self.handed_out)
+        checks = metrics.rate_limit_checks.values()
+        return {
+            "exhaustion": {
+                "samples_without_available_accounts": f"{len(exhausted)}/{len(self.samples)}",
+                "first_exhausted_hours": round((exhausted[0] - start) / 3600, 1) if exhausted else None,
+                "min_available": min((available for _, available, _, _ in self.samples), default=None),
+                "mean_cooldown": round(statistics.mean(cooldown for *_, cooldown in self.samples), 1)
+                if self.samples else None,
+            },
+            "starvation": {
+                "failed_checkouts": self.starvation_events,
+                "first_failed_hours": round((self.first_starvation - start) / 3600, 1)
+                if self.first_starvation is not None else None,
+                "device_hours_without_account": round(self.starved_seconds / 3600, 1),
+                "share_of_device_time": round(self.starved_seconds / (len(self.devices) * self.args.days * 86400), 4)
+                if self.devices else None,
+            },
+            "utilization": {
+                "mean_in_use_share": round(statistics.mean(in_use), 4),
+                "accounts_never_handed_out": never_used,
+                "checkouts_per_account": {
+                    "mean": round(sum(self.handed_out.values()) / accounts, 2) if accounts else None,
+                    "max": max(self.handed_out.values(), default=0),
+                },
+                "checkouts_per_device_and_day": round(sum(self.checkouts.values())
+                                                      / len(self.devices) / self.args.days, 2)
+                if self.devices else None,
+            },
+            "rate_limits": {labels[0]: count for labels, count in sorted(checks.items())},
+            "events": dict(self.events_run),
+            "final_stats": self.server.stats(),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pogoAccountServer fleet simulation")
+    parser.add_argument("--accounts", type=int, default=500)
+    parser.add_argument("--low-level-share", type=float, default=0.0,
+                        help="share of the accounts starting at level 0, to be leveled by --levelers")
+    parser.add_argument("--devices", type=int, default=50, help="scanning devices requesting accounts at --level")
+    parser.add_argument("--levelers", type=int, default=0, help="devices leveling accounts below --level")
+    parser.add_argument("--level", type=int, default=30)
+    parser.add_argument("--days", type=float, default=28, help="virtual days to simulate")
+    parser.add_argument("--burns-per-day", type=float, default=2, help="mean burns of a scanning device per day")
+    parser.add_argument("--restarts-per-day", type=float, default=1, help="mean restarts of a device per day")
+    parser.add_argument("--leveling-hours", type=float, default=6, help="hours to level up an account")
+    parser.add_argument("--retry-minutes", type=float, default=5, help="delay before a starved device retries")
+    parser.add_argument("--startup-minutes", type=float, default=10)
+    parser.add_argument("--sample-minutes", type=float, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--cooldown-hours", type=float, default=Config.cooldown_seconds / 3600)
+    parser.add_argument("--rate-limit-minutes", type=int, default=Config.rate_limit_minutes)
+    parser.add_argument("--rate-limit-number", type=int, default=Config.rate_limit_number)
+    parser.add_argument("--strict-rate-limit-minutes", type=float, default=Config.strict_rate_limit_minutes)
+    parser.add_argument("--force-release-days", type=float, default=Config.force_release_seconds / 86400)
+    parser.add_argument("--output", default="simulation_results.json")
+    args, _ = parser.parse_known_args()
+    logger.remove()
+
+    Config.cooldown_seconds = int(args.cooldown_hours * 3600)
+    Config.rate_limit_minutes = args.rate_limit_minutes
+    Config.rate_limit_number = args.rate_limit_number
+    Config.strict_rate_limit_minutes = args.strict_rate_limit_minutes
+    Config.strict_rate_limit_seconds = int(args.strict_rate_limit_minutes * 60)
+    Config.force_release_seconds = int(args.force_release_days * 86400)
+    # leases need heartbeats, which the simulated devices don't send
+    Config.lease_seconds = 0
+    Config.log_checkout_stats = False
+
+    virtual_clock = clock.VirtualClock(int(time.time()))
+    clock.use(virtual_clock)
+    rnd = random.Random(args.seed)
+    levels = [0 if rnd.random() < args.low_level_share else args.level for _ in range(args.accounts)]
+    server = SimulatedServer(levels)
+    simulation = Simulation(server, args, virtual_clock)
+
+    wall = time.perf_counter()
+    simulation.run()
+    elapsed = time.perf_counter() - wall
+
+    results = {
+        "config": vars(args),
+        "wall_seconds": round(elapsed, 2),
+        **simulation.report(),
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Compare statement throughput of SQL built by string interpolation against registered statements prepared once per
+connection and executed with bound parameters.
+
+Runs read-only lookups (an account's level, a device's current account) against the database configured in
+config.ini, on a single pooled connection.
+
+Run from the repository root: python benchmarks/statement_bench.py --queries 20000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loguru import logger  # noqa: E402
+
+from db_connection import DbConnection as Db  # noqa: E402
+
+
+def bench_interpolated(conn, usernames, queries):
+    # the previous style: a new SQL text for every value, parsed and planned on every execution
+    start = time.perf_counter()
+    for i in range(queries):
+        username = usernames[i % len(usernames)]
+        conn.cur.execute(f"SELECT level FROM accounts WHERE username = '{username}' LIMIT 1")
+        conn.cur.fetchall()
+        conn.cur.execute(f"SELECT username FROM accounts WHERE pool = '{Db.pool_name}' AND in_use_by = "
+                         f"'bench_device_{i % 100}' LIMIT 1")
+        conn.cur.fetchall()
+    return time.perf_counter() - start
+
+
+def bench_prepared(conn, usernames, queries):
+    start = time.perf_counter()
+    for i in range(queries):
+        conn.scalar("level", (usernames[i % len(usernames)],))
+        conn.scalar("current_account", (Db.pool_name, f"bench_device_{i % 100}"))
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="prepared statement benchmark")
+    parser.add_argument("--queries", type=int, default=20000)
+    parser.add_argument("--accounts", type=int, default=1000, help="number of distinct usernames to look up")
+    args, _ = parser.parse_known_args()
+    logger.remove()
+
+    with Db() as conn:
+        conn.cur.execute("SELECT username FROM accounts LIMIT %s", (args.accounts,))
+        usernames = [row[0] for row in conn.cur.fetchall()]
+        if not usernames:
+            sys.exit("no accounts in the database - import some first")
+        # warm up both paths
+        bench_interpolated(conn, usernames, 100)
+        bench_prepared(conn, usernames, 100)
+        interpolated = bench_interpolated(conn, usernames, args.queries)
+        prepared = bench_prepared(conn, usernames, args.queries)
+
+    statements = args.queries * 2
+    print(f"backend: {Db.backend().name}, {statements} statements over {len(usernames)} accounts")
+    print(f"{'':>13} {'statements/s':>13} {'us/statement':>13}")
+    for name, elapsed in (("interpolated", interpolated), ("prepared", prepared)):
+        print(f"{name:>13} {statements / elapsed:>13.0f} {elapsed / statements * 1e6:>13.1f}")
+    print(f"speedup: {interpolated / prepared:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import atexit
+import json
+import threading
+
+from loguru import logger
+
+
+def assigned_accounts(data):
+    """
+    Usernames handed out in a response body - of a single checkout or of every result of a batch checkout.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get("data"), dict):
+        return []
+    data = data["data"]
+    if "username" in data:
+        return [data["username"]]
+    return [result["username"] for result in data.get("results", ()) if isinstance(result, dict)
+            and result.get("username")]
+
+
+class TrafficCapture:
+    """
+    Appends one JSON line per served request to a trace file, for benchmarks/replay.py.
+
+    Records are buffered in memory and written every `buffer_size` records, by `flush()` (called periodically by
+    the scheduler) and at exit. Passwords are never written - a record only has the usernames a response handed out.
+    """
+
+    def __init__(self, filename, buffer_size=1000):
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self._buffer: list = []
+        self._lock = threading.Lock()
+        self._file = open(filename, "a")
+        self.records = 0
+        logger.info(f"capturing requests to {filename}")
+        atexit.register(self.close)
+
+    def record(self, ts, method, route, params, body, status, latency, response):
+        line = json.dumps({"ts": round(ts, 6), "method": method, "route": route, "device": params.get("device"),
+                           "params": params, "body": body, "status": status, "latency_ms": round(latency * 1000, 3),
+                           "accounts": assigned_accounts(response)}, separators=(",", ":"))
+        with self._lock:
+            self._buffer.append(line)
+            self.records += 1
+            if len(self._buffer) < self.buffer_size:
+                return
+            lines, self._buffer = self._buffer, []
+            self._write(lines)
+
+    def _write(self, lines):
+        # called with the lock held, keeps the records in order
+        try:
+            self._file.write("\n".join(lines) + "\n")
+            self._file.flush()
+        except Exception as e:
+            logger.warning(f"Failed writing {len(lines)} records to request capture {self.filename}: {e}")
+
+    def flush(self):
+        with self._lock:
+            if self._buffer and not self._file.closed:
+                lines, self._buffer = self._buffer, []
+                self._write(lines)
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+def read_trace(filename):
+    """
+    Yields the records of a captured trace in order, skipping an incomplete last line.
+    """
+    with open(filename) as trace:
+        for line in trace:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                logger.warning(f"skipping broken trace record: {line!r}")
@@ -0,0 +1,42 @@
+import time
+
+
+class Clock:
+    """
+    Wall-clock time in seconds since the epoch, read by everything that timestamps account state or evaluates
+    cooldowns, rate limits and leases.
+    """
+
+    def time(self):
+        return time.time()
+
+
+class VirtualClock(Clock):
+    """
+    Clock that only moves when advanced - lets a simulation run weeks of account activity in seconds.
+    """
+
+    def __init__(self, start=None):
+        self.now = time.time() if start is None else start
+
+    def time(self):
+        return self.now
+
+    def advance_to(self, ts):
+        self.now = max(self.now, ts)
+
+
+_clock = Clock()
+
+
+def now():
+    return _clock.time()
+
+
+def use(clock):
+    """
+    Replace the clock for the whole process - returns the previous one.
+    """
+    global _clock
+    previous, _clock = _clock, clock
+    return previous
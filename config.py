@@ -1,9 +1,11 @@
 import argparse
 import configparser
 import logging
-import time
+import re
 from loguru import logger
 
+import clock
+
 
 config = configparser.ConfigParser()
 config.read("config.ini")
@@ -11,10 +13,30 @@ config.read("config.ini")
 parser = argparse.ArgumentParser(description='Pokemon GO PTC Account Server')
 parser.add_argument('-v', '--verbose', action='store_true')
 parser.add_argument('-vv', '--trace', action='store_true')
+parser.add_argument('--server-mode', choices=['flask', 'async'], default=None,
+                    help='serve with the Flask development server or with aiohttp + aiomysql')
+
+
+def pool_names(default):
+    """
+    Names of the named account pools, from the config's [pool:<name>] sections.
+    """
+    names = []
+    for section in config.sections():
+        if not section.startswith("pool:"):
+            continue
+        name = section[len("pool:"):]
+        if not re.fullmatch(r"[A-Za-z0-9_-]+", name) or name == default:
+            logger.error(f"Invalid account pool name {name!r} - use letters, digits, - and _, and not {default!r}")
+            continue
+        names.append(name)
+    return names
 
 
 class Config:
     general = config["general"]
+    # name of the pool served by the routes without a pool name - the only pool without a [pool:<name>] section
+    pool_name = "default"
     listen_host = general.get("listen_host", "127.0.0.1")
     listen_port = general.getint("listen_port", 9009)
     auth_username = general.get("auth_username", None)
@@ -26,9 +48,34 @@ class Config:
     strict_rate_limit_minutes = general.getint("strict_rate_limit_minutes", 5)
     strict_rate_limit_seconds = strict_rate_limit_minutes * 60
     allow_rate_limit_override_when_burned = general.getboolean("allow_rate_limit_override_when_burned", True)
+    shared_state = general.getboolean("shared_state", False)
+    shared_cache_seconds = general.getfloat("shared_cache_seconds", 2)
+    memory_pool = general.getboolean("memory_pool", False)
+    write_behind_seconds = general.getfloat("write_behind_seconds", 1)
+    reservation_size = general.getint("reservation_size", 0)
+    reservation_refill_seconds = general.getint("reservation_refill_seconds", 1)
     force_release_seconds = general.getint("force_release_days", 30) * 60 * 60 * 24
+    force_release_interval_seconds = general.getint("force_release_interval_minutes", 60) * 60
+    stats_reconcile_seconds = general.getint("stats_reconcile_seconds", 300)
+    lease_seconds = general.getint("lease_minutes", 0) * 60
+    lease_sweep_seconds = general.getint("lease_sweep_seconds", 60)
+    batch_max_items = general.getint("batch_max_items", 500)
+    accounts_file = general.get("accounts_file", "accounts.txt")
+    accounts_reload_seconds = general.getint("accounts_reload_seconds", 60)
+    import_chunk_size = general.getint("import_chunk_size", 1000)
+    read_cache_seconds = general.getfloat("read_cache_seconds", 5)
+    read_cache_size = general.getint("read_cache_size", 10000)
+    event_buffer_size = general.getint("event_buffer_size", 100)
+    event_keepalive_seconds = general.getint("event_keepalive_seconds", 15)
+    pool_low_accounts = general.getint("pool_low_accounts", 10)
+    pool_check_seconds = general.getint("pool_check_seconds", 10)
+    archive_burn_count = general.getint("archive_burn_count", 0)
+    archive_unused_days = general.getint("archive_unused_days", 0)
+    archive_interval_seconds = general.getint("archive_interval_minutes", 60) * 60
+    archive_batch_size = general.getint("archive_batch_size", 1000)
 
-    args = parser.parse_args()
+    args, _ = parser.parse_known_args()
+    server_mode = args.server_mode or general.get("server_mode", "flask")
     if args.verbose:
         loglevel = logging.DEBUG
     elif args.trace:
@@ -37,19 +84,73 @@ class Config:
         loglevel = logging.INFO
 
     database = config["database"]
+    db_backend = database.get("backend", "mysql")
+    db_path = database.get("path", "accounts.db")
     db_host = database.get("host", "127.0.0.1")
     db_port = database.getint("port", 3306)
     db_user = database.get("user", None)
     db_pw = database.get("pass", None)
     db = database.get("db", None)
+    db_pool_size = database.getint("pool_size", 10)
+    db_pool_timeout = database.getint("pool_timeout", 10)
+    db_pool_recycle_seconds = database.getint("pool_recycle_seconds", 3600)
+    db_pool_ping_seconds = database.getint("pool_ping_seconds", 30)
+    db_skip_locked = database.getboolean("skip_locked", True)
+    db_auto_migrate = database.getboolean("auto_migrate", True)
+
+    # optional section - all settings fall back to their defaults without it
+    log_settings = config["logging"] if config.has_section("logging") else config[config.default_section]
+    log_console = log_settings.getboolean("console", True)
+    log_file = log_settings.get("file", "")
+    log_file_rotation = log_settings.get("file_rotation", "50 MB")
+    log_file_retention = log_settings.getint("file_retention", 5)
+    log_enqueue = log_settings.getboolean("enqueue", True)
+    log_device_sample_rate = log_settings.getfloat("device_sample_rate", 1.0)
+    log_checkout_stats = log_settings.getboolean("checkout_stats", False)
+
+    capture_settings = config["capture"] if config.has_section("capture") else config[config.default_section]
+    capture_file = capture_settings.get("file", "")
+    capture_buffer_size = capture_settings.getint("buffer_size", 1000)
+    capture_flush_seconds = capture_settings.getfloat("flush_seconds", 1)
+
+    profiling_settings = config["profiling"] if config.has_section("profiling") else config[config.default_section]
+    profiling = profiling_settings.getboolean("enabled", False)
+    profiling_trace_buffer_size = profiling_settings.getint("trace_buffer_size", 200)
+    profiling_slowest_requests = profiling_settings.getint("slowest_requests", 20)
+    profiling_max_seconds = profiling_settings.getint("max_profile_seconds", 60)
+
+    pools = pool_names(pool_name)
 
     def __init__(self):
-        if self.db_user is None or self.db_pw is None or self.db is None or self.auth_username is None \
-                or self.auth_password is None:
+        if (self.db_backend == "mysql" and (self.db_user is None or self.db_pw is None or self.db is None)) \
+                or self.auth_username is None or self.auth_password is None:
             logger.error("Missing required setting! Check your config.")
 
+    @classmethod
+    def for_pool(cls, name):
+        """
+        Config of a named pool - the settings of its [pool:<name>] section, all others from [general].
+        """
+        section = config[f"pool:{name}"]
+        cooldown_hours = section.getint("cooldown", cls.cooldown_hours)
+        strict_rate_limit_minutes = section.getint("strict_rate_limit_minutes", cls.strict_rate_limit_minutes)
+        overrides = {
+            "pool_name": name,
+            "accounts_file": section.get("accounts_file", f"accounts_{name}.txt"),
+            "cooldown_hours": cooldown_hours,
+            "cooldown_seconds": cooldown_hours * 60 * 60,
+            "rate_limit_minutes": section.getint("rate_limit_minutes", cls.rate_limit_minutes),
+            "rate_limit_number": section.getint("rate_limit_number", cls.rate_limit_number),
+            "strict_rate_limit_minutes": strict_rate_limit_minutes,
+            "strict_rate_limit_seconds": strict_rate_limit_minutes * 60,
+            "force_release_seconds": section.getint("force_release_days", cls.force_release_seconds // 86400) * 86400,
+            "lease_seconds": section.getint("lease_minutes", cls.lease_seconds // 60) * 60,
+            "pool_low_accounts": section.getint("pool_low_accounts", cls.pool_low_accounts),
+        }
+        return type(f"Config[{name}]", (cls,), overrides)
+
     @classmethod
     def get_cooldown_timestamp(cls):
-        res = int(int(time.time()) - cls.cooldown_seconds)
+        res = int(int(clock.now()) - cls.cooldown_seconds)
         logger.trace(f"calculated cooldown timestamp {res}")
         return res
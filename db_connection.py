@@ -1,125 +1,670 @@
-import mysql.connector
+import threading
+import time
+
+from loguru import logger
+
+import clock
+from backends import create_backend
 from config import Config
+from db_pool import ConnectionPool
+import profiler
+from statements import STATEMENTS, PreparedStatement
+from metrics import db_query_duration, query_kind
+
+
+class Cursor:
+    """
+    Cursor passing statements written in MySQL syntax through the backend's translation.
+    """
+
+    def __init__(self, cursor, backend):
+        self.cursor = cursor
+        self.backend = backend
+
+    def execute(self, sql, params=()):
+        start = time.perf_counter()
+        try:
+            return self.cursor.execute(self.backend.translate(sql), params)
+        finally:
+            self.observe(sql, start)
+
+    def executemany(self, sql, seq_of_params):
+        start = time.perf_counter()
+        try:
+            return self.cursor.executemany(self.backend.translate(sql), seq_of_params)
+        finally:
+            self.observe(sql, start)
+
+    @staticmethod
+    def observe(sql, start):
+        elapsed = time.perf_counter() - start
+        kind = query_kind(sql)
+        db_query_duration.observe(elapsed, kind)
+        profiler.span("db", kind, start, elapsed)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def close(self):
+        return self.cursor.close()
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def __iter__(self):
+        return iter(self.cursor)
 
 
 class DbConnection:
-    # autocommit to always wait for queries to finish?
-    # https://stackoverflow.com/a/54752005
-    __config = {
-        "host": Config.db_host,
-        "port": Config.db_port,
-        "user": Config.db_user,
-        "passwd": Config.db_pw,
-        "database": Config.db,
-        "autocommit": True
-    }
+    """
+    Database connection from the shared connection pool - its classmethods are the account store of the default
+    account pool, for_pool() returns the store of a named pool.
+    """
+
+    __backend = None
+    __pool = None
+    __pool_lock = threading.Lock()
+    __pool_stores: dict = {}
+
+    # the account pool the store's accounts belong to - devices are looked up within their account pool only
+    pool_name = Config.pool_name
+    # the settings of the account pool - cooldown and leases
+    config = Config
+
+    release_sql = ("UPDATE accounts SET in_use_by = NULL, last_returned = %s, lease_expires = NULL WHERE pool = %s AND "
+                   "in_use_by = %s")
+    assign_sql = "UPDATE accounts SET in_use_by = %s, last_use = %s, lease_expires = %s WHERE username = %s"
+    assign_keep_last_use_sql = "UPDATE accounts SET in_use_by = %s, lease_expires = %s WHERE username = %s"
+    current_account_sql = "SELECT username FROM accounts WHERE pool = %s AND in_use_by = %s LIMIT 1"
+    set_level_sql = "UPDATE accounts SET level = %s WHERE username = %s AND pool = %s"
+    # burn_count is assigned first - MySQL evaluates the assignments left to right
+    set_burned_sql = ("UPDATE accounts SET burn_count = burn_count + (ifnull(last_burned, 0) < %s), last_burned = %s "
+                      "WHERE username = %s AND pool = %s")
+    claim_sql = ("UPDATE accounts SET in_use_by = %s, last_use = %s, lease_expires = %s WHERE username = %s AND "
+                 "in_use_by IS NULL AND level >= %s AND cooldown_start < %s")
+    claim_keep_last_use_sql = ("UPDATE accounts SET in_use_by = %s, lease_expires = %s WHERE username = %s AND "
+                               "in_use_by IS NULL AND level >= %s AND cooldown_start < %s")
+    heartbeat_sql = "UPDATE accounts SET lease_expires = %s WHERE pool = %s AND in_use_by = %s"
+    # copied to and from the accounts_archive table
+    archive_columns = "username, password, last_use, last_returned, level, last_burned, burn_count, pool"
 
     def __init__(self):
-        self.conn = mysql.connector.connect(**self.__config)
-        self.cur = self.conn.cursor()
+        start = time.perf_counter()
+        self.pooled = self.pool().acquire()
+        profiler.span("db_pool", "acquire", start, time.perf_counter() - start)
+        self.conn = self.pooled.conn
+        self.cur = Cursor(self.conn.cursor(), self.backend())
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.cur.close()
+        # connections that broke while in use are not handed out again
+        discard = isinstance(exc_val, self.backend().connection_errors)
+        start = time.perf_counter()
         try:
-            self.conn.commit()
+            self.cur.close()
+            if exc_type is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
         except Exception as e:
-            print(f"commit on exit failed: {e}")
-        self.conn.close()
+            logger.warning(f"{'commit' if exc_type is None else 'rollback'} on exit failed: {e}")
+            discard = True
+        profiler.span("db", "commit" if exc_type is None else "rollback", start, time.perf_counter() - start)
+        self.pool().release(self.pooled, discard=discard)
+
+    def begin(self):
+        self.backend().begin(self.conn)
+
+    # the backend and the connection pool are shared by the stores of all account pools
+
+    @staticmethod
+    def backend():
+        if DbConnection.__backend is None:
+            with DbConnection.__pool_lock:
+                if DbConnection.__backend is None:
+                    DbConnection.__backend = create_backend()
+        return DbConnection.__backend
+
+    @staticmethod
+    def pool():
+        if DbConnection.__pool is None:
+            backend = DbConnection.backend()
+            with DbConnection.__pool_lock:
+                if DbConnection.__pool is None:
+                    DbConnection.__pool = ConnectionPool(backend, size=Config.db_pool_size,
+                                                         timeout=Config.db_pool_timeout,
+                                                         recycle=Config.db_pool_recycle_seconds,
+                                                         ping=backend.ping_seconds)
+        return DbConnection.__pool
+
+    @staticmethod
+    def for_pool(name):
+        """
+        The store of the named account pool - DbConnection with every account query limited to the pool's accounts.
+        """
+        if name == DbConnection.pool_name:
+            return DbConnection
+        with DbConnection.__pool_lock:
+            store = DbConnection.__pool_stores.get(name)
+            if store is None:
+                # pools without a [pool:<name>] section, e.g. of benchmarks, use the settings of [general]
+                config = Config.for_pool(name) if name in Config.pools else Config
+                store = DbConnection.__pool_stores[name] = type(f"DbConnection[{name}]", (DbConnection,),
+                                                                {"pool_name": name, "config": config})
+        return store
+
+    @staticmethod
+    def is_store(store):
+        return isinstance(store, type) and issubclass(store, DbConnection)
+
+    @classmethod
+    def pool_stats(cls):
+        return cls.pool().stats()
 
     def cursor(self, *args, **kwargs):
-        return self.conn.cursor(*args, **kwargs)
-
-    @classmethod
-    def get_single_results(cls, *sqls):
-        res: list = []
-        with cls() as conn:
-            for sql in sqls:
-                conn.cur.execute(sql)
-                # get the first element of the cursor (tuple) - or if it's none, get a list [None]
-                # then return the first element of that result (the actual query result, or None)
-                # https://stackoverflow.com/a/68186597
-                res.append(next(conn.cur, [None])[0])
-        return res
-
-    @classmethod
-    def execute(cls, sql):
-        with cls() as conn:
-            conn.cur.execute(sql)
-
-    @classmethod
-    def get(cls, sql):
-        return cls.get_elements_of_first_result(sql, num=1)
-
-    @classmethod
-    def get_elements_of_first_result(cls, sql, num=None):
-        if not "limit" in sql.lower():
-            sql = sql.rstrip(";")
-            sql += " LIMIT 1"
-        with cls() as conn:
-            conn.cur.execute(sql)
-            results: int = 0
-            for elem in conn.cur:
-                results += 1
-                if not num:
-                    if len(elem) == 0:
-                        return False
-                    elif len(elem) == 1:
-                        return elem[0]
-                    return [e for e in elem]
-                else:
-                    if num == 1:
-                        return elem[0] if elem[0] else False
-                    c: int = 0
-                    ret: list = []
-                    while c < num:
-                        try:
-                            ret.append(elem[c])
-                        except Exception as e:
-                            ret.append(False)
-                        c+=1
-                    return ret
-            if results == 0:
-                ret: list = []
-                if num and num > 1:
-                    c: int = 0
-                    while c < num:
-                        ret.append(False)
-                        c += 1
-                    return ret
-                else:
-                    return False
+        return Cursor(self.conn.cursor(*args, **kwargs), self.backend())
+
+    def run(self, name, params=()):
+        """
+        Execute the registered statement `name` with bound parameters - prepared on first use on this connection.
+        """
+        statement = self.pooled.statements.get(name)
+        if statement is None:
+            statement = self.pooled.statements[name] = PreparedStatement(self.backend(), self.conn, name)
+        return statement.execute(params)
+
+    # result shapes of registered statements
+
+    def scalar(self, name, params=(), default=None):
+        """
+        First column of the first row, or `default` without rows.
+        """
+        rows = self.run(name, params).fetchall()
+        return rows[0][0] if rows else default
 
+    def row(self, name, params=()):
+        """
+        First row, or None without rows.
+        """
+        rows = self.run(name, params).fetchall()
+        return rows[0] if rows else None
+
+    def rows(self, name, params=()):
+        return self.run(name, params).fetchall()
+
+    def affected(self, name, params=()):
+        """
+        Number of rows changed by a registered UPDATE, INSERT or DELETE.
+        """
+        return self.run(name, params).rowcount
+
+    @classmethod
+    def checkout(cls, device, mark_last_use=True, level=None, cooldown_ts=None, username=None, current=False):
+        """
+        Pick an account, release the device's previous account and assign the picked one in a single transaction.
+
+        The account is picked by `username`, as the device's `current` one, or as the eligible account of at least
+        `level` used the longest time ago. Candidate rows are locked with SKIP LOCKED (if enabled), so concurrent
+        checkouts skip each other's rows instead of blocking on them or handing out the same account twice.
+        Returns (username, password) or (None, None) if no account could be picked.
+        """
+        select, params = cls.checkout_select(device, level, cooldown_ts, username, current)
+        now = int(clock.now())
+        with cls() as conn:
+            conn.begin()
+            row = conn.row(select, params)
+            if not row or not row[0] or not row[1]:
+                conn.conn.rollback()
+                return None, None
+            picked, password = row
+            conn.run("release", (now, cls.pool_name, device))
+            if mark_last_use:
+                conn.run("assign", (device, now, cls.lease_expiry(now), picked))
+            else:
+                conn.run("assign_keep_last_use", (device, cls.lease_expiry(now), picked))
+        return picked, password
+
+    @classmethod
+    def checkout_select(cls, device, level=None, cooldown_ts=None, username=None, current=False):
+        """
+        Returns the name of the locking SELECT statement and its parameters used by checkout to pick an account.
+        """
+        if username is not None:
+            return "checkout_by_username", (username, cls.pool_name)
+        if current:
+            return "checkout_current", (cls.pool_name, device)
+        return "checkout_next", (cls.pool_name, int(level), int(cooldown_ts))
+
+    @classmethod
+    def claim(cls, device, username, level, cooldown_ts, mark_last_use=True):
+        """
+        Assign a pre-selected account to the device and release its previous one - only if the account is still free,
+        at least at `level` and cooled down. Returns whether the account was claimed.
+        """
+        now = int(clock.now())
+        with cls() as conn:
+            conn.begin()
+            conn.run("release", (now, cls.pool_name, device))
+            lease = cls.lease_expiry(now)
+            if mark_last_use:
+                claimed = conn.affected("claim", (device, now, lease, username, int(level), int(cooldown_ts)))
+            else:
+                claimed = conn.affected("claim_keep_last_use", (device, lease, username, int(level), int(cooldown_ts)))
+            if claimed != 1:
+                conn.conn.rollback()
+                return False
+        return True
+
+    @classmethod
+    def candidates(cls, level, cooldown_ts, limit):
+        """
+        Returns (username, password) of up to `limit` eligible accounts of at least `level`, used the longest time ago.
+        """
+        with cls() as conn:
+            return conn.rows("candidates", (cls.pool_name, int(level), int(cooldown_ts), int(limit)))
+
+    @staticmethod
+    def placeholders(count):
+        return ", ".join(["%s"] * count)
+
+    @classmethod
+    def checkout_many(cls, requests):
+        """
+        Set-based checkout for many devices in a single transaction. `requests` are (device, mark_last_use, pick)
+        tuples with `pick` being the keyword arguments of checkout. Returns {device: (username, password)} for every
+        device an account could be picked for.
+        """
+        now = int(clock.now())
+        picked: dict = {}
+        taken: set = set()
+        with cls() as conn:
+            conn.begin()
+            by_username = {pick["username"]: device for device, _, pick in requests if "username" in pick}
+            if by_username:
+                conn.cur.execute(f"SELECT username, password FROM accounts WHERE username IN "
+                                 f"({cls.placeholders(len(by_username))}) AND pool = %s FOR UPDATE",
+                                 (*by_username, cls.pool_name))
+                for username, password in conn.cur.fetchall():
+                    picked[by_username[username]] = (username, password)
+            current = [device for device, _, pick in requests if pick.get("current")]
+            if current:
+                conn.cur.execute(f"SELECT in_use_by, username, password FROM accounts WHERE pool = %s AND in_use_by IN "
+                                 f"({cls.placeholders(len(current))}) FOR UPDATE", (cls.pool_name, *current))
+                taken.update(username for username, _ in picked.values())
+                for device, username, password in conn.cur.fetchall():
+                    if username not in taken:
+                        picked[device] = (username, password)
+            taken.update(username for username, _ in picked.values())
+
+            # the default picks - one query per requested level, highest level first, so devices requiring a lower
+            # level don't take the only accounts suitable for higher levels
+            by_level: dict = {}
+            for device, _, pick in requests:
+                if "level" in pick:
+                    by_level.setdefault(int(pick["level"]), []).append((device, int(pick["cooldown_ts"])))
+            for level in sorted(by_level, reverse=True):
+                devices = by_level[level]
+                select = "SELECT username, password FROM accounts WHERE pool = %s AND in_use_by IS NULL AND " \
+                         "level >= %s AND cooldown_start < %s"
+                params = [cls.pool_name, level, min(cooldown_ts for _, cooldown_ts in devices)]
+                if taken:
+                    select += f" AND username NOT IN ({cls.placeholders(len(taken))})"
+                    params += list(taken)
+                select += " ORDER BY last_use ASC LIMIT %s FOR UPDATE"
+                if Config.db_skip_locked:
+                    select += " SKIP LOCKED"
+                conn.cur.execute(select, (*params, len(devices)))
+                for (device, _), (username, password) in zip(devices, conn.cur.fetchall()):
+                    picked[device] = (username, password)
+                    taken.add(username)
+
+            picked = {device: row for device, row in picked.items() if row[0] and row[1]}
+            if not picked:
+                conn.conn.rollback()
+                return {}
+            conn.cur.execute(f"UPDATE accounts SET in_use_by = NULL, last_returned = %s, lease_expires = NULL WHERE "
+                             f"pool = %s AND in_use_by IN ({cls.placeholders(len(picked))})",
+                             (now, cls.pool_name, *picked))
+            mark = {device for device, mark_last_use, _ in requests if mark_last_use and device in picked}
+            sql = "UPDATE accounts SET lease_expires = %s, in_use_by = CASE username" + " WHEN %s THEN %s" * len(picked)
+            sql += " END"
+            params = [cls.lease_expiry(now)]
+            params += [value for device, (username, _) in picked.items() for value in (username, device)]
+            if mark:
+                sql += ", last_use = CASE username" + " WHEN %s THEN %s" * len(mark) + " ELSE last_use END"
+                params += [value for device in mark for value in (picked[device][0], now)]
+            sql += f" WHERE username IN ({cls.placeholders(len(picked))})"
+            params += [username for username, _ in picked.values()]
+            conn.cur.execute(sql, tuple(params))
+        return picked
+
+    @classmethod
+    def current_accounts(cls, devices):
+        """
+        Returns {device: username} of the given devices in a single query.
+        """
+        if not devices:
+            return {}
+        with cls() as conn:
+            conn.cur.execute(f"SELECT in_use_by, username FROM accounts WHERE pool = %s AND in_use_by IN "
+                             f"({cls.placeholders(len(devices))})", (cls.pool_name, *devices))
+            return dict(conn.cur.fetchall())
+
+    @classmethod
+    def set_burned_many(cls, usernames, ts):
+        """
+        Mark all given accounts burned at `ts` in a single transaction - returns the set of existing accounts.
+        """
+        if not usernames:
+            return set()
+        with cls() as conn:
+            conn.begin()
+            conn.cur.execute(f"SELECT username FROM accounts WHERE username IN ({cls.placeholders(len(usernames))}) "
+                             f"AND pool = %s FOR UPDATE", (*usernames, cls.pool_name))
+            existing = {row[0] for row in conn.cur.fetchall()}
+            if existing:
+                conn.cur.execute(f"UPDATE accounts SET burn_count = burn_count + (ifnull(last_burned, 0) < %s), "
+                                 f"last_burned = %s WHERE username IN ({cls.placeholders(len(existing))})",
+                                 (int(ts), int(ts), *existing))
+        return existing
+
+    @classmethod
+    def set_level_many(cls, levels):
+        """
+        Set the levels of many accounts ({username: level}) in a single transaction - returns the set of existing
+        accounts.
+        """
+        if not levels:
+            return set()
+        with cls() as conn:
+            conn.begin()
+            conn.cur.execute(f"SELECT username FROM accounts WHERE username IN ({cls.placeholders(len(levels))}) "
+                             f"AND pool = %s FOR UPDATE", (*levels, cls.pool_name))
+            existing = {row[0] for row in conn.cur.fetchall()}
+            if existing:
+                sql = ("UPDATE accounts SET level = CASE username" + " WHEN %s THEN %s" * len(existing) +
+                       f" END WHERE username IN ({cls.placeholders(len(existing))})")
+                params = [value for username in existing for value in (username, int(levels[username]))]
+                conn.cur.execute(sql, (*params, *existing))
+        return existing
+
+    @classmethod
+    def current_account(cls, device):
+        with cls() as conn:
+            return conn.scalar("current_account", (cls.pool_name, device))
+
+    @classmethod
+    def device_last_uses(cls):
+        """
+        Returns the last_use of every device's current account as {device: last_use}.
+        """
+        with cls() as conn:
+            return dict(conn.rows("device_last_uses", (cls.pool_name,)))
+
+    @classmethod
+    def account_states(cls, usernames):
+        """
+        Returns {username: (last_burned, level)} of the given accounts in a single query.
+        """
+        if not usernames:
+            return {}
+        with cls() as conn:
+            rows = conn.rows(cls.account_states_statement(len(usernames)), tuple(usernames))
+            return {username: (last_burned, level) for username, last_burned, level in rows}
+
+    @staticmethod
+    def account_states_sql(count):
+        return f"SELECT username, last_burned, level FROM accounts WHERE username IN ({', '.join(['%s'] * count)})"
+
+    @classmethod
+    def account_states_statement(cls, count):
+        # one statement per number of usernames - at most rate_limit_number of them in practice
+        name = f"account_states_{count}"
+        if name not in STATEMENTS:
+            STATEMENTS.register(name, cls.account_states_sql(count))
+        return name
+
+    @classmethod
+    def set_level(cls, username, level):
+        with cls() as conn:
+            conn.run("set_level", (int(level), username, cls.pool_name))
+
+    @classmethod
+    def set_burned(cls, username, ts):
+        with cls() as conn:
+            conn.run("set_burned", (int(ts), int(ts), username, cls.pool_name))
+
+    @classmethod
+    def force_release(cls, before_ts):
+        """
+        Release all accounts assigned to a device since before `before_ts`.
+        Returns the released accounts as (username, in_use_by, last_use, last_returned, level, last_burned).
+        """
+        now = int(clock.now())
+        with cls() as conn:
+            conn.begin()
+            conn.cur.execute("SELECT username, in_use_by, last_use, last_returned, level, last_burned FROM accounts "
+                             "WHERE pool = %s AND in_use_by IS NOT NULL AND last_returned < %s ORDER BY last_returned "
+                             "DESC FOR UPDATE", (cls.pool_name, before_ts))
+            released = conn.cur.fetchall()
+            if released:
+                conn.cur.execute("UPDATE accounts SET in_use_by = NULL, last_returned = %s, lease_expires = NULL WHERE "
+                                 "pool = %s AND in_use_by IS NOT NULL AND last_returned < %s",
+                                 (now, cls.pool_name, before_ts))
+        return released
+
+    @classmethod
+    def lease_expiry(cls, now):
+        # assignments without a lease (NULL) never expire
+        return now + cls.config.lease_seconds if cls.config.lease_seconds > 0 else None
+
+    @classmethod
+    def heartbeat(cls, device):
+        """
+        Extend the lease of the device's account - returns the new expiry or None if the device has no account.
+        """
+        expires = cls.lease_expiry(int(clock.now()))
+        with cls() as conn:
+            found = conn.affected("heartbeat", (expires, cls.pool_name, device)) > 0
+        return expires if found else None
+
+    @classmethod
+    def release_expired(cls, now):
+        """
+        Release all accounts with a lease expired before `now` - an index range scan over the expired leases only.
+        Returns the released accounts like force_release.
+        """
+        with cls() as conn:
+            conn.begin()
+            conn.cur.execute("SELECT username, in_use_by, last_use, last_returned, level, last_burned FROM accounts "
+                             "WHERE pool = %s AND lease_expires < %s FOR UPDATE", (cls.pool_name, now))
+            released = conn.cur.fetchall()
+            if released:
+                conn.cur.execute("UPDATE accounts SET in_use_by = NULL, last_returned = %s, lease_expires = NULL WHERE "
+                                 "pool = %s AND lease_expires < %s", (now, cls.pool_name, now))
+        return released
+
+    @classmethod
+    def grant_missing_leases(cls, now):
+        """
+        Give every assignment without a lease one starting `now` - e.g. after leases got enabled.
+        """
+        with cls() as conn:
+            conn.cur.execute("UPDATE accounts SET lease_expires = %s WHERE pool = %s AND in_use_by IS NOT NULL AND "
+                             "lease_expires IS NULL", (cls.lease_expiry(now), cls.pool_name))
+            return conn.cur.rowcount
+
+    @classmethod
+    def stats_snapshot(cls, cooldown_ts):
+        """
+        Returns the device assignments {device: username}, the accounts in cooldown {username: cooldown_start}
+        and the total number of accounts.
+        """
+        with cls() as conn:
+            conn.cur.execute("SELECT in_use_by, username FROM accounts WHERE pool = %s AND in_use_by IS NOT NULL",
+                             (cls.pool_name,))
+            assigned = dict(conn.cur.fetchall())
+            conn.cur.execute("SELECT username, cooldown_start FROM accounts WHERE pool = %s AND cooldown_start >= %s",
+                             (cls.pool_name, int(cooldown_ts)))
+            cooling = dict(conn.cur.fetchall())
+            conn.cur.execute("SELECT count(*) FROM accounts WHERE pool = %s", (cls.pool_name,))
+            total = conn.cur.fetchone()[0]
+        return assigned, cooling, total
+
+    @classmethod
+    def archive_candidates(cls, burn_count, unused_before, limit):
+        """
+        Returns up to `limit` free accounts to archive as (username, reason): accounts burned at least `burn_count`
+        times ("burned") and accounts used before, but not since `unused_before` ("unused"). None disables a rule.
+        """
+        rules = []
+        params: list = [cls.pool_name]
+        if burn_count is not None:
+            rules.append("burn_count >= %s")
+            params.append(burn_count)
+        if unused_before is not None:
+            rules.append("(last_use > 0 AND last_use < %s)")
+            params.append(unused_before)
+        if not rules:
+            return []
+        with cls() as conn:
+            conn.cur.execute(f"SELECT username, burn_count FROM accounts WHERE pool = %s AND in_use_by IS NULL AND "
+                             f"({' OR '.join(rules)}) LIMIT %s", (*params, limit))
+            rows = conn.cur.fetchall()
+        return [(username, "burned" if burn_count is not None and count >= burn_count else "unused")
+                for username, count in rows]
+
+    @classmethod
+    def archive(cls, usernames, reason, now):
+        """
+        Move the given accounts to the accounts_archive table in a single transaction - accounts assigned to a device
+        are skipped. Returns the set of archived accounts.
+        """
+        if not usernames:
+            return set()
+        with cls() as conn:
+            conn.begin()
+            conn.cur.execute(f"SELECT username FROM accounts WHERE username IN ({cls.placeholders(len(usernames))}) "
+                             f"AND pool = %s AND in_use_by IS NULL FOR UPDATE", (*usernames, cls.pool_name))
+            free = tuple(row[0] for row in conn.cur.fetchall())
+            if free:
+                selected = cls.placeholders(len(free))
+                conn.cur.execute(f"DELETE FROM accounts_archive WHERE username IN ({selected})", free)
+                conn.cur.execute(f"INSERT INTO accounts_archive ({cls.archive_columns}, archived_at, reason) "
+                                 f"SELECT {cls.archive_columns}, %s, %s FROM accounts WHERE username IN ({selected})",
+                                 (now, reason, *free))
+                conn.cur.execute(f"DELETE FROM accounts WHERE username IN ({selected})", free)
+        return set(free)
+
+    @classmethod
+    def restore(cls, usernames, now):
+        """
+        Move archived accounts of the pool back to the accounts table in a single transaction, with their burn count
+        reset and last_use set to `now`, so the archive policy doesn't pick them again right away. Returns the set of
+        restored accounts.
+        """
+        if not usernames:
+            return set()
+        with cls() as conn:
+            conn.begin()
+            conn.cur.execute(f"SELECT username FROM accounts_archive WHERE username IN "
+                             f"({cls.placeholders(len(usernames))}) AND pool = %s FOR UPDATE",
+                             (*usernames, cls.pool_name))
+            archived = {row[0] for row in conn.cur.fetchall()}
+            conn.cur.execute(f"SELECT username FROM accounts WHERE username IN ({cls.placeholders(len(usernames))})",
+                             tuple(usernames))
+            # re-imported since they were archived - the live account wins
+            restored = tuple(archived - {row[0] for row in conn.cur.fetchall()})
+            if restored:
+                selected = cls.placeholders(len(restored))
+                conn.cur.execute(f"INSERT INTO accounts (username, password, last_use, last_returned, level, "
+                                 f"last_burned, burn_count, pool) SELECT username, password, %s, last_returned, level, "
+                                 f"last_burned, 0, pool FROM accounts_archive WHERE username IN ({selected})",
+                                 (now, *restored))
+            if archived:
+                conn.cur.execute(f"DELETE FROM accounts_archive WHERE username IN "
+                                 f"({cls.placeholders(len(archived))})", tuple(archived))
+        return set(restored)
+
+    @classmethod
+    def archived_accounts(cls, limit, offset=0, reason=None, pool=None):
+        """
+        Returns the total number of archived accounts of all pools (with `reason` and of `pool`, if given) and a page
+        of them, latest first.
+        """
+        filters = {column: value for column, value in (("reason", reason), ("pool", pool)) if value}
+        where = ("WHERE " + " AND ".join(f"{column} = %s" for column in filters)) if filters else ""
+        params = tuple(filters.values())
+        with cls() as conn:
+            conn.cur.execute(f"SELECT count(*) FROM accounts_archive {where}", params)
+            total = conn.cur.fetchone()[0]
+            conn.cur.execute(f"SELECT username, pool, level, burn_count, last_use, last_burned, archived_at, reason "
+                             f"FROM accounts_archive {where} ORDER BY archived_at DESC, username LIMIT %s OFFSET %s",
+                             (*params, limit, offset))
+            columns = ("username", "pool", "level", "burn_count", "last_use", "last_burned", "archived_at", "reason")
+            accounts = [dict(zip(columns, row)) for row in conn.cur.fetchall()]
+        return total, accounts
+
+    @classmethod
+    def archived_usernames(cls, conn, usernames):
+        conn.cur.execute(f"SELECT username FROM accounts_archive WHERE username IN "
+                         f"({cls.placeholders(len(usernames))})", tuple(usernames))
+        return {row[0] for row in conn.cur.fetchall()}
 
     @classmethod
     def is_account_cooled(cls, username):
-        sql = f"SELECT GREATEST(last_returned, last_burned) FROM accounts WHERE username = \"{username}\""
-        ts = cls.get(sql)
+        with cls() as conn:
+            ts = conn.scalar("cooldown_start", (username,))
         if not ts:
             return None
-        elif ts < Config.get_cooldown_timestamp():
+        elif ts < cls.config.get_cooldown_timestamp():
             return True
         return False
 
     @classmethod
     def is_account_burned(cls, username):
-        sql = f"SELECT last_burned FROM accounts WHERE username = \"{username}\""
-        ts = cls.get(sql)
+        with cls() as conn:
+            ts = conn.scalar("last_burned", (username,))
         if not ts:
             return None
-        elif ts < Config.get_cooldown_timestamp():
+        elif ts < cls.config.get_cooldown_timestamp():
             # NOT burned -> is_account_burned? False!
             return False
         return True
 
     @classmethod
     def is_account_at_level(cls, username, level):
-        sql = f"SELECT level FROM accounts WHERE username = \"{username}\""
-        acc_level = int(cls.get(sql))
+        with cls() as conn:
+            acc_level = int(conn.scalar("level", (username,), default=0) or 0)
         if not acc_level:
             return None
         elif acc_level < int(level):
             return False
         return True
+
+
+for name in ("release", "assign", "assign_keep_last_use", "current_account", "set_level", "set_burned", "claim",
+             "claim_keep_last_use", "heartbeat"):
+    STATEMENTS.register(name, getattr(DbConnection, f"{name}_sql"))
+# every statement that searches accounts or looks up devices is limited to one account pool - its index ranges
+# start with the pool, so a pool's checkouts never scan or lock the rows of another pool
+STATEMENTS.register("checkout_by_username",
+                    "SELECT username, password FROM accounts WHERE username = %s AND pool = %s FOR UPDATE")
+STATEMENTS.register("checkout_current",
+                    "SELECT username, password FROM accounts WHERE pool = %s AND in_use_by = %s LIMIT 1 FOR UPDATE")
+STATEMENTS.register("checkout_next", "SELECT username, password FROM accounts WHERE pool = %s AND in_use_by IS NULL "
+                                     "AND level >= %s AND cooldown_start < %s ORDER BY last_use ASC LIMIT 1 FOR UPDATE"
+                                     + (" SKIP LOCKED" if Config.db_skip_locked else ""))
+STATEMENTS.register("candidates", "SELECT username, password FROM accounts WHERE pool = %s AND in_use_by IS NULL AND "
+                                  "level >= %s AND cooldown_start < %s AND password IS NOT NULL ORDER BY last_use ASC "
+                                  "LIMIT %s")
+STATEMENTS.register("device_last_uses",
+                    "SELECT in_use_by, last_use FROM accounts WHERE pool = %s AND in_use_by IS NOT NULL")
+for column in ("cooldown_start", "last_burned", "level"):
+    STATEMENTS.register(column, f"SELECT {column} FROM accounts WHERE username = %s")
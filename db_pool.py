@@ -0,0 +1,140 @@
+import threading
+import time
+
+from collections import deque
+from loguru import logger
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection:
+    __slots__ = ("conn", "created", "last_used", "statements")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created = time.monotonic()
+        self.last_used = self.created
+        # statements prepared on this connection, by name
+        self.statements: dict = {}
+
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe pool of database connections, opened through the database backend.
+
+    Connections are handed out LIFO so a small set of hot connections serves most requests while the rest idle out.
+    On checkout, connections older than `recycle` seconds are replaced and connections idle for longer than `ping`
+    seconds are pinged before use - connections failing the ping are replaced by new ones, together with the statements
+    prepared on them.
+    """
+
+    def __init__(self, backend, size=10, timeout=10, recycle=3600, ping=30):
+        self.backend = backend
+        self.size = size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping = ping
+        self._idle: deque = deque()
+        self._created: int = 0
+        self._cond = threading.Condition()
+        self._metrics = {"checkouts": 0, "waits": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0, "timeouts": 0,
+                         "connects": 0, "recycled": 0, "discarded": 0}
+
+    def _count(self, metric):
+        # connects, recycles and discards happen outside of the lock of acquire() and release()
+        with self._cond:
+            self._metrics[metric] += 1
+
+    def _connect(self):
+        conn = self.backend.connect()
+        self._count("connects")
+        return PooledConnection(conn)
+
+    def _close(self, pooled):
+        try:
+            pooled.conn.close()
+        except Exception as e:
+            logger.debug(f"closing pooled connection failed: {e}")
+
+    def acquire(self):
+        start = time.monotonic()
+        waited = False
+        with self._cond:
+            while True:
+                if self._idle:
+                    pooled = self._idle.pop()
+                    break
+                if self._created < self.size:
+                    # reserve the slot now, connect outside of the lock
+                    self._created += 1
+                    pooled = None
+                    break
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    self._metrics["timeouts"] += 1
+                    raise PoolTimeout(f"no database connection available after {self.timeout}s "
+                                      f"(pool size {self.size})")
+                waited = True
+                self._cond.wait(remaining)
+            wait = time.monotonic() - start
+            self._metrics["checkouts"] += 1
+            if waited:
+                self._metrics["waits"] += 1
+                self._metrics["wait_seconds"] += wait
+                self._metrics["max_wait_seconds"] = max(self._metrics["max_wait_seconds"], wait)
+
+        try:
+            if pooled is None:
+                return self._connect()
+            return self._check(pooled)
+        except Exception:
+            self._forget()
+            raise
+
+    def _check(self, pooled):
+        now = time.monotonic()
+        if self.recycle and now - pooled.created > self.recycle:
+            logger.trace("recycling pooled connection")
+            self._count("recycled")
+            self._close(pooled)
+            return self._connect()
+        if self.ping is not None and now - pooled.last_used > self.ping:
+            try:
+                self.backend.ping(pooled.conn)
+            except Exception as e:
+                logger.debug(f"pooled connection failed health check ({e}) - reconnecting")
+                self._count("discarded")
+                self._close(pooled)
+                return self._connect()
+        return pooled
+
+    def release(self, pooled, discard=False):
+        if discard:
+            self._count("discarded")
+            self._close(pooled)
+            self._forget()
+            return
+        pooled.last_used = time.monotonic()
+        with self._cond:
+            self._idle.append(pooled)
+            self._cond.notify()
+
+    def _forget(self):
+        with self._cond:
+            self._created -= 1
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            while self._idle:
+                self._close(self._idle.pop())
+                self._created -= 1
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._metrics)
+            stats.update({"size": self.size, "open": self._created, "idle": len(self._idle),
+                          "in_use": self._created - len(self._idle)})
+        return stats
@@ -0,0 +1,140 @@
+import asyncio
+import itertools
+import json
+import threading
+
+from collections import deque
+from loguru import logger
+
+import clock
+
+
+class Subscription:
+    """
+    Bounded buffer of the events published since the subscriber last read - if it doesn't keep up, the oldest events
+    are dropped and the next read starts with an "overflow" event carrying the number of dropped events.
+
+    Thread-based consumers block in get(), asyncio consumers pass their loop and await wait().
+    """
+
+    def __init__(self, broadcaster, maxsize, types=None, loop=None, pools=None):
+        self.broadcaster = broadcaster
+        self.maxsize = maxsize
+        self.types = types
+        self.pools = pools
+        self.dropped = 0
+        self._events: deque = deque()
+        self._cond = threading.Condition()
+        self._loop = loop
+        self._ready = asyncio.Event() if loop is not None else None
+
+    def put(self, event):
+        if self.types and event["type"] not in self.types:
+            return
+        if self.pools and event.get("pool") not in self.pools:
+            return
+        with self._cond:
+            if len(self._events) >= self.maxsize:
+                self._events.popleft()
+                self.dropped += 1
+            self._events.append(event)
+            self._cond.notify()
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._ready.set)
+
+    def _drain(self):
+        events = list(self._events)
+        self._events.clear()
+        if self.dropped:
+            events.insert(0, {"type": "overflow", "ts": int(clock.now()), "dropped": self.dropped})
+            self.dropped = 0
+        return events
+
+    def get(self, timeout):
+        """
+        Returns all buffered events - waits up to `timeout` seconds for one, returns an empty list if none arrived.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._events, timeout)
+            return self._drain()
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._ready.clear()
+        with self._cond:
+            return self._drain()
+
+    def close(self):
+        self.broadcaster.unsubscribe(self)
+
+
+class EventBroadcaster:
+    """
+    Fans out pool and assignment events to all subscribers of the event stream. Publishing never blocks on a
+    subscriber - every subscriber has its own bounded buffer.
+    """
+
+    def __init__(self, buffer_size=100):
+        self.buffer_size = buffer_size
+        self._subscribers: set = set()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def subscribe(self, types=None, loop=None, pools=None):
+        subscription = Subscription(self, self.buffer_size, types=types, loop=loop, pools=pools)
+        with self._lock:
+            self._subscribers.add(subscription)
+        logger.debug(f"event stream subscribed, {len(self._subscribers)} subscribers")
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+        logger.debug(f"event stream unsubscribed, {len(self._subscribers)} subscribers")
+
+    @property
+    def subscribers(self):
+        return len(self._subscribers)
+
+    def publish(self, event_type, **data):
+        if not self._subscribers:
+            return
+        event = {"id": next(self._ids), "type": event_type, "ts": int(clock.now()), **data}
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            subscription.put(event)
+
+
+class PoolEvents:
+    """
+    Publishes the events of an account pool to the shared broadcaster - every event carries the pool's name.
+    Everything else is delegated to the broadcaster.
+    """
+
+    def __init__(self, broadcaster, pool):
+        self.broadcaster = broadcaster
+        self.pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self.broadcaster, name)
+
+    def publish(self, event_type, **data):
+        self.broadcaster.publish(event_type, pool=self.pool, **data)
+
+
+def server_sent_event(event):
+    """
+    Formats an event as a server-sent event - the event type as the SSE event name, the whole event as data.
+    """
+    lines = [f"event: {event['type']}", f"data: {json.dumps(event, separators=(',', ':'))}"]
+    if "id" in event:
+        lines.insert(0, f"id: {event['id']}")
+    return "\n".join(lines) + "\n\n"
+
+
+# sent when no event arrived for keepalive seconds - keeps proxies from closing idle streams
+KEEPALIVE = ": keepalive\n\n"
@@ -1,8 +1,32 @@
+import functools
 import sys
+import zlib
+
 from loguru import logger
 from config import Config
 
 
+@functools.lru_cache(maxsize=4096)
+def device_sampled(device, rate):
+    # stable per device, so a sampled device's log is complete
+    return zlib.crc32(device.encode()) % 10000 < rate * 10000
+
+
+def sample_filter(rate):
+    """
+    Log filter passing info and lower messages only for the sampled fraction `rate` of devices - messages not bound to
+    a device, warnings and errors always pass.
+    """
+    if rate >= 1:
+        return None
+    warning = logger.level("WARNING").no
+
+    def sampled(record):
+        device = record["extra"].get("name")
+        return not device or record["level"].no >= warning or device_sampled(device, rate)
+    return sampled
+
+
 def setup_logger():
     log_fmt_time = "[<cyan>{time:MM-DD HH:mm:ss.SS}</cyan>]"
     log_fmt_id = "[<cyan>{extra[name]: >12}</cyan>]"
@@ -14,10 +38,16 @@ def setup_logger():
     log_format_console = ' '.join(log_format_c)
 
     logger.remove()
-    logger.add(sys.stdout, format=log_format_console, level=Config.loglevel, colorize=True)
+    sample = sample_filter(Config.log_device_sample_rate)
+    # enqueued sinks are written by a background thread - requests don't wait for the terminal or the disk
+    if Config.log_console:
+        logger.add(sys.stdout, format=log_format_console, level=Config.loglevel, colorize=True, filter=sample,
+                   enqueue=Config.log_enqueue)
+    if Config.log_file:
+        logger.add(Config.log_file, level=Config.loglevel, serialize=True, filter=sample, enqueue=Config.log_enqueue,
+                   rotation=Config.log_file_rotation, retention=Config.log_file_retention)
 
     logconfig = {
             "extra": {"name": ""},
     }
     logger.configure(**logconfig)
-
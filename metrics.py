@@ -0,0 +1,151 @@
+import bisect
+import functools
+import re
+import threading
+
+
+# latency buckets in seconds - from sub-millisecond in-memory lookups up to slow database transactions
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values: dict = {}
+        self._lock = threading.Lock()
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def values(self):
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        return self.header() + [f"{self.name}{format_labels(self.labels, labels)} {format_value(value)}"
+                                for labels, value in sorted(values)]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                # per-bucket (not cumulative) counts, the sum and the count
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        with self._lock:
+            values = [(labels, (list(counts), total, count)) for labels, (counts, total, count) in self._values.items()]
+        lines = self.header()
+        for labels, (counts, total, count) in sorted(values):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, float("inf")), counts):
+                cumulative += bucket_count
+                le = (("le", format_value(float(bound))),)
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {total!r}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {count}")
+        return lines
+
+
+class Registry:
+    """
+    Collects metrics and renders them in the Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self.metrics: dict = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+@functools.lru_cache(maxsize=512)
+def query_kind(sql):
+    """
+    Short, low-cardinality name of a statement, e.g. select_accounts or update_request_log.
+    """
+    verb = sql.lstrip().split(None, 1)[0].lower() if sql.strip() else "unknown"
+    table = re.search(r"\b(?:FROM|INTO|UPDATE)\s+(\w+)", sql, flags=re.IGNORECASE)
+    return f"{verb}_{table.group(1).lower()}" if table else verb
+
+
+REGISTRY = Registry()
+
+http_requests = REGISTRY.register(Counter(
+    "account_server_http_requests_total", "HTTP requests by route, method and status code.",
+    ("route", "method", "status")))
+http_request_duration = REGISTRY.register(Histogram(
+    "account_server_http_request_duration_seconds", "HTTP request latency by route.", ("route",)))
+db_query_duration = REGISTRY.register(Histogram(
+    "account_server_db_query_duration_seconds", "Database statement latency by kind of statement.", ("kind",)))
+rate_limit_checks = REGISTRY.register(Counter(
+    "account_server_rate_limit_checks_total", "Rate limit checks by outcome and account pool.", ("outcome", "pool")))
+pool_accounts = REGISTRY.register(Gauge(
+    "account_server_pool", "Account pool statistics as reported by /stats, per account pool.", ("pool", "stat")))
+db_pool = REGISTRY.register(Gauge(
+    "account_server_db_connection_pool", "Database connection pool statistics.", ("stat",)))
+reservations = REGISTRY.register(Gauge(
+    "account_server_reservations", "Reservation queue checkouts (hits, stale, misses) and reserved accounts.",
+    ("stat",)))
+request_log_size = REGISTRY.register(Gauge(
+    "account_server_request_log_size", "Devices and entries in the request log.", ("unit",)))
+cache_requests = REGISTRY.register(Counter(
+    "account_server_cache_requests_total", "Read cache lookups by cache and result (hit or miss).",
+    ("cache", "result")))
+cache_entries = REGISTRY.register(Gauge(
+    "account_server_cache_entries", "Entries in the read caches.", ("cache",)))
@@ -0,0 +1,103 @@
+import os
+import re
+import time
+
+from loguru import logger
+
+from db_connection import DbConnection as Db
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# MySQL migrations that used to be applied by hand - on databases without a schema_version table, each one counts as
+# applied if the column it adds already exists
+LEGACY_COLUMNS = {1: "last_returned", 2: "level", 3: "last_burned"}
+
+# seconds to wait for another process migrating the same database, e.g. another worker starting at the same time
+LOCK_TIMEOUT = 600
+
+
+def sql_dir():
+    # every backend has its own schema and migrations
+    return os.path.join(BASE_DIR, Db.backend().sql_dir)
+
+
+def available_migrations():
+    migrations = []
+    for file in sorted(os.listdir(sql_dir())):
+        match = re.match(r"^(\d+)_.*\.sql$", file)
+        if match:
+            migrations.append((int(match.group(1)), file))
+    return migrations
+
+
+def read_statements(file):
+    with open(os.path.join(sql_dir(), file), "r") as f:
+        lines = [line for line in f if not line.strip().startswith("--")]
+    return [statement.strip() for statement in "".join(lines).split(";") if statement.strip()]
+
+
+def table_exists(conn, table):
+    conn.cur.execute(Db.backend().table_exists_sql(), (table,))
+    return conn.cur.fetchone()[0] > 0
+
+
+def column_exists(conn, table, column):
+    conn.cur.execute("SELECT count(*) FROM information_schema.columns WHERE table_schema = DATABASE() AND "
+                     "table_name = %s AND column_name = %s", (table, column))
+    return conn.cur.fetchone()[0] > 0
+
+
+def mark_applied(conn, version, name):
+    conn.cur.execute("INSERT INTO schema_version (version, name, applied_at) VALUES (%s, %s, %s)",
+                     (version, name, int(time.time())))
+
+
+def baseline(conn):
+    # create the schema_version table - and the accounts table on an empty database
+    conn.cur.execute("CREATE TABLE schema_version (version int not null, name varchar(255) not null, "
+                     "applied_at bigint not null, primary key (version))")
+    if Db.backend().name != "mysql":
+        return
+    if not table_exists(conn, "accounts"):
+        logger.info("accounts table not found - creating it")
+        for statement in read_statements("accounts.sql"):
+            conn.cur.execute(statement)
+    for version, file in available_migrations():
+        if version in LEGACY_COLUMNS and column_exists(conn, "accounts", LEGACY_COLUMNS[version]):
+            logger.debug(f"baseline: {file} already applied")
+            mark_applied(conn, version, file)
+
+
+def migrate():
+    """
+    Bring the database schema up to date by applying every sql/NNN_*.sql file that's not recorded in the
+    schema_version table, in numerical order.
+
+    Processes migrating the same database at the same time take turns: the applied migrations are read only with the
+    backend's migration lock held, so a process waiting for the lock finds the migrations applied by the other one.
+    """
+    backend = Db.backend()
+    with Db() as conn:
+        backend.lock_migrations(conn.conn, LOCK_TIMEOUT)
+        try:
+            if not table_exists(conn, "schema_version"):
+                baseline(conn)
+            conn.cur.execute("SELECT version FROM schema_version")
+            applied = {row[0] for row in conn.cur}
+
+            pending = [(version, file) for version, file in available_migrations() if version not in applied]
+            if not pending:
+                logger.debug("database schema is up to date")
+                return 0
+            for version, file in pending:
+                logger.info(f"applying database migration {file}")
+                for statement in read_statements(file):
+                    conn.cur.execute(statement)
+                mark_applied(conn, version, file)
+                if backend.name == "mysql":
+                    # MySQL applied the schema changes right away - record them right away as well
+                    conn.conn.commit()
+        finally:
+            backend.unlock_migrations(conn.conn)
+    return len(pending)
@@ -0,0 +1,78 @@
+import heapq
+import threading
+
+
+class PoolStats:
+    """
+    Account pool counters kept up to date from the changes the server makes, so stats don't need to query the
+    database. Accounts leaving the cooldown are tracked in a heap ordered by cooldown start. reconcile() replaces the
+    counters with a fresh snapshot from the account store to correct any drift, e.g. from changes made by other
+    processes.
+    """
+
+    def __init__(self):
+        self.total: int = 0
+        self.assigned: dict = {}
+        self._devices: dict = {}
+        self.cooling: dict = {}
+        self._cooling_heap: list = []
+        self._lock = threading.Lock()
+
+    def reconcile(self, assigned, cooling, total):
+        with self._lock:
+            self.assigned = dict(assigned)
+            self._devices = {username: device for device, username in self.assigned.items()}
+            self.cooling = dict(cooling)
+            self._cooling_heap = [(start, username) for username, start in self.cooling.items()]
+            heapq.heapify(self._cooling_heap)
+            self.total = total
+
+    def _cool(self, username, start):
+        if start > self.cooling.get(username, -1):
+            self.cooling[username] = start
+            heapq.heappush(self._cooling_heap, (start, username))
+
+    def _expire(self, cooldown_ts):
+        while self._cooling_heap and self._cooling_heap[0][0] < cooldown_ts:
+            start, username = heapq.heappop(self._cooling_heap)
+            if self.cooling.get(username) == start:
+                del self.cooling[username]
+
+    def on_checkout(self, device, username, now):
+        """
+        Returns the device's previous account and the device the account was taken from, if any.
+        """
+        with self._lock:
+            previous = self.assigned.pop(device, None)
+            if previous is not None:
+                self._devices.pop(previous, None)
+                self._cool(previous, now)
+            other = self._devices.pop(username, None)
+            if other is not None:
+                self.assigned.pop(other, None)
+            self.assigned[device] = username
+            self._devices[username] = device
+            return previous, other
+
+    def on_burned(self, username, ts):
+        with self._lock:
+            self._cool(username, int(ts))
+
+    def on_released(self, device, username, now):
+        with self._lock:
+            if self.assigned.get(device) == username:
+                del self.assigned[device]
+                self._devices.pop(username, None)
+            self._cool(username, now)
+
+    def on_added(self, count):
+        with self._lock:
+            self.total += count
+
+    def counts(self, cooldown_ts):
+        """
+        Returns the number of accounts in cooldown, in use and in total.
+        """
+        with self._lock:
+            self._expire(cooldown_ts)
+            return len(self.cooling), len(self.assigned), self.total
@@ -0,0 +1,222 @@
+import contextlib
+import contextvars
+import heapq
+import itertools
+import os
+import sys
+import threading
+import time
+
+from collections import Counter, deque
+
+# the trace of the request being served by the current thread or asyncio task - None while tracing is disabled
+_current = contextvars.ContextVar("request_trace", default=None)
+
+# returned by phase() without a trace, so untraced requests don't allocate anything
+NO_PHASE = contextlib.nullcontext()
+
+
+class RequestTrace:
+    """
+    Timeline of a single request: the phases of its handler and every database statement, with their offsets from the
+    start of the request.
+    """
+
+    __slots__ = ("id", "ts", "method", "path", "route", "status", "start", "duration", "spans")
+
+    def __init__(self, trace_id, method, path):
+        self.id = trace_id
+        self.ts = time.time()
+        self.method = method
+        self.path = path
+        self.route = None
+        self.status = None
+        self.start = time.perf_counter()
+        self.duration = None
+        # (category, name, start offset in seconds, duration in seconds)
+        self.spans: list = []
+
+    def add(self, category, name, start, seconds):
+        self.spans.append((category, name, start - self.start, seconds))
+
+    def totals(self):
+        """
+        Time per phase and per category of the other spans (db, db_pool), with their counts.
+        """
+        totals: dict = {}
+        for category, name, _, seconds in self.spans:
+            key = name if category == "phase" else category
+            count, total = totals.get(key, (0, 0.0))
+            totals[key] = (count + 1, total + seconds)
+        return totals
+
+    def server_timing(self):
+        """
+        Server-Timing header value - shown next to the request in the browser's developer tools.
+        """
+        entries = [f'{key};dur={total * 1000:.3f};desc="{count}x"' for key, (count, total) in self.totals().items()]
+        entries.append(f"total;dur={(self.duration or 0) * 1000:.3f}")
+        return ", ".join(entries)
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "ts": round(self.ts, 3),
+            "method": self.method,
+            "path": self.path,
+            "route": self.route,
+            "status": self.status,
+            "duration_ms": round((self.duration or 0) * 1000, 3),
+            "totals": {key: {"count": count, "ms": round(total * 1000, 3)}
+                       for key, (count, total) in self.totals().items()},
+            "spans": [{"category": category, "name": name, "start_ms": round(offset * 1000, 3),
+                       "ms": round(seconds * 1000, 3)} for category, name, offset, seconds in self.spans],
+        }
+
+
+class Phase:
+    __slots__ = ("trace", "name", "start")
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.trace.add("phase", self.name, self.start, time.perf_counter() - self.start)
+
+
+def phase(name):
+    """
+    Context manager timing a phase of the current request's handler, e.g. `with profiler.phase("rate_limit"):`.
+    """
+    trace = _current.get()
+    return NO_PHASE if trace is None else Phase(trace, name)
+
+
+def span(category, name, start, seconds):
+    """
+    Add a span that started at perf_counter() `start` to the current request's trace, if it's traced.
+    """
+    trace = _current.get()
+    if trace is not None:
+        trace.add(category, name, start, seconds)
+
+
+class RequestTracer:
+    """
+    Traces every request while profiling is enabled: keeps the last `buffer_size` traces and the `slowest_size`
+    slowest ones since the start (or the last clear()).
+    """
+
+    def __init__(self, buffer_size=200, slowest_size=20):
+        self.slowest_size = slowest_size
+        self._recent: deque = deque(maxlen=buffer_size)
+        # min-heap of (duration, id, trace) - the fastest of the slowest requests is replaced first
+        self._slowest: list = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def start(self, method, path):
+        trace = RequestTrace(next(self._ids), method, path)
+        _current.set(trace)
+        return trace
+
+    def finish(self, trace, route, status, keep=True):
+        trace.duration = time.perf_counter() - trace.start
+        trace.route = route
+        trace.status = status
+        _current.set(None)
+        if not keep:
+            return trace
+        with self._lock:
+            self._recent.append(trace)
+            if len(self._slowest) < self.slowest_size:
+                heapq.heappush(self._slowest, (trace.duration, trace.id, trace))
+            elif self._slowest and trace.duration > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, (trace.duration, trace.id, trace))
+        return trace
+
+    def recent(self, limit=50, route=None, min_ms=0):
+        """
+        The latest traces, newest first - optionally of one route and at least `min_ms` long only.
+        """
+        with self._lock:
+            traces = list(self._recent)
+        traces = [trace for trace in reversed(traces) if (route is None or trace.route == route)
+                  and trace.duration * 1000 >= min_ms]
+        return [trace.as_dict() for trace in traces[:limit]]
+
+    def slowest(self):
+        with self._lock:
+            traces = sorted(self._slowest, reverse=True)
+        return [trace.as_dict() for _, _, trace in traces]
+
+    def clear(self):
+        with self._lock:
+            self._recent.clear()
+            self._slowest.clear()
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all threads every `interval` seconds for a time window and aggregates them by stack, in the
+    folded format of flamegraph.pl and speedscope: "thread;outer:function;...;inner:function samples".
+
+    Nothing runs between profiles. Only one profile runs at a time.
+    """
+
+    def __init__(self):
+        self._running = threading.Lock()
+
+    def profile(self, seconds, interval=0.01):
+        if not self._running.acquire(blocking=False):
+            raise RuntimeError("a profile is already running")
+        try:
+            own = threading.get_ident()
+            stacks: Counter = Counter()
+            samples = 0
+            end = time.monotonic() + seconds
+            while time.monotonic() < end:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(frame_name(frame))
+                        frame = frame.f_back
+                    stack.append(names.get(thread_id, str(thread_id)))
+                    stacks[";".join(reversed(stack))] += 1
+                samples += 1
+                time.sleep(interval)
+        finally:
+            self._running.release()
+        return samples, stacks
+
+
+def folded(stacks):
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def top_functions(stacks, limit=30):
+    """
+    Functions by the samples they were on top of the stack (self) and anywhere on it (total).
+    """
+    own: Counter = Counter()
+    total: Counter = Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(";")[1:]
+        if frames:
+            own[frames[-1]] += count
+        for name in set(frames):
+            total[name] += count
+    return [{"function": name, "self": count, "total": total[name]} for name, count in own.most_common(limit)]
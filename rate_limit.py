@@ -0,0 +1,103 @@
+import humanize
+
+from enum import IntEnum
+from loguru import logger
+from operator import itemgetter
+
+import clock
+from config import Config
+
+
+class RateLimit(IntEnum):
+    unlimited = 0
+    burst = 1
+    period = 2
+    unknown = 3
+
+
+class RateLimiter:
+    """
+    Decides whether a device is rate-limited, based on in-memory sliding windows per device:
+
+    * burst: the time the device last got an account with updated timestamps, compared against
+      strict_rate_limit_minutes
+    * period: the device's RequestLog entries within rate_limit_minutes, compared against rate_limit_number
+
+    The only database access required is one batched lookup of the burned/level states passed to
+    usable_previous_account.
+    """
+
+    def __init__(self, request_log, config=None):
+        self.config = config or Config()
+        self.request_log = request_log
+        self.last_grant: dict = {}
+
+    def seed(self, store):
+        # start from the last use of the devices' current accounts and their latest logged requests
+        for device, last_use in store.device_last_uses().items():
+            self.last_grant[device] = max(self.last_grant.get(device, 0), last_use or 0)
+        for device, requests in self.request_log.items():
+            if requests:
+                latest = max(request["ts"] for request in requests)
+                self.last_grant[device] = max(self.last_grant.get(device, 0), latest)
+        logger.debug(f"rate limiter seeded with {len(self.last_grant)} devices")
+
+    def record_grant(self, device, ts=None):
+        self.last_grant[device] = int(clock.now()) if ts is None else ts
+
+    def latest_grant(self, device):
+        return self.last_grant.get(device, 0)
+
+    def check(self, device=None):
+        device_logger = logger.bind(name=device)
+        if not device:
+            return RateLimit.unknown
+        now = int(clock.now())
+
+        # check RateLimit.burst - strict_rate_limit (quick repeated requests)
+        latest = self.latest_grant(device)
+        device_logger.opt(lazy=True).info(
+            "Latest allowed request was {} ago",
+            lambda: humanize.precisedelta(now - latest) if latest > 0 else "an eternity")
+        if now - latest < self.config.strict_rate_limit_seconds:
+            device_logger.warning("Rate-limited! Device requested an account less than "
+                                  f"{self.config.strict_rate_limit_minutes} minutes ago!")
+            return RateLimit.burst
+
+        # check RateLimit.period - requesting too many accounts across the configured interval
+        window_start = now - self.config.rate_limit_minutes * 60
+        requests = self.request_log.get(device, ())
+        limiting_requests = sum(1 for request in requests if request["ts"] > window_start)
+        device_logger.opt(lazy=True).debug(
+            "Previous requests: {}",
+            lambda: ", ".join(f"{request} ({humanize.precisedelta(now - request['ts'])} ago)"
+                              for request in sorted(requests, key=itemgetter("ts"))))
+
+        if limiting_requests >= self.config.rate_limit_number:
+            device_logger.warning(f"Rate-limited! {limiting_requests=} >= {self.config.rate_limit_number}")
+            return RateLimit.period
+        device_logger.trace("NOT rate-limited! limiting_requests={} < {}", limiting_requests,
+                            self.config.rate_limit_number)
+        return RateLimit.unlimited
+
+    def logged_usernames(self, device):
+        return list(self.request_log.get_logged_usernames(device))
+
+    def usable_previous_account(self, device, level, states):
+        """
+        Returns the first account from the device's RequestLog that is not burned and at least at `level`, or None if
+        all of them are unusable. `states` are the accounts' {username: (last_burned, level)} as returned by
+        store.account_states. Raises IndexError if the device has no logged requests.
+        """
+        device_logger = logger.bind(name=device)
+        usernames = self.logged_usernames(device)
+        if not usernames:
+            raise IndexError("No accounts in request log")
+        cooldown_ts = self.config.get_cooldown_timestamp()
+        for username in usernames:
+            last_burned, acc_level = states.get(username, (None, None))
+            burned = bool(last_burned) and last_burned >= cooldown_ts
+            if not burned and acc_level and acc_level >= int(level):
+                return username
+            device_logger.debug("account {} unusable .. try next", username)
+        return None
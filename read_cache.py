@@ -0,0 +1,122 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+import metrics
+
+# returned by get() for keys that aren't cached - None is a valid cached value
+MISSING = object()
+
+
+class LRUCache:
+    """
+    Bounded per-process cache for read-only routes: entries expire `ttl` seconds after they were set and the least
+    recently used entry is evicted once `maxsize` entries are cached. Hits and misses are counted per cache `name`.
+
+    The server invalidates entries whenever it changes the underlying state - the TTL only bounds how long changes
+    made by other processes (shared_state) stay unnoticed. A `ttl` or `maxsize` of 0 disables the cache.
+    """
+
+    def __init__(self, name, maxsize, ttl):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        # bumped by every invalidation - values read from the store before one must not be cached
+        self._generation = 0
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0 and self.ttl > 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] >= time.monotonic():
+                self._data.move_to_end(key)
+                value = entry[1]
+            else:
+                if entry is not None:
+                    self._remove(key)
+                value = MISSING
+        metrics.cache_requests.inc(self.name, "miss" if value is MISSING else "hit")
+        return value
+
+    def token(self):
+        """
+        Take before reading a value from the store, and pass to set() - the value is only cached if nothing was
+        invalidated in between.
+        """
+        return self._generation
+
+    def load(self, key, read):
+        value = self.get(key)
+        if value is MISSING:
+            token = self.token()
+            value = read()
+            self.set(key, value, token)
+        return value
+
+    def set(self, key, value, token=None):
+        if not self.enabled:
+            return
+        with self._lock:
+            if token is not None and token != self._generation:
+                return
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._stored(key, value)
+            while len(self._data) > self.maxsize:
+                self._remove(next(iter(self._data)))
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                if key in self._data:
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            for key in list(self._data):
+                self._remove(key)
+
+    def _stored(self, key, value):
+        pass
+
+    def _remove(self, key):
+        del self._data[key]
+
+    def __len__(self):
+        return len(self._data)
+
+
+class CurrentAccountCache(LRUCache):
+    """
+    Device -> username of its current account (None if it has none), also indexed by username: a checkout invalidates
+    the device's entry and the entry of the device the account was taken from.
+    """
+
+    def __init__(self, maxsize, ttl):
+        super().__init__("current_account", maxsize, ttl)
+        self._devices: dict = {}
+
+    def _stored(self, key, value):
+        if value is not None:
+            self._devices[value] = key
+
+    def _remove(self, key):
+        _, username = self._data.pop(key)
+        if username is not None and self._devices.get(username) == key:
+            del self._devices[username]
+
+    def checked_out(self, device, username):
+        with self._lock:
+            self._generation += 1
+            for key in (device, self._devices.get(username)):
+                if key in self._data:
+                    self._remove(key)
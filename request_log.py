@@ -1,7 +1,11 @@
+import atexit
+import json
 import logging
 import pickle
 import os
 import sys
+import threading
+import time
 
 from collections import deque, UserDict
 from loguru import logger
@@ -14,57 +18,204 @@ from config import Config
 
 
 class RequestLog(UserDict):
-    def __init__(self, *args, filename=".request_log.pickle"):
+    """
+    Per-device log of the latest requests, persisted as a snapshot plus an append-only journal.
+
+    Every change appends one small JSON record to the journal, which is fsync'd every `fsync_every` records or
+    `fsync_seconds`, whatever comes first. Appends only check the time when they happen, so the owner calls sync()
+    every `fsync_seconds` as well - the last records before the log goes idle get synced too. After `compact_every`
+    records, the whole log is written to a new snapshot that atomically replaces the previous one and the journal
+    starts over. On startup, the snapshot gets loaded and
+    the journal replayed on top of it.
+
+    A compaction renames the journal aside before it replaces the snapshot and deletes it once the new journal is
+    started - a compaction that crashed in between is finished on startup, instead of replaying the old journal onto
+    the new snapshot.
+    """
+
+    def __init__(self, *args, filename=".request_log.pickle", journal=".request_log.journal", fsync_every=100,
+                 fsync_seconds=1.0, compact_every=10000, config=None):
         super().__init__(*args)
-        self.config = Config()
-        self.filename = filename
-        self.__load_pickle_data()
+        self.config = config or Config()
+        directory = os.path.dirname(os.path.abspath(__file__))
+        self.filename = os.path.join(directory, filename)
+        self.journal_filename = os.path.join(directory, journal)
+        self.compacted_filename = f"{self.journal_filename}.compacted"
+        self.fsync_every = fsync_every
+        self.fsync_seconds = fsync_seconds
+        self.compact_every = compact_every
+        self._lock = threading.RLock()
+        self._journal = None
+        self._journal_records: int = 0
+        self._unsynced: int = 0
+        self._last_sync = time.monotonic()
+        self.__finish_compaction()
+        self.__load_snapshot()
         if not self.data:
             self.data: dict = {}
+        self.__replay_journal()
         logger.trace(f"Loaded request log data: {self.data}")
+        self.__open_journal()
+        if self._journal_records:
+            self.compact()
+        atexit.register(self.close)
 
     def __setitem__(self, key, value):
-        super().__setitem__(key, value)
-        self.__save_pickle_data()
+        with self._lock:
+            super().__setitem__(key, value)
+            self.__append({"op": "set", "device": key, "entries": list(value)})
 
-    def __save_pickle_data(self):
+    def __finish_compaction(self):
+        if not os.path.exists(self.compacted_filename):
+            return
+        # the new snapshot was complete before the journal was renamed aside - replace the old snapshot with it, if
+        # that didn't happen yet, and drop the journal it already contains
+        tmp = f"{self.filename}.tmp"
+        if os.path.exists(tmp):
+            os.replace(tmp, self.filename)
+        os.remove(self.compacted_filename)
+        self.__fsync_directory()
+        logger.info("finished an interrupted request log compaction")
+
+    def __fsync_directory(self):
+        # makes the renames durable, in the order they happened
+        fd = os.open(os.path.dirname(self.filename), os.O_RDONLY)
         try:
-            with open("{}/{}".format(os.path.dirname(os.path.abspath(__file__)), self.filename), "wb") as datafile:
-                pickle.dump(self.data, datafile, -1)
-                logger.trace("Saved data to pickle file")
-                return True
-        except Exception as e:
-            logger.warning("Failed saving to pickle file: {}".format(e))
-            return False
+            os.fsync(fd)
+        finally:
+            os.close(fd)
 
-    def __load_pickle_data(self):
+    def __load_snapshot(self):
         try:
-            with open("{}/{}".format(os.path.dirname(os.path.abspath(__file__)), self.filename), "rb") as datafile:
+            with open(self.filename, "rb") as datafile:
                 data = pickle.load(datafile)
                 self.data = data
-                logger.info("request log data loaded from pickle file")
+                logger.info("request log data loaded from snapshot")
+        except FileNotFoundError:
+            logger.info("no request log snapshot found")
         except Exception as e:
-            logger.warning("exception trying to load pickle'd data: {}".format(e))
+            logger.warning("exception trying to load request log snapshot: {}".format(e))
             return None
 
+    def __replay_journal(self):
+        try:
+            with open(self.journal_filename, "r") as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # an incomplete last record from a crash while writing
+                        logger.warning(f"skipping broken request log journal record: {line!r}")
+                        continue
+                    self.__apply(record)
+                    self._journal_records += 1
+        except FileNotFoundError:
+            return
+        logger.info(f"replayed {self._journal_records} request log journal records")
+
+    def __apply(self, record):
+        device = record["device"]
+        if record["op"] == "log":
+            self.__create_if_not_exists(device)
+            self.data[device].append(record["entry"])
+        elif record["op"] == "rotate":
+            if device in self.data:
+                self.data[device].rotate(-1)
+        elif record["op"] == "set":
+            self.data[device] = deque(record["entries"], maxlen=self.config.rate_limit_number)
+
+    def __open_journal(self):
+        self._journal = open(self.journal_filename, "a")
+
+    def __append(self, record):
+        try:
+            self._journal.write(json.dumps(record, separators=(",", ":")) + "\n")
+            self._journal.flush()
+            self._journal_records += 1
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_seconds:
+                self.sync()
+            if self._journal_records >= self.compact_every:
+                self.compact()
+            return True
+        except Exception as e:
+            logger.warning("Failed writing to request log journal: {}".format(e))
+            return False
+
+    def sync(self):
+        with self._lock:
+            if self._unsynced and not self._journal.closed:
+                os.fsync(self._journal.fileno())
+                self._unsynced = 0
+            self._last_sync = time.monotonic()
+
+    def compact(self):
+        """
+        Write the whole log to a new snapshot, replace the old one atomically and start a new journal.
+        """
+        with self._lock:
+            tmp = f"{self.filename}.tmp"
+            try:
+                # the new snapshot mustn't be mistaken for the one of a failed compaction
+                self.__finish_compaction()
+                with open(tmp, "wb") as datafile:
+                    pickle.dump(self.data, datafile, -1)
+                    datafile.flush()
+                    os.fsync(datafile.fileno())
+            except Exception as e:
+                logger.warning("Failed compacting request log: {}".format(e))
+                return False
+            self._journal.close()
+            try:
+                os.replace(self.journal_filename, self.compacted_filename)
+                self.__fsync_directory()
+                os.replace(tmp, self.filename)
+                self._journal = open(self.journal_filename, "w")
+                self.__fsync_directory()
+                os.remove(self.compacted_filename)
+            except Exception as e:
+                # the journal keeps the records that aren't in the current snapshot, whichever step failed - the
+                # next startup finishes the compaction
+                logger.warning("Failed compacting request log: {}".format(e))
+                if self._journal.closed:
+                    self.__open_journal()
+                return False
+            self._journal_records = 0
+            self._unsynced = 0
+            logger.trace("compacted request log journal into snapshot")
+            return True
+
+    def close(self):
+        with self._lock:
+            if not self._journal.closed:
+                self.sync()
+                self._journal.close()
+
     def __create_if_not_exists(self, name):
         if not name in self.data:
             self.data[name] = deque(maxlen=self.config.rate_limit_number)
 
     def log(self, name, request):
-        self.__create_if_not_exists(name)
-        self.data[name].append(request)
-        self.__save_pickle_data()
-        return True
+        with self._lock:
+            self.__create_if_not_exists(name)
+            self.data[name].append(request)
+            return self.__append({"op": "log", "device": name, "entry": request})
 
     def rotate(self, device):
-        try:
-            self.data[device].rotate(-1)
-            self.__save_pickle_data()
-            return True
-        except Exception as e:
-            logger.warning(f"Exception trying to rotate deque of {device}: {e}")
-            return False
+        with self._lock:
+            try:
+                self.data[device].rotate(-1)
+            except Exception as e:
+                logger.warning(f"Exception trying to rotate deque of {device}: {e}")
+                return False
+            return self.__append({"op": "rotate", "device": device})
+
+    def size(self):
+        """
+        Returns the number of devices and entries in the log.
+        """
+        with self._lock:
+            return len(self.data), sum(len(entries) for entries in self.data.values())
 
     def get_logged_usernames(self, device):
         return map(itemgetter('username'), self.data[device]) if device in self.data else []
@@ -0,0 +1,118 @@
+import threading
+
+from collections import deque
+from loguru import logger
+
+from config import Config
+from db_connection import DbConnection as Db
+
+
+class ReservingStore:
+    """
+    Store wrapper answering default checkouts (by level) from short queues of pre-selected candidate accounts.
+
+    One queue is kept per requested level and refilled in the background by `refill()` with the eligible accounts used
+    the longest time ago. A checkout pops the next candidate and claims it with a single conditional UPDATE, which
+    only succeeds if the account is still free, at the level and cooled down - stale candidates are skipped. If the
+    queue runs dry, the checkout falls back to the store's regular search. Every other call goes to the store.
+    """
+
+    # stale candidates to skip before falling back to the regular search
+    max_attempts = 3
+
+    def __init__(self, store, size=20, config=Config):
+        self.store = store
+        self.size = size
+        self.config = config
+        self._queues: dict = {}
+        # usernames in any queue - every account is reserved for one level at most
+        self._reserved: set = set()
+        self._lock = threading.Lock()
+        self.metrics = {"hits": 0, "stale": 0, "misses": 0}
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def _take(self, level):
+        with self._lock:
+            queue = self._queues.get(level)
+            if queue is None:
+                # refilled with the next run of refill()
+                self._queues[level] = deque()
+                return None
+            if not queue:
+                return None
+            username, password = queue.popleft()
+            self._reserved.discard(username)
+            return username, password
+
+    def _count(self, metric):
+        # checkouts of many threads count at the same time
+        with self._lock:
+            self.metrics[metric] += 1
+
+    def checkout(self, device, mark_last_use=True, level=None, cooldown_ts=None, username=None, current=False):
+        if username is None and not current:
+            stale = False
+            for _ in range(self.max_attempts):
+                candidate = self._take(int(level))
+                if candidate is None:
+                    break
+                if self.store.claim(device, candidate[0], level, cooldown_ts, mark_last_use=mark_last_use):
+                    self._count("hits")
+                    return candidate
+                stale = True
+                logger.trace(f"reserved account {candidate[0]} went stale")
+            # every checkout counts once - as stale if it fell back after skipping stale candidates
+            self._count("stale" if stale else "misses")
+        return self.store.checkout(device, mark_last_use=mark_last_use, level=level, cooldown_ts=cooldown_ts,
+                                   username=username, current=current)
+
+    def refill(self):
+        """
+        Replace the queues' contents with the currently eligible accounts, highest level first.
+        """
+        cooldown_ts = self.config.get_cooldown_timestamp()
+        with self._lock:
+            levels = sorted(self._queues, reverse=True)
+        taken: set = set()
+        refilled: dict = {}
+        for level in levels:
+            candidates = self.store.candidates(level, cooldown_ts, self.size + len(taken))
+            refilled[level] = deque(((username, password) for username, password in candidates
+                                     if username not in taken), maxlen=self.size)
+            taken.update(username for username, _ in refilled[level])
+        with self._lock:
+            self._queues.update(refilled)
+            self._reserved = taken
+        logger.trace(f"refilled reservation queues of levels {levels}")
+
+    def add_or_update_many(self, accounts):
+        # changed passwords - drop the accounts' reservations, the next refill picks them up again
+        usernames = {username for username, _ in accounts}
+        with self._lock:
+            if not usernames & self._reserved:
+                return
+            for level, queue in self._queues.items():
+                self._queues[level] = deque((entry for entry in queue if entry[0] not in usernames),
+                                            maxlen=self.size)
+            self._reserved -= usernames
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.metrics)
+            stats.update({"reserved": len(self._reserved), "levels": len(self._queues)})
+        return stats
+
+
+def reserving(store, config=Config):
+    """
+    Wraps the database store (of any account pool) in a ReservingStore if reservations are enabled - the in-memory
+    pool picks accounts without a database search anyway.
+    """
+    if config.reservation_size <= 0:
+        return store
+    if not Db.is_store(store):
+        logger.info("reservations are not used with the in-memory pool")
+        return store
+    return ReservingStore(store, size=config.reservation_size, config=config)
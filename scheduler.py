@@ -0,0 +1,58 @@
+import heapq
+import itertools
+import threading
+import time
+
+from loguru import logger
+
+
+class Scheduler:
+    """
+    Runs periodic jobs on a single background thread.
+    """
+
+    def __init__(self):
+        self._jobs: list = []
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def every(self, seconds, func, name=None, run_now=False):
+        name = name or func.__name__
+        if seconds <= 0:
+            logger.info(f"Periodic job {name} disabled")
+            return
+        first = time.monotonic() + (0 if run_now else seconds)
+        with self._lock:
+            heapq.heappush(self._jobs, (first, next(self._order), seconds, name, func))
+        self._wakeup.set()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self._lock:
+                due = self._jobs[0][0] if self._jobs else None
+            timeout = None if due is None else max(0.0, due - time.monotonic())
+            if timeout is None or timeout > 0:
+                self._wakeup.wait(timeout)
+                self._wakeup.clear()
+                continue
+            with self._lock:
+                _, order, seconds, name, func = heapq.heappop(self._jobs)
+            try:
+                logger.trace(f"running periodic job {name}")
+                func()
+            except Exception as e:
+                logger.opt(exception=e).error(f"Periodic job {name} failed: {e}")
+            with self._lock:
+                heapq.heappush(self._jobs, (time.monotonic() + seconds, order, seconds, name, func))
@@ -1,52 +1,171 @@
 import collections
-import humanize
 import logging
-import os
+import re
 import sys
 import time
 
-from enum import IntEnum
-from flask import Flask, request
+from flask import Flask, Response, g, request
 from flask_basicauth import BasicAuth
 from loguru import logger
-from operator import itemgetter
+from werkzeug.routing import BaseConverter
 
+from account_import import AccountImporter
+from account_pool import AccountPool
+from capture import TrafficCapture
+import clock
 from config import Config
 from db_connection import DbConnection as Db
+from events import KEEPALIVE, EventBroadcaster, PoolEvents, server_sent_event
 from logs import setup_logger
+import metrics
+from migrations import migrate
+from pool_stats import PoolStats
+import profiler
+from profiler import RequestTracer, SamplingProfiler
+from rate_limit import RateLimit, RateLimiter
+from read_cache import CurrentAccountCache, LRUCache
 from request_log import RequestLog
+from reservations import ReservingStore, reserving
+from scheduler import Scheduler
+from shared_state import SharedRateLimiter, SharedRequestLog
 from utils import can_be_type
 
 
 setup_logger()
 
 
-class RateLimit(IntEnum):
-    unlimited = 0
-    burst = 1
-    period = 2
-    unknown = 3
+def pool_converter(names):
+    """
+    URL converter matching the names of the named account pools only, e.g. /get/<pool:pool>/<device>. Its lower
+    weight makes routes with a pool name win over routes starting with a device or account name.
+    """
+    class PoolConverter(BaseConverter):
+        regex = "|".join(re.escape(name) for name in names)
+        weight = 50
+    return PoolConverter
+
+
+# route parameters of Flask (<device>, <pool:pool>, <path:rest>) and aiohttp ({device}) rules
+ROUTE_PARAM = re.compile(r"<(?:\w+:)?(\w+)>|{(\w+)}")
+
+
+def route_label(rule):
+    """
+    Label of a route in the metrics, traces and captured traffic: its rule without converters in Flask's notation,
+    e.g. /<pool>/get/<device>, the same in both server modes.
+    """
+    return ROUTE_PARAM.sub(lambda match: f"<{match.group(1) or match.group(2)}>", rule)
 
 
 class AccountServer:
 
-    def __init__(self):
+    def __init__(self, launch=True):
         logger.info("initializing server")
         self.config = Config()
         self.host = self.config.listen_host
         self.port = self.config.listen_port
         self.resp_headers = {"Server": "pogoAccountServer"
                              }
-        self.request_log = RequestLog()
         self.app = None
-        self.load_accounts_from_file()
+        if self.config.db_auto_migrate:
+            migrate()
+        self.scheduler = Scheduler()
+        self.events = PoolEvents(EventBroadcaster(self.config.event_buffer_size), self.config.pool_name)
+        self.open_pool()
+        # the server serves the default pool itself - every named pool is served by a PoolServer of its own
+        self.pools = {self.config.pool_name: self}
+        for name in self.config.pools:
+            self.pools[name] = self.create_pool(name)
+        self.capture = None
+        if self.config.capture_file:
+            self.capture = TrafficCapture(self.config.capture_file, buffer_size=self.config.capture_buffer_size)
+        self.tracer = None
+        if self.config.profiling:
+            self.tracer = RequestTracer(self.config.profiling_trace_buffer_size, self.config.profiling_slowest_requests)
+            self.sampler = SamplingProfiler()
+        if self.capture is not None:
+            self.scheduler.every(self.config.capture_flush_seconds, self.capture.flush, name="flush_capture")
+        self.scheduler.start()
         logger.info(self.stats())
-        self.launch_server()
+        if launch:
+            self.launch_server()
+
+    def open_pool(self):
+        """
+        Set up the account pool of self.config: its request log, accounts, store, rate limiter, stats, caches and
+        periodic jobs. Nothing of it is shared with other pools - the checkouts of a pool only search its accounts.
+        """
+        name = self.config.pool_name
+        # shared state: request log and rate limit windows live in the database, shared by all server processes
+        if self.config.shared_state:
+            self.request_log = SharedRequestLog(self.config)
+        else:
+            suffix = "" if name == Config.pool_name else f".{name}"
+            self.request_log = RequestLog(filename=f".request_log{suffix}.pickle",
+                                          journal=f".request_log{suffix}.journal", config=self.config)
+            # the journal is fsync'd on appends - and on time, so the last records of an idle server are synced too
+            self.every(self.request_log.fsync_seconds, self.request_log.sync, name="sync_request_log")
+        self.importer = AccountImporter(self.config.accounts_file, chunk_size=self.config.import_chunk_size, pool=name)
+        self.importer.run()
+        # account state is read and changed through self.store - either the database directly or the in-memory pool
+        self.store = Db.for_pool(name)
+        if self.config.memory_pool and self.config.shared_state:
+            logger.warning("memory_pool can't be used with shared_state - using the database directly")
+        elif self.config.memory_pool:
+            self.store = AccountPool(flush_interval=self.config.write_behind_seconds, db=self.store)
+            self.store.load()
+            self.store.start()
+        self.store = reserving(self.store, self.config)
+        self.rate_limiter = (SharedRateLimiter if self.config.shared_state else RateLimiter)(self.request_log,
+                                                                                            self.config)
+        self.rate_limiter.seed(self.store)
+        self.pool_stats = PoolStats()
+        self.create_caches()
+        self.pool_state = None
+        self.reconcile_stats()
+        self.check_pool()
+        self.every(self.config.force_release_interval_seconds, self.force_release, run_now=True)
+        if self.config.lease_seconds > 0:
+            granted = self.store.grant_missing_leases(int(clock.now()))
+            if granted:
+                logger.info(f"Granted leases to {granted} accounts of pool {name} assigned without one")
+            self.every(self.config.lease_sweep_seconds, self.release_expired_leases)
+        self.every(self.config.stats_reconcile_seconds, self.reconcile_stats)
+        self.every(self.config.accounts_reload_seconds, self.watch_accounts_file)
+        self.every(self.config.pool_check_seconds, self.check_pool)
+        if self.config.archive_burn_count > 0 or self.config.archive_unused_days > 0:
+            self.every(self.config.archive_interval_seconds, self.archive_accounts)
+        if isinstance(self.store, ReservingStore):
+            self.every(self.config.reservation_refill_seconds, self.store.refill, name="refill_reservations")
+
+    def every(self, seconds, func, name=None, run_now=False):
+        # the jobs of named pools are told apart by the pool's name
+        name = name or func.__name__
+        if self.config.pool_name != Config.pool_name:
+            name = f"{name}[{self.config.pool_name}]"
+        self.scheduler.every(seconds, func, name=name, run_now=run_now)
+
+    def create_pool(self, name):
+        return PoolServer(self, name)
+
+    def create_caches(self):
+        # polls of /get-current/<device> and /stats are answered from memory until the server changes what they return
+        self.current_account_cache = CurrentAccountCache(self.config.read_cache_size, self.config.read_cache_seconds)
+        self.stats_cache = LRUCache("stats", 1, self.config.read_cache_seconds)
 
     def launch_server(self):
+        self.create_app()
+        werkzeug_logger = logging.getLogger("werkzeug")
+        werkzeug_logger.setLevel(logging.WARNING)
+        logger.info(f"start listening on port {self.port}")
+        self.app.run(host=self.host, port=self.port, debug=False, use_reloader=False)
+
+    def create_app(self):
         self.app = Flask(__name__)
         self.app.config['BASIC_AUTH_USERNAME'] = self.config.auth_username
         self.app.config['BASIC_AUTH_PASSWORD'] = self.config.auth_password
+        # registered before the basic auth check, so rejected requests are timed as well
+        self.app.before_request(self.start_timer)
         basic_auth = BasicAuth(self.app)
         self.app.config['BASIC_AUTH_FORCE'] = True
         self.app.config['MAX_CONTENT_LENGTH'] = 16 * 1000 * 1000
@@ -55,8 +174,18 @@ class AccountServer:
         self.app.add_url_rule('/<first>', "fallback", self.fallback, methods=['GET', 'POST'])
         self.app.add_url_rule('/<first>/<path:rest>', "fallback", self.fallback, methods=['GET', 'POST'])
 
+        named = [name for name in self.pools if name != self.config.pool_name]
+        if named:
+            self.app.url_map.converters["pool"] = pool_converter(named)
+            views: dict = {}
+            for rule, handler in self.pool_routes:
+                view = views.setdefault(handler, self.pool_view(handler))
+                methods = ['GET'] if handler == "cached_stats" else ['GET', 'POST']
+                self.app.add_url_rule(rule.replace("<pool>", "<pool:pool>"), f"pool_{handler}", view, methods=methods)
+
         self.app.add_url_rule("/get-current/<device>", "get_current_account", self.get_current_account,
                               methods=['GET', 'POST'])
+        self.app.add_url_rule("/heartbeat/<device>", "heartbeat", self.heartbeat, methods=['GET', 'POST'])
         self.app.add_url_rule("/get/<device>", "get_account", self.get_account, methods=['GET', 'POST'])
         self.app.add_url_rule("/get/<device>/<level>", "get_account_level", self.get_account, methods=['GET', 'POST'])
         self.app.add_url_rule("/set/level/by-device/<device>/<level>", "set_level_by_device",
@@ -71,37 +200,193 @@ class AccountServer:
                               self.set_burned_by_account, methods=['GET', 'POST'])
         self.app.add_url_rule("/set/burned/by-account/<account>/<ts>", "set_burned_by_account",
                               self.set_burned_by_account, methods=['GET', 'POST'])
-        self.app.add_url_rule("/stats", "stats", self.stats, methods=['GET'])
-
-        werkzeug_logger = logging.getLogger("werkzeug")
-        werkzeug_logger.setLevel(logging.WARNING)
-        logger.info(f"start listening on port {self.port}")
-        self.app.run(host=self.host, port=self.port, debug=False, use_reloader=False)
-
-    def load_accounts_from_file(self, file="accounts.txt"):
-        accounts = []
-        if not os.path.isfile(file):
-            logger.warning(f"{file} not found - not adding accounts")
-            return False
-        with open(file, "r") as f:
-            for line in f:
-                try:
-                    split = line.strip().split(",")
-                    if len(split) > 2:
-                        logger.warning(f"Invalid account entry: {line}")
-                        continue
-                    username, password = split
-                    accounts.append((username, password))
-                except Exception as e:
-                    logger.warning(f"{e} trying to parse: {line}")
-                    continue
-        sql = ("INSERT INTO accounts (username, password) VALUES (%s, %s) ON DUPLICATE KEY UPDATE "
-               "password=VALUES(password);")
-        logger.info(f"Loaded {len(accounts)} from {file}")
-        with Db() as conn:
-            conn.cur.executemany(sql, accounts)
-            conn.conn.commit()
-        return True
+        self.app.add_url_rule("/stats", "stats", self.cached_stats, methods=['GET'])
+        self.app.add_url_rule("/batch/get", "batch_get", self.json_view(self.in_pool("get_accounts")),
+                              methods=['POST'])
+        self.app.add_url_rule("/batch/set/level", "batch_set_level", self.json_view(self.in_pool("set_levels")),
+                              methods=['POST'])
+        self.app.add_url_rule("/batch/set/burned", "batch_set_burned", self.json_view(self.in_pool("set_burned_many")),
+                              methods=['POST'])
+        self.app.add_url_rule("/admin/reload-accounts", "admin_reload_accounts",
+                              self.json_view(self.in_pool("admin_reload_accounts")), methods=['POST'])
+        self.app.add_url_rule("/admin/archive", "admin_archived_accounts", self.query_view(self.archived_accounts),
+                              methods=['GET'])
+        self.app.add_url_rule("/admin/archive", "admin_archive", self.json_view(self.in_pool("admin_archive")),
+                              methods=['POST'])
+        self.app.add_url_rule("/admin/archive/restore", "admin_restore",
+                              self.json_view(self.in_pool("admin_restore")), methods=['POST'])
+        self.app.add_url_rule("/metrics", "metrics", self.export_metrics, methods=['GET'])
+        self.app.add_url_rule("/events", "events", self.event_stream, methods=['GET'])
+        if self.tracer is not None:
+            self.app.add_url_rule("/debug/traces", "debug_traces", self.query_view(self.debug_traces), methods=['GET'])
+            self.app.add_url_rule("/debug/traces/slowest", "debug_slowest_traces",
+                                  self.query_view(self.debug_slowest_traces), methods=['GET'])
+            self.app.add_url_rule("/debug/profile", "debug_profile", self.query_view(self.debug_profile),
+                                  methods=['GET'])
+        self.app.after_request(self.observe_request)
+        return self.app
+
+    def start_timer(self):
+        g.request_ts = time.time()
+        g.request_start = time.perf_counter()
+        if self.tracer is not None:
+            g.trace = self.tracer.start(request.method, request.path)
+
+    def observe_request(self, response):
+        # label by the route's rule, not the actual path, to keep the number of series bounded - the fallback rules
+        # differ between the server modes, their requests count as unmatched
+        if request.url_rule is None or request.url_rule.endpoint == "fallback":
+            route = "unmatched"
+        else:
+            route = route_label(request.url_rule.rule)
+        latency = time.perf_counter() - g.request_start
+        if self.tracer is not None:
+            response.headers["Server-Timing"] = self.finish_trace(g.trace, route, response.status_code)
+        metrics.http_request_duration.observe(latency, route)
+        metrics.http_requests.inc(route, request.method, str(response.status_code))
+        if self.capture is not None:
+            self.capture.record(g.request_ts, request.method, route, request.view_args or {},
+                                request.get_json(silent=True), response.status_code, latency,
+                                response.get_json(silent=True))
+        return response
+
+    def finish_trace(self, trace, route, status):
+        # requests for the traces and profiles themselves are not kept
+        self.tracer.finish(trace, route, status, keep=not route.startswith("/debug/"))
+        return trace.server_timing()
+
+    @staticmethod
+    def json_view(handler):
+        # batch handlers take the parsed JSON body, so the async server can share them
+        def view():
+            return handler(request.get_json(silent=True))
+        return view
+
+    @staticmethod
+    def query_view(handler):
+        # like json_view, with the query string parameters instead of the body
+        def view():
+            return handler(request.args.to_dict())
+        return view
+
+    # routes of the named account pools - the routes of the default pool with the pool's name in front of the device or
+    # account, served by the pool's handler
+    pool_routes = [
+        ("/get-current/<pool>/<device>", "get_current_account"),
+        ("/heartbeat/<pool>/<device>", "heartbeat"),
+        ("/get/<pool>/<device>", "get_account"),
+        ("/get/<pool>/<device>/<level>", "get_account"),
+        ("/set/level/by-device/<pool>/<device>/<level>", "set_level_by_device"),
+        ("/set/level/by-account/<pool>/<account>/<level>", "set_level_by_account"),
+        ("/set/burned/by-device/<pool>/<device>", "set_burned_by_device"),
+        ("/set/burned/by-device/<pool>/<device>/<ts>", "set_burned_by_device"),
+        ("/set/burned/by-account/<pool>/<account>", "set_burned_by_account"),
+        ("/set/burned/by-account/<pool>/<account>/<ts>", "set_burned_by_account"),
+        ("/stats/<pool>", "cached_stats"),
+    ]
+
+    def pool_view(self, handler):
+        def view(pool, **kwargs):
+            return getattr(self.pools[pool], handler)(**kwargs)
+        return view
+
+    def in_pool(self, handler):
+        """
+        Batch and admin handlers of the pool named in the payload: {"pool": "name", ...} - the default pool without one.
+        """
+        def pool_handler(payload):
+            name = payload.get("pool", self.config.pool_name) if isinstance(payload, dict) else self.config.pool_name
+            if not isinstance(name, str) or name not in self.pools:
+                return self.invalid_request({"error": f"unknown account pool: {name}"})
+            return getattr(self.pools[name], handler)(payload)
+        return pool_handler
+
+    def reload_accounts(self, force=False):
+        # new and changed accounts are already written to the database - the in-memory pool and the reservations have
+        # to learn about them
+        on_change = getattr(self.store, "add_or_update_many", None)
+        counts = self.importer.run(force=force, on_change=on_change)
+        if counts and counts["added"]:
+            self.pool_stats.on_added(counts["added"])
+            self.stats_cache.clear()
+        return counts
+
+    def watch_accounts_file(self):
+        if self.importer.changed_on_disk():
+            logger.info(f"{self.importer.file} changed - importing it")
+            self.reload_accounts()
+
+    def admin_reload_accounts(self, payload):
+        force = bool(payload.get("force")) if isinstance(payload, dict) else False
+        counts = self.reload_accounts(force=force)
+        return self.resp_ok({"status": "ok", "imported": counts is not None, "counts": counts})
+
+    def archive_accounts(self):
+        """
+        Move the accounts matching the archive policy to the archive, archive_batch_size accounts per transaction.
+        """
+        now = int(clock.now())
+        burn_count = self.config.archive_burn_count if self.config.archive_burn_count > 0 else None
+        unused_before = now - self.config.archive_unused_days * 86400 if self.config.archive_unused_days > 0 else None
+        archived = 0
+        while True:
+            candidates = self.store.archive_candidates(burn_count, unused_before, self.config.archive_batch_size)
+            by_reason = collections.defaultdict(list)
+            for username, reason in candidates:
+                by_reason[reason].append(username)
+            moved = sum(len(self.archive(usernames, reason, now)) for reason, usernames in by_reason.items())
+            archived += moved
+            if not moved or len(candidates) < self.config.archive_batch_size:
+                break
+        if archived:
+            logger.info(f"Archived {archived} accounts")
+            self.reconcile_stats()
+        return archived
+
+    def archive(self, usernames, reason, now):
+        archived = self.store.archive(usernames, reason, now)
+        for username in archived:
+            self.events.publish("archived", username=username, reason=reason)
+        return archived
+
+    def archived_accounts(self, query):
+        """
+        Page through the archive of all pools: ?limit=100&offset=0&reason=burned&pool=default
+        """
+        limit, offset = query.get("limit", 100), query.get("offset", 0)
+        if not can_be_type(limit, int) or not can_be_type(offset, int) or not 0 < int(limit) <= 1000 \
+                or int(offset) < 0:
+            return self.invalid_request({"error": "limit must be 1 - 1000, offset at least 0"})
+        total, accounts = Db.archived_accounts(int(limit), int(offset), query.get("reason"), query.get("pool"))
+        return self.resp_ok({"status": "ok", "total": total, "accounts": accounts})
+
+    def admin_archive(self, payload):
+        """
+        Archive accounts right away, e.g. banned ones: {"accounts": ["account", ...]} - assigned accounts are skipped.
+        """
+        accounts = self.batch_items(payload, "accounts")
+        if not accounts or not all(isinstance(account, str) for account in accounts):
+            return self.invalid_request({"error": "expected a list of accounts"})
+        archived = self.archive(accounts, "admin", int(clock.now()))
+        if archived:
+            self.reconcile_stats()
+        return self.resp_ok({"status": "ok", "results": [
+            {"account": account, "status": "ok" if account in archived else "fail"} for account in accounts]})
+
+    def admin_restore(self, payload):
+        """
+        Move archived accounts back to the pool: {"accounts": ["account", ...]}
+        """
+        accounts = self.batch_items(payload, "accounts")
+        if not accounts or not all(isinstance(account, str) for account in accounts):
+            return self.invalid_request({"error": "expected a list of accounts"})
+        restored = self.store.restore(accounts, int(clock.now()))
+        for username in restored:
+            self.events.publish("restored", username=username)
+        if restored:
+            self.reconcile_stats()
+        return self.resp_ok({"status": "ok", "results": [
+            {"account": account, "status": "ok" if account in restored else "fail"} for account in accounts]})
 
     def resp_ok(self, data=None):
         standard = {"status": "ok"}
@@ -130,84 +415,50 @@ class AccountServer:
         return self.invalid_request()
 
     def is_rate_limited(self, device=None):
-        device_logger = logger.bind(name=device)
-        if not device:
-            return RateLimit.unknown
-
-        # check RateLimit.burst - strict_rate_limit (quick repeated requests)
-        # include usernames from the device's RequestLog into the query and choose the largest timestamp
-        # - this is when the device last got any account
-        latest = 0
-        latest_request = f"SELECT max(last_use) FROM accounts WHERE in_use_by = \"{device}\""
-        for username in self.request_log.get_logged_usernames(device):
-            latest_request += f" or username = \"{username}\""
-        device_logger.trace(f"{latest_request=}")
-        latest = Db.get(latest_request)
-        print_string = humanize.precisedelta(int(int(time.time()) - latest)) if latest > 0 else "an eternity"
-        device_logger.info(f"Latest allowed request was {print_string} ago")
-        # the actual check against the configured rate limit interval
-        if int(time.time()) - latest < self.config.strict_rate_limit_seconds:
-            device_logger.warning("Rate-limited! Device requested an account less than "
-                                  f"{self.config.strict_rate_limit_minutes} minutes ago!")
-            return RateLimit.burst
-
-        # check RateLimit.period - requesting too many accounts across the configured interval
-        limiting_requests: int = 0
-        if device in self.request_log:
-            # sorted for nicer logging - no programmatical use
-            for request in sorted(self.request_log[device], key=itemgetter("ts")):
-                device_logger.debug(f"Evaluating previous request: {request} "
-                                    f"({humanize.precisedelta(int(time.time()) - request['ts'])} ago)")
-                if request["ts"] > int(time.time()) - (self.config.rate_limit_minutes * 60):
-                    device_logger.debug("Found request within rate-limit interval")
-                    limiting_requests += 1
-
-        if limiting_requests >= self.config.rate_limit_number:
-            device_logger.warning(f"Rate-limited! {limiting_requests=} >= {self.config.rate_limit_number}")
-            return RateLimit.period
-        else:
-            device_logger.trace(f"NOT rate-limited! {limiting_requests=} < {self.config.rate_limit_number}")
-            return RateLimit.unlimited
+        rate_limit_state = self.rate_limiter.check(device)
+        metrics.rate_limit_checks.inc(rate_limit_state.name, self.config.pool_name)
+        return rate_limit_state
 
     def get_account(self, device=None, level=30):
-        device_logger = logger.bind(name=device)
         if not device or not can_be_type(level, int):
             return self.invalid_request()
+        with profiler.phase("rate_limit"):
+            rate_limit_state = self.is_rate_limited(device)
+        # look up the states of the logged accounts in one query - only required when rate-limited
+        with profiler.phase("account_states"):
+            states = self.store.account_states(self.rate_limiter.logged_usernames(device)) if rate_limit_state else {}
+        with profiler.phase("choose_account"):
+            rate_limit_state, pick = self.choose_account(device, level, rate_limit_state, states)
+        # pick the account, release the device's previous one and assign the new one in a single transaction.
+        # on RateLimit.burst, do not update timestamps in DB to allow to get a new account after the burst limit
+        # - the burst may be justified if the device persistently retries
+        with profiler.phase("checkout"):
+            username, pw = self.store.checkout(device, mark_last_use=rate_limit_state != RateLimit.burst, **pick)
+        with profiler.phase("checked_out"):
+            return self.checked_out(device, rate_limit_state, username, pw)
+
+    def choose_account(self, device, level, rate_limit_state, states):
+        """
+        Decide which account to check out for the device - returns the (possibly overridden) rate limit state and the
+        keyword arguments for store.checkout.
+        """
+        device_logger = logger.bind(name=device)
+        # default: pick the eligible account used the longest time ago - can get overridden in the rate limit
+        # handler below
+        pick: dict = {"level": int(level), "cooldown_ts": self.config.get_cooldown_timestamp()}
 
-        username = None
-        pw = None
-
-        # default select statement - can get overridden in the rate limit handler below
-        last_returned_limit = self.config.get_cooldown_timestamp()
-        select = (f"SELECT username, password from accounts WHERE in_use_by is NULL AND level >= {int(level)} AND "
-                  f"GREATEST(last_returned, last_burned) < {last_returned_limit} ORDER BY last_use ASC LIMIT 1;")
-
-        rate_limit_state = self.is_rate_limited(device)
         # True if RateLimit is not 0 - that would be RateLimit.unlimited
-        # this if-statement chooses the correct SQL query as variable "select"
+        # this if-statement chooses which account to check out as dict "pick"
         if rate_limit_state:
             device_logger.trace("rate-limited ... handle it")
             try:
                 # get the first not-burned account with suitable level from the request log
-                c: int = 0
-                while c < Config.rate_limit_number:
-                    try:
-                        previous_username = self.request_log[device][c]["username"]
-                        if (not Db.is_account_burned(previous_username) and
-                                Db.is_account_at_level(previous_username, level)):
-                            select = f"SELECT username, password from accounts where username = \"{previous_username}\""
-                            device_logger.info(f"Getting earliest queue account ({previous_username})")
-                            break
-                        else:
-                            device_logger.debug(f"account {previous_username} unusable .. try next")
-                    except Exception as e:
-                        if c == 0:
-                            raise IndexError("No accounts in request log")
-                        continue
-                    finally:
-                        c += 1
+                previous_username = self.rate_limiter.usable_previous_account(device, level, states)
+                if previous_username:
+                    pick = {"username": previous_username}
+                    device_logger.info("Getting earliest queue account ({})", previous_username)
                 else:
-                    # keep the default select statement because all accounts in the request log were burned
+                    # keep the default pick because all accounts in the request log were burned
                     if not Config.allow_rate_limit_override_when_burned:
                         raise RuntimeError("Not allowed to override rate limit when all accounts are burned!")
                     device_logger.warning("All accounts in request log have been marked as burned - allow to get "
@@ -218,55 +469,50 @@ class AccountServer:
                 # -> backward rotation is handled by RequestLog
                 self.request_log.rotate(device)
             except Exception as e:
-                select = f"SELECT username, password from accounts where in_use_by = \"{device}\""
+                pick = {"current": True}
                 device_logger.warning(f"Unable to get a previous account ({e})- getting its current account again")
-                username, pw = Db.get_elements_of_first_result(select, num=2)
         else:
-            device_logger.trace(f"not rate-limited ... move on")
+            device_logger.trace("not rate-limited ... move on")
+        device_logger.debug("rate_limit_state={!r} - checkout {}", rate_limit_state, pick)
+        return rate_limit_state, pick
 
+    def checked_out(self, device, rate_limit_state, username, pw):
+        device_logger = logger.bind(name=device)
         if not username or not pw:
-            device_logger.trace(select)
-            username, pw = Db.get_elements_of_first_result(select, num=2)
-        if not username or not pw:
-            device_logger.error(f"Unable to return an account")
+            device_logger.error("Unable to return an account")
             return self.invalid_request({"error": "No accounts available"})
-
-        # successfully got username and pw to return - now update DB to reflect the change
-        reset = (f"UPDATE accounts SET in_use_by = NULL, last_returned = '{int(time.time())}' WHERE "
-                 f" in_use_by = '{device}';")
-        Db.execute(reset)
-
-        # on RateLimit.burst, do not update timestamps in DB to allow to get a new account after the burst limit
-        # - the burst may be justified if the device persistently retries
+        previous, other = self.pool_stats.on_checkout(device, username, int(clock.now()))
+        self.current_account_cache.checked_out(device, username)
+        self.stats_cache.clear()
+        if previous is not None and previous != username:
+            self.events.publish("released", device=device, username=previous, reason="reassigned")
+        if other is not None and other != device:
+            self.events.publish("released", device=other, username=username, reason="taken")
+        self.events.publish("assigned", device=device, username=username)
+        self.check_pool()
         if rate_limit_state != RateLimit.burst:
-            device_logger.debug(f"{rate_limit_state=} - update timestamps in DB")
-            mark_used = (f"UPDATE accounts SET in_use_by = '{device}', last_use = '{int(time.time())}' WHERE "
-                         f"username = '{username}';")
-        else:
-            device_logger.debug(f"{rate_limit_state=} - do not update timestamps in DB")
-            mark_used = f"UPDATE accounts SET in_use_by = '{device}' WHERE username = '{username}';"
-        Db.execute(mark_used)
+            self.rate_limiter.record_grant(device)
 
         # make sure every account is only added to the RequestLog once
         if device not in self.request_log or username not in self.request_log.get_logged_usernames(device):
-            log_entry: dict = {"ts": int(time.time()), "username": username}
-            device_logger.debug(f"log this request: {log_entry}")
+            log_entry: dict = {"ts": int(clock.now()), "username": username}
+            device_logger.debug("log this request: {}", log_entry)
             self.request_log.log(device, log_entry)
         else:
-            device_logger.debug(f"NOT log this request")
+            device_logger.debug("NOT log this request")
 
-        device_logger.info(f"return {username=}, {pw=}")
-        device_logger.info(f"{self.stats()}\n")
-        # newline for visual separation of requests ...
-        print()
+        device_logger.info("return username={!r}, pw={!r}", username, pw)
+        if self.config.log_checkout_stats:
+            # only computed if a sink takes info messages
+            device_logger.opt(lazy=True).info("{}", self.stats)
         return self.resp_ok({"username": username, "password": pw})
 
     def set_level_by_account(self, account=None, level=None):
         logger.info(f"Set level by account: {account=} to {level=}")
         if not (level and account) or not can_be_type(level, int):
             return self.invalid_request()
-        sql = f"UPDATE accounts SET level = {int(level)} WHERE username = \"{account}\""
-        Db.execute(sql)
+        self.store.set_level(account, level)
+        self.events.publish("level", username=account, level=int(level))
         return self.resp_ok()
 
     def set_level_by_device(self, device=None, level=None):
@@ -275,28 +521,31 @@ class AccountServer:
         device_logger.info(f"Set level by device to {level=}")
         if not (device and level) or not can_be_type(level, int):
             return self.invalid_request()
-        sql = f"SELECT username FROM accounts WHERE in_use_by = \"{device}\""
-        username = Db.get(sql)
+        username = self.store.current_account(device)
         if username:
             return self.set_level_by_account(account=username, level=level)
         return self.invalid_request()
 
-    def set_burned_by_account(self, account=None, ts=int(time.time())):
+    def set_burned_by_account(self, account=None, ts=None):
+        ts = int(clock.now()) if ts is None else ts
         logger.info(f"Set burned by account: {account=} at {ts=}")
         if not (account and ts) or not can_be_type(ts, int):
             return self.invalid_request()
-        sql = f"UPDATE accounts SET last_burned = {int(ts)} WHERE username = \"{account}\""
-        Db.execute(sql)
+        self.store.set_burned(account, ts)
+        self.pool_stats.on_burned(account, ts)
+        self.stats_cache.clear()
+        self.events.publish("burned", username=account, ts=int(ts))
+        self.check_pool()
         return self.resp_ok()
 
-    def set_burned_by_device(self, device=None, ts=int(time.time())):
+    def set_burned_by_device(self, device=None, ts=None):
         # find the assigned account, then return self.set_burned_by_account
+        ts = int(clock.now()) if ts is None else ts
         device_logger = logger.bind(name=device)
         device_logger.info(f"Set burned by device at {ts=}")
         if not (device and ts) or not can_be_type(ts, int):
             return self.invalid_request()
-        sql = f"SELECT username FROM accounts WHERE in_use_by = \"{device}\""
-        username = Db.get(sql)
+        username = self.store.current_account(device)
         if username:
             return self.set_burned_by_account(account=username, ts=ts)
         return self.invalid_request()
@@ -306,52 +555,317 @@ class AccountServer:
         device_logger.info("Get current account")
         if not device:
             return self.invalid_request()
-        sql = f"SELECT username FROM accounts WHERE in_use_by = \"{device}\""
-        username = Db.get(sql)
+        username = self.current_account_cache.load(device, lambda: self.store.current_account(device))
         if username:
+            if self.config.lease_seconds > 0:
+                self.store.heartbeat(device)
             data = {"username": username}
             device_logger.info(f"Return current account: {data}")
             return self.resp_ok(data)
+        return self.invalid_request()
+
+    def heartbeat(self, device=None):
+        # extend the lease of the device's account - nothing to do without leases
+        if not device:
+            return self.invalid_request()
+        if self.config.lease_seconds <= 0:
+            return self.resp_ok({"lease_expires": None})
+        return self.heartbeat_response(device, self.store.heartbeat(device))
+
+    def heartbeat_response(self, device, expires):
+        if expires is None:
+            logger.bind(name=device).debug("heartbeat without an assigned account")
+            return self.invalid_request()
+        return self.resp_ok({"lease_expires": expires})
+
+    def batch_items(self, payload, key, kind=list):
+        """
+        Returns the items (a list or dict, depending on `kind`) at `key` of a batch request's JSON payload - empty if
+        the key is missing, None if the payload is invalid or has more than batch_max_items items.
+        """
+        if not isinstance(payload, dict):
+            return None
+        items = payload.get(key, kind())
+        if not isinstance(items, kind) or len(items) > self.config.batch_max_items:
+            return None
+        return items
+
+    def batch_result(self, key, item, response):
+        # per-item result of a batch request, from the response of the corresponding single-item handler
+        data, code, _ = response
+        result = {key: item, "status": data["status"]}
+        result.update(data.get("data", {}))
+        return result
+
+    def get_accounts(self, payload):
+        """
+        Batch variant of get_account: {"devices": ["device", {"device": "device", "level": 30}, ...], "level": 30}.
+        Rate limits are evaluated per device, then all accounts are checked out in a single transaction.
+        """
+        items = self.batch_items(payload, "devices")
+        if items is None:
+            return self.invalid_request({"error": f"expected a list of at most {self.config.batch_max_items} devices"})
+        default_level = payload.get("level", 30)
+        levels: dict = {}
+        for item in items:
+            device, level = (item.get("device"), item.get("level", default_level)) if isinstance(item, dict) \
+                else (item, default_level)
+            if not device or not isinstance(device, str) or not can_be_type(level, int) or device in levels:
+                return self.invalid_request({"error": f"invalid or duplicate device: {item}"})
+            levels[device] = level
+        logger.info(f"Batch checkout for {len(levels)} devices")
+
+        rate_limit_states = {device: self.is_rate_limited(device) for device in levels}
+        # the states of all logged accounts of all rate-limited devices in one query
+        logged = {username for device, state in rate_limit_states.items() if state
+                  for username in self.rate_limiter.logged_usernames(device)}
+        states = self.store.account_states(list(logged)) if logged else {}
+        plan = [(device, *self.choose_account(device, level, rate_limit_states[device], states))
+                for device, level in levels.items()]
+        picked = self.store.checkout_many([(device, rate_limit_state != RateLimit.burst, pick)
+                                           for device, rate_limit_state, pick in plan])
+        results = [self.batch_result("device", device,
+                                     self.checked_out(device, rate_limit_state, *picked.get(device, (None, None))))
+                   for device, rate_limit_state, _ in plan]
+        return self.resp_ok({"status": "ok", "results": results})
+
+    def set_levels(self, payload):
+        """
+        Batch variant of set_level_by_account and set_level_by_device:
+        {"accounts": {"account": level, ...}, "devices": {"device": level, ...}}
+        """
+        accounts = self.batch_items(payload, "accounts", dict)
+        devices = self.batch_items(payload, "devices", dict)
+        if accounts is None or devices is None \
+                or len(accounts) + len(devices) > self.config.batch_max_items \
+                or not all(can_be_type(level, int) for level in (*accounts.values(), *devices.values())):
+            return self.invalid_request({"error": "expected accounts and devices mapped to their levels"})
+        logger.info(f"Batch set level of {len(accounts)} accounts and {len(devices)} devices")
+        current = self.store.current_accounts(list(devices))
+        levels = {username: int(level) for username, level in accounts.items()}
+        levels.update({current[device]: int(level) for device, level in devices.items() if device in current})
+        updated = self.store.set_level_many(levels)
+        for username in updated:
+            self.events.publish("level", username=username, level=levels[username])
+        results = [{"account": account, "status": "ok" if account in updated else "fail"} for account in accounts]
+        results += [{"device": device, "status": "ok" if current.get(device) in updated else "fail",
+                     "account": current.get(device)} for device in devices]
+        return self.resp_ok({"status": "ok", "results": results})
+
+    def set_burned_many(self, payload):
+        """
+        Batch variant of set_burned_by_account and set_burned_by_device:
+        {"accounts": ["account", ...], "devices": ["device", ...], "ts": 1700000000}
+        """
+        accounts = self.batch_items(payload, "accounts")
+        devices = self.batch_items(payload, "devices")
+        ts = payload.get("ts", int(clock.now())) if isinstance(payload, dict) else None
+        if accounts is None or devices is None \
+                or len(accounts) + len(devices) > self.config.batch_max_items \
+                or not all(isinstance(item, str) for item in (*accounts, *devices)) \
+                or not ts or not can_be_type(ts, int):
+            return self.invalid_request({"error": "expected lists of accounts and devices"})
+        ts = int(ts)
+        logger.info(f"Batch set burned of {len(accounts)} accounts and {len(devices)} devices at {ts=}")
+        current = self.store.current_accounts(devices)
+        burned = self.store.set_burned_many({*accounts, *current.values()}, ts)
+        for username in burned:
+            self.pool_stats.on_burned(username, ts)
+            self.events.publish("burned", username=username, ts=ts)
+        self.stats_cache.clear()
+        self.check_pool()
+        results = [{"account": account, "status": "ok" if account in burned else "fail"} for account in accounts]
+        results += [{"device": device, "status": "ok" if current.get(device) in burned else "fail",
+                     "account": current.get(device)} for device in devices]
+        return self.resp_ok({"status": "ok", "results": results})
 
     def force_release(self):
-        sql = (f"UPDATE accounts SET in_use_by = NULL, last_returned = '{int(time.time())}' WHERE "
-               f"in_use_by IS NOT NULL AND last_returned < {int(time.time()) - self.config.force_release_seconds}")
-        sql_log = (f"SELECT * FROM accounts WHERE in_use_by IS NOT NULL AND last_returned < "
-                   f"{int(time.time()) - self.config.force_release_seconds} ORDER BY last_returned DESC")
-        with Db() as conn:
-            conn.cur.execute(sql_log)
-            for res in conn.cur:
-                logger.info(f"Force release this account after {int(self.config.force_release_seconds / 60 / 60 / 24)}"
-                            f" days: {res}")
-        Db.execute(sql)
+        now = int(clock.now())
+        released = self.store.force_release(now - self.config.force_release_seconds)
+        self.current_account_cache.invalidate(*(res[1] for res in released))
+        for res in released:
+            self.pool_stats.on_released(res[1], res[0], now)
+            logger.info(f"Force release this account after {int(self.config.force_release_seconds / 60 / 60 / 24)}"
+                        f" days: {res}")
+            self.events.publish("force_released", device=res[1], username=res[0])
+        if released:
+            self.stats_cache.clear()
+            self.check_pool()
         return True
 
-    def stats(self):
-        self.force_release()
-        last_returned_limit = self.config.get_cooldown_timestamp()
+    def release_expired_leases(self):
+        now = int(clock.now())
+        released = self.store.release_expired(now)
+        self.current_account_cache.invalidate(*(res[1] for res in released))
+        for res in released:
+            self.pool_stats.on_released(res[1], res[0], now)
+            logger.info(f"Released account with expired lease: {res}")
+            self.events.publish("released", device=res[1], username=res[0], reason="lease_expired")
+        if released:
+            self.stats_cache.clear()
+            self.check_pool()
+        return True
 
-        cd_sql = f"SELECT count(*) from accounts WHERE GREATEST(last_returned, last_burned) >= {last_returned_limit}"
-        in_use_sql = "SELECT count(*) from accounts WHERE in_use_by IS NOT NULL"
-        total_sql = "SELECT count(*) from accounts"
+    def reconcile_stats(self):
+        self.pool_stats.reconcile(*self.store.stats_snapshot(self.config.get_cooldown_timestamp()))
+        self.stats_cache.clear()
+        logger.trace("reconciled pool stats")
 
-        self.cd, self.in_use, self.total = Db.get_single_results(cd_sql, in_use_sql, total_sql)
+    def stats(self):
+        self.cd, self.in_use, self.total = self.pool_stats.counts(self.config.get_cooldown_timestamp())
         self.available = self.total - self.in_use - self.cd
-        try:
+        # the ratios are per device in use - 0 while no account is in use, e.g. on every /metrics scrape of an idle pool
+        if self.in_use > 0:
             self.accs_per_device = round(self.total / self.in_use, 2)
             self.required_per_device = round((self.in_use + self.cd) / self.in_use, 2)
             self.hours_per_account = round(24 / self.required_per_device, 2)
-        except ZeroDivisionError:
-            logger.warning("Encountered ZeroDivisionError trying to calculate stats ... return zeroes")
+        else:
             self.accs_per_device = 0
             self.required_per_device = 0
             self.hours_per_account = 0
+        logger.opt(lazy=True).debug("db connection pool: {}", Db.pool_stats)
 
         return {"accounts": self.total, "accounts_per_device": self.accs_per_device,
                 "required_per_device": self.required_per_device, "hours_per_account": self.hours_per_account,
                 "in_use": self.in_use, "cooldown": self.cd, "available": self.available}
 
+    def pool_event(self):
+        cd, in_use, total = self.pool_stats.counts(self.config.get_cooldown_timestamp())
+        available = total - in_use - cd
+        state = "exhausted" if available <= 0 else "low" if available <= self.config.pool_low_accounts else "ok"
+        return {"type": "pool", "ts": int(clock.now()), "pool": self.config.pool_name, "state": state,
+                "available": available}
+
+    def check_pool(self):
+        """
+        Publish a pool event when the available accounts drop to pool_low_accounts or to 0, or recover.
+        """
+        event = self.pool_event()
+        if event["state"] != self.pool_state:
+            self.pool_state = event["state"]
+            self.events.publish("pool", state=event["state"], available=event["available"])
+
+    def event_types(self, types):
+        # ?types=assigned,burned subscribes to some of the events only, ?pools=default,raid to some pools only
+        return set(filter(None, (types or "").split(","))) or None
+
+    def pool_events(self, pools):
+        # the current state of the subscribed pools, sent first
+        return [server.pool_event() for name, server in self.pools.items() if pools is None or name in pools]
+
+    def event_stream(self):
+        """
+        Server-sent events of assignments, releases, burns, level changes and the pool state - starting with the
+        current pool state.
+        """
+        pools = self.event_types(request.args.get("pools"))
+        subscription = self.events.subscribe(self.event_types(request.args.get("types")), pools=pools)
+
+        def stream():
+            try:
+                for event in self.pool_events(pools):
+                    yield server_sent_event(event)
+                while True:
+                    events = subscription.get(self.config.event_keepalive_seconds)
+                    if not events:
+                        yield KEEPALIVE
+                    for event in events:
+                        yield server_sent_event(event)
+            finally:
+                subscription.close()
+        headers = {**self.resp_headers, "Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        return Response(stream(), mimetype="text/event-stream", headers=headers)
+
+    def debug_traces(self, query):
+        """
+        The latest request traces, newest first: ?limit=50&route=/get/<device>&min_ms=10
+        """
+        limit, min_ms = query.get("limit", 50), query.get("min_ms", 0)
+        if not can_be_type(limit, int) or not can_be_type(min_ms, float) or int(limit) < 1:
+            return self.invalid_request({"error": "limit must be a positive number, min_ms a number"})
+        traces = self.tracer.recent(int(limit), query.get("route"), float(min_ms))
+        return self.resp_ok({"status": "ok", "traces": traces})
+
+    def debug_slowest_traces(self, query):
+        return self.resp_ok({"status": "ok", "traces": self.tracer.slowest()})
+
+    def debug_profile(self, query):
+        """
+        Sample the stacks of all threads for a while: ?seconds=10&interval_ms=10 - aggregated as JSON, or as folded
+        stacks for flame graph tools with &format=folded.
+        """
+        seconds, interval_ms = query.get("seconds", 10), query.get("interval_ms", 10)
+        if not can_be_type(seconds, float) or not can_be_type(interval_ms, float) \
+                or not 0 < float(seconds) <= self.config.profiling_max_seconds or not 1 <= float(interval_ms) <= 1000:
+            return self.invalid_request({"error": f"seconds must be 0 - {self.config.profiling_max_seconds}, "
+                                                  "interval_ms 1 - 1000"})
+        try:
+            samples, stacks = self.sampler.profile(float(seconds), float(interval_ms) / 1000)
+        except RuntimeError as e:
+            return self.invalid_request({"error": str(e)}, code=409)
+        if query.get("format") == "folded":
+            return profiler.folded(stacks), 200, {**self.resp_headers, "Content-Type": "text/plain; charset=utf-8"}
+        top_stacks = [{"stack": stack, "samples": count} for stack, count in stacks.most_common(100)]
+        return self.resp_ok({"status": "ok", "samples": samples, "functions": profiler.top_functions(stacks),
+                             "stacks": top_stacks})
+
+    def cached_stats(self):
+        return self.stats_cache.load("stats", self.stats)
+
+    def export_metrics(self):
+        """
+        Prometheus text exposition of the request, database and rate limit metrics plus the current pool statistics.
+        """
+        reservations: collections.Counter = collections.Counter()
+        cache_entries: collections.Counter = collections.Counter()
+        request_log_size: collections.Counter = collections.Counter()
+        # per pool statistics, everything else summed up over all pools
+        for name, server in self.pools.items():
+            for stat, value in server.stats().items():
+                metrics.pool_accounts.set(value, name, stat)
+            if isinstance(server.store, ReservingStore):
+                reservations.update(server.store.stats())
+            for cache in (server.current_account_cache, server.stats_cache):
+                cache_entries[cache.name] += len(cache)
+            request_log_size.update(dict(zip(("devices", "entries"), server.request_log.size())))
+        for stat, value in Db.pool_stats().items():
+            metrics.db_pool.set(value, stat)
+        for stat, value in reservations.items():
+            metrics.reservations.set(value, stat)
+        for name, value in cache_entries.items():
+            metrics.cache_entries.set(value, name)
+        for unit, value in request_log_size.items():
+            metrics.request_log_size.set(value, unit)
+        headers = dict(self.resp_headers)
+        headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+        return metrics.REGISTRY.render(), 200, headers
+
+
+class PoolServer(AccountServer):
+    """
+    Serves a named account pool: the handlers of the routes with the pool's name run on the pool's own config
+    ([pool:<name>] section), store, request log, rate limiter, stats and caches. The web app, the scheduler and the
+    event stream are the server's.
+    """
+
+    def __init__(self, server, name):
+        logger.info(f"initializing account pool {name}")
+        self.config = Config.for_pool(name)()
+        self.resp_headers = server.resp_headers
+        self.app = None
+        self.capture = None
+        self.tracer = None
+        self.scheduler = server.scheduler
+        self.events = PoolEvents(server.events.broadcaster, name)
+        self.open_pool()
+        logger.info(f"account pool {name}: {self.stats()}")
+
 
 if __name__ == "__main__":
-    serv = AccountServer()
+    if Config.server_mode == "async":
+        from async_server import AsyncAccountServer
+        serv = AsyncAccountServer()
+    else:
+        serv = AccountServer()
     while True:
         time.sleep(1)
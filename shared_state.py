@@ -0,0 +1,194 @@
+import threading
+import time
+
+from collections import deque
+from loguru import logger
+
+import clock
+from config import Config
+from db_connection import DbConnection as Db
+from rate_limit import RateLimiter
+from statements import STATEMENTS
+
+
+class TTLCache:
+    """
+    Small per-process cache for shared state read from the database - entries expire after `ttl` seconds.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._data: dict = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+
+
+def device_key(config, device):
+    """
+    Key of a device in the shared request_log and device_state tables - devices of named account pools are stored as
+    `pool/device`, device names never contain a slash.
+    """
+    return device if config.pool_name == Config.pool_name else f"{config.pool_name}/{device}"
+
+
+def device_filter(config):
+    """
+    WHERE condition and its parameters matching the keys of the account pool's devices - a key range for named pools
+    ("0" follows "/"), as LIKE would treat the "_" of pool names as a wildcard.
+    """
+    if config.pool_name == Config.pool_name:
+        return "device NOT LIKE %s", ("%/%",)
+    return "device >= %s AND device < %s", (f"{config.pool_name}/", f"{config.pool_name}0")
+
+
+class SharedRequestLog:
+    """
+    RequestLog stored in the request_log table, so all server processes share the devices' request history.
+
+    Each device keeps at most rate_limit_number rows, ordered by position. Reads are cached per process for
+    shared_cache_seconds; writes go to the database right away and refresh the local cache.
+    """
+
+    def __init__(self, config=None):
+        self.config = config or Config()
+        self.cache = TTLCache(self.config.shared_cache_seconds)
+
+    def __load(self, conn, device):
+        entries = deque(({"ts": ts, "username": username}
+                         for username, ts in conn.rows("request_log", (device_key(self.config, device),))),
+                        maxlen=self.config.rate_limit_number)
+        self.cache.set(device, entries)
+        return entries
+
+    def __getitem__(self, device):
+        entries = self.get(device)
+        if entries is None:
+            raise KeyError(device)
+        return entries
+
+    def __contains__(self, device):
+        return self.get(device) is not None
+
+    def get(self, device, default=None):
+        entries = self.cache.get(device)
+        if entries is None:
+            with Db() as conn:
+                entries = self.__load(conn, device)
+        return entries if entries else default
+
+    def items(self):
+        where, params = device_filter(self.config)
+        prefix = len(device_key(self.config, ""))
+        with Db() as conn:
+            conn.cur.execute(f"SELECT DISTINCT device FROM request_log WHERE {where}", params)
+            devices = [row[0][prefix:] for row in conn.cur.fetchall()]
+            return [(device, self.__load(conn, device)) for device in devices]
+
+    def log(self, name, request):
+        key = device_key(self.config, name)
+        with Db() as conn:
+            conn.begin()
+            # the FOR UPDATE of the last position locks no row before the device's first entry - concurrent logs of
+            # the device take turns on its device_state row instead, or their first entries would get the same position
+            conn.run(self.lock_device_statement(), (key,))
+            position = (conn.scalar("request_log_last_position", (key,)) or 0) + 1
+            conn.run("request_log_insert", (key, position, request["username"], request["ts"]))
+            # keep the latest rate_limit_number entries, like the deque of the local RequestLog
+            conn.run("request_log_trim", (key, position - self.config.rate_limit_number))
+            self.__load(conn, name)
+        return True
+
+    @staticmethod
+    def lock_device_statement():
+        # the upsert syntax depends on the database backend
+        if "request_log_lock_device" not in STATEMENTS:
+            STATEMENTS.register("request_log_lock_device", Db.backend().upsert_sql("device_state", ("device",),
+                                                                                   ("device",)))
+        return "request_log_lock_device"
+
+    def rotate(self, device):
+        key = device_key(self.config, device)
+        try:
+            with Db() as conn:
+                conn.begin()
+                first, last = conn.row("request_log_positions", (key,))
+                if first is None:
+                    raise KeyError(device)
+                conn.run("request_log_move", (last + 1, key, first))
+                self.__load(conn, device)
+            return True
+        except Exception as e:
+            logger.warning(f"Exception trying to rotate request log of {device}: {e}")
+            return False
+
+    def size(self):
+        where, params = device_filter(self.config)
+        with Db() as conn:
+            conn.cur.execute(f"SELECT count(DISTINCT device), count(*) FROM request_log WHERE {where}", params)
+            return conn.cur.fetchone()
+
+    def get_logged_usernames(self, device):
+        return [entry["username"] for entry in self.get(device, ())]
+
+    def close(self):
+        pass
+
+
+class SharedRateLimiter(RateLimiter):
+    """
+    RateLimiter keeping the burst window in the device_state table, so all server processes share it.
+    Devices without a row fall back to the last use of their current account.
+    """
+
+    def __init__(self, request_log, config=None):
+        super().__init__(request_log, config)
+        self.cache = TTLCache(self.config.shared_cache_seconds)
+
+    def seed(self, store):
+        # nothing to seed - the state lives in the database
+        pass
+
+    def record_grant(self, device, ts=None):
+        ts = int(clock.now()) if ts is None else ts
+        with Db() as conn:
+            conn.run(self.record_grant_statement(), (device_key(self.config, device), ts))
+        self.cache.set(device, ts)
+
+    @staticmethod
+    def record_grant_statement():
+        # the upsert syntax depends on the database backend
+        if "record_grant" not in STATEMENTS:
+            STATEMENTS.register("record_grant", Db.backend().upsert_sql("device_state", ("device", "last_grant"),
+                                                                        ("device",), keep_greatest=("last_grant",)))
+        return "record_grant"
+
+    def latest_grant(self, device):
+        latest = self.cache.get(device)
+        if latest is None:
+            with Db() as conn:
+                latest = conn.scalar("latest_grant", (device_key(self.config, device), self.config.pool_name, device))
+            self.cache.set(device, latest)
+        return latest
+
+
+STATEMENTS.register("request_log", "SELECT username, ts FROM request_log WHERE device = %s ORDER BY position")
+STATEMENTS.register("request_log_last_position", "SELECT max(position) FROM request_log WHERE device = %s FOR UPDATE")
+STATEMENTS.register("request_log_insert",
+                    "INSERT INTO request_log (device, position, username, ts) VALUES (%s, %s, %s, %s)")
+STATEMENTS.register("request_log_trim", "DELETE FROM request_log WHERE device = %s AND position <= %s")
+STATEMENTS.register("request_log_positions",
+                    "SELECT min(position), max(position) FROM request_log WHERE device = %s FOR UPDATE")
+STATEMENTS.register("request_log_move", "UPDATE request_log SET position = %s WHERE device = %s AND position = %s")
+STATEMENTS.register("latest_grant",
+                    "SELECT GREATEST(IFNULL((SELECT last_grant FROM device_state WHERE device = %s), 0), "
+                    "IFNULL((SELECT max(last_use) FROM accounts WHERE pool = %s AND in_use_by = %s), 0))")
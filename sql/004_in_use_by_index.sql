@@ -0,0 +1 @@
+alter table accounts modify in_use_by varchar(64) default null, add index in_use_by (in_use_by, last_returned)
@@ -0,0 +1 @@
+alter table accounts add column cooldown_start bigint as (greatest(ifnull(last_returned, 0), ifnull(last_burned, 0))) stored, add index cooldown_start (cooldown_start)
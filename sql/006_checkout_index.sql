@@ -0,0 +1 @@
+alter table accounts add index checkout (in_use_by, last_use, level, cooldown_start)
@@ -0,0 +1,6 @@
+create table request_log (
+    device varchar(64) not null,
+    position bigint not null,
+    username varchar(255) not null,
+    ts bigint not null,
+    primary key (device, position))
@@ -0,0 +1,4 @@
+create table device_state (
+    device varchar(64) not null,
+    last_grant bigint not null default 0,
+    primary key (device))
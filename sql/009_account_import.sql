@@ -0,0 +1,5 @@
+create table account_import (
+    file varchar(255) not null,
+    checksum char(64) not null,
+    imported_at bigint not null,
+    primary key (file))
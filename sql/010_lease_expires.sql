@@ -0,0 +1 @@
+alter table accounts add column lease_expires bigint default null, add index lease_expires (lease_expires)
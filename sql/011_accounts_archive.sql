@@ -0,0 +1,13 @@
+alter table accounts add column burn_count int not null default 0, add index burn_count (burn_count);
+create table accounts_archive (
+    username varchar(255) not null,
+    password text,
+    last_use bigint default 0,
+    last_returned bigint default 0,
+    level tinyint default 0,
+    last_burned bigint default 0,
+    burn_count int not null default 0,
+    archived_at bigint not null,
+    reason varchar(32) not null,
+    primary key (username),
+    index archived_at (archived_at))
@@ -0,0 +1,7 @@
+alter table accounts add column pool varchar(64) not null default 'default',
+    drop index in_use_by, add index in_use_by (pool, in_use_by, last_returned),
+    drop index cooldown_start, add index cooldown_start (pool, cooldown_start),
+    drop index checkout, add index checkout (pool, in_use_by, last_use, level, cooldown_start),
+    drop index lease_expires, add index lease_expires (pool, lease_expires),
+    drop index burn_count, add index burn_count (pool, burn_count);
+alter table accounts_archive add column pool varchar(64) not null default 'default'
@@ -0,0 +1,25 @@
+-- complete schema for the sqlite backend, equivalent to sql/accounts.sql with the MySQL updates 001 - 008
+create table accounts (
+    id integer,
+    username text not null primary key,
+    password text,
+    last_use bigint default 0,
+    in_use_by text,
+    last_returned bigint default 0,
+    level tinyint default 0,
+    last_burned bigint default 0,
+    cooldown_start bigint generated always as (max(ifnull(last_returned, 0), ifnull(last_burned, 0))) stored);
+create index in_use_by on accounts (in_use_by, last_returned);
+create index cooldown_start on accounts (cooldown_start);
+create index checkout on accounts (in_use_by, last_use, level, cooldown_start);
+
+create table request_log (
+    device text not null,
+    position bigint not null,
+    username text not null,
+    ts bigint not null,
+    primary key (device, position));
+
+create table device_state (
+    device text not null primary key,
+    last_grant bigint not null default 0);
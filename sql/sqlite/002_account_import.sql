@@ -0,0 +1,4 @@
+create table account_import (
+    file text not null primary key,
+    checksum text not null,
+    imported_at bigint not null)
@@ -0,0 +1,2 @@
+alter table accounts add column lease_expires bigint default null;
+create index lease_expires on accounts (lease_expires)
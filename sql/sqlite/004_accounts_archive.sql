@@ -0,0 +1,13 @@
+alter table accounts add column burn_count integer not null default 0;
+create index burn_count on accounts (burn_count);
+create table accounts_archive (
+    username text not null primary key,
+    password text,
+    last_use bigint default 0,
+    last_returned bigint default 0,
+    level tinyint default 0,
+    last_burned bigint default 0,
+    burn_count integer not null default 0,
+    archived_at bigint not null,
+    reason text not null);
+create index archived_at on accounts_archive (archived_at)
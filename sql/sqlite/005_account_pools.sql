@@ -0,0 +1,12 @@
+alter table accounts add column pool text not null default 'default';
+drop index in_use_by;
+create index in_use_by on accounts (pool, in_use_by, last_returned);
+drop index cooldown_start;
+create index cooldown_start on accounts (pool, cooldown_start);
+drop index checkout;
+create index checkout on accounts (pool, in_use_by, last_use, level, cooldown_start);
+drop index lease_expires;
+create index lease_expires on accounts (pool, lease_expires);
+drop index burn_count;
+create index burn_count on accounts (pool, burn_count);
+alter table accounts_archive add column pool text not null default 'default'
@@ -0,0 +1,5 @@
+-- without planner statistics sqlite prefers (pool=? AND cooldown_start<?) of an index (pool, cooldown_start) for the
+-- account checkout and sorts its rows by last_use - with cooldown_start first, the checkout index (pool, in_use_by,
+-- last_use, ...) reads the free accounts of a pool in the ORDER BY last_use order instead
+drop index cooldown_start;
+create index cooldown_start on accounts (cooldown_start, pool)
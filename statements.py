@@ -0,0 +1,65 @@
+import time
+
+from metrics import db_query_duration, query_kind
+import profiler
+
+
+class StatementRegistry:
+    """
+    Named, parameterized SQL statements (in MySQL syntax, with %s placeholders).
+
+    Statements are registered once at import time and prepared lazily, once per pooled connection, the first time
+    they're executed on it.
+    """
+
+    def __init__(self):
+        self.sql: dict = {}
+
+    def register(self, name, sql):
+        if self.sql.get(name, sql) != sql:
+            raise ValueError(f"statement {name!r} is already registered with different SQL")
+        self.sql[name] = sql
+        return name
+
+    def __getitem__(self, name):
+        return self.sql[name]
+
+    def __contains__(self, name):
+        return name in self.sql
+
+
+STATEMENTS = StatementRegistry()
+
+
+class PreparedStatement:
+    """
+    A registered statement prepared on one connection - executed with bound parameters only.
+    """
+
+    __slots__ = ("name", "kind", "cursor", "backend")
+
+    def __init__(self, backend, conn, name):
+        self.name = name
+        self.kind = query_kind(STATEMENTS[name])
+        self.backend = backend
+        self.cursor = backend.prepare(conn, STATEMENTS[name])
+
+    def execute(self, params=()):
+        start = time.perf_counter()
+        try:
+            self.cursor.execute(params)
+        finally:
+            elapsed = time.perf_counter() - start
+            db_query_duration.observe(elapsed, self.kind)
+            profiler.span("db", self.kind, start, elapsed)
+        return self
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def close(self):
+        self.cursor.close()
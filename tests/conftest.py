@@ -0,0 +1,36 @@
+"""
+The tests run against a fresh SQLite database in a temporary directory - Config reads config.ini from the working
+directory when it's imported, so a minimal one is written there first. Set POGO_TEST_CONFIG to the path of another
+config.ini, e.g. of a local MySQL/MariaDB test database, to run them against that database instead.
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TEST_DIR = tempfile.mkdtemp(prefix="pogo_tests_")
+if os.environ.get("POGO_TEST_CONFIG"):
+    shutil.copy(os.environ["POGO_TEST_CONFIG"], os.path.join(TEST_DIR, "config.ini"))
+else:
+    with open(os.path.join(TEST_DIR, "config.ini"), "w") as f:
+        f.write("[general]\nauth_username = test\nauth_password = test\n"
+                f"[database]\nbackend = sqlite\npath = {os.path.join(TEST_DIR, 'accounts.db')}\n")
+os.chdir(TEST_DIR)
+
+from loguru import logger  # noqa: E402
+
+from migrations import migrate  # noqa: E402
+
+logger.remove()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def database():
+    migrate()
+    yield
+    shutil.rmtree(TEST_DIR, ignore_errors=True)
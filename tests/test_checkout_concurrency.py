@@ -0,0 +1,107 @@
+"""
+Many threads check out accounts for distinct devices at the same time - no account may be handed out to two devices,
+with checkout_next locking its candidate row with FOR UPDATE SKIP LOCKED as well as with plain FOR UPDATE. On SQLite,
+which has no row locks, both variants run the same serialized transactions.
+"""
+import threading
+from collections import Counter
+
+import pytest
+
+import clock
+from db_connection import DbConnection as Db
+from statements import STATEMENTS
+
+TEST_POOL = "checkout_concurrency_test"
+THREADS = 16
+DEVICES_PER_THREAD = 4
+# fewer accounts than devices - the last free accounts are competed for
+ACCOUNTS = THREADS * DEVICES_PER_THREAD * 3 // 4
+ROUNDS = 5
+
+# both locking variants of checkout_next, whichever of them the config registered
+NEXT_SQL = STATEMENTS["checkout_next"].replace(" SKIP LOCKED", "")
+STATEMENTS.register("checkout_next_skip_locked", NEXT_SQL + " SKIP LOCKED")
+STATEMENTS.register("checkout_next_for_update", NEXT_SQL)
+
+
+def store_for(variant):
+    """
+    The test pool's store, picking accounts with the given checkout_next variant.
+    """
+    class Store(Db.for_pool(TEST_POOL)):
+        @classmethod
+        def checkout_select(cls, device, level=None, cooldown_ts=None, username=None, current=False):
+            name, params = super().checkout_select(device, level, cooldown_ts, username, current)
+            return (variant if name == "checkout_next" else name), params
+
+    return Store
+
+
+@pytest.fixture
+def accounts():
+    with Db() as conn:
+        conn.cur.execute("DELETE FROM accounts WHERE pool = %s", (TEST_POOL,))
+        conn.cur.executemany("INSERT INTO accounts (username, password, pool) VALUES (%s, %s, %s)",
+                             [(f"concurrency_{i}", "password", TEST_POOL) for i in range(ACCOUNTS)])
+    yield
+    with Db() as conn:
+        conn.cur.execute("DELETE FROM accounts WHERE pool = %s", (TEST_POOL,))
+
+
+def release_all():
+    with Db() as conn:
+        conn.cur.execute("UPDATE accounts SET in_use_by = NULL, lease_expires = NULL WHERE pool = %s", (TEST_POOL,))
+
+
+def run_round(store):
+    """
+    Every thread checks out one account for each of its devices, all threads starting at once. Devices keep their
+    accounts until the round ends. Returns the (username, device) handed out and the failed checkouts.
+    """
+    handed_out = []
+    failed = []
+    lock = threading.Lock()
+    start = threading.Barrier(THREADS)
+    cooldown_ts = int(clock.now()) + 1
+
+    def work(thread):
+        start.wait()
+        for i in range(DEVICES_PER_THREAD):
+            device = f"concurrency_device_{thread}_{i}"
+            try:
+                username, _ = store.checkout(device, level=0, cooldown_ts=cooldown_ts)
+            except Exception as e:
+                with lock:
+                    failed.append(f"{device}: {e}")
+                continue
+            if username is not None:
+                with lock:
+                    handed_out.append((username, device))
+
+    workers = [threading.Thread(target=work, args=(thread,)) for thread in range(THREADS)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return handed_out, failed
+
+
+@pytest.mark.parametrize("variant", ["checkout_next_skip_locked", "checkout_next_for_update"])
+def test_no_account_handed_out_twice(accounts, variant):
+    store = store_for(variant)
+    for _ in range(ROUNDS):
+        release_all()
+        handed_out, failed = run_round(store)
+        assert not failed
+        twice = [username for username, count in Counter(username for username, _ in handed_out).items()
+                 if count > 1]
+        assert not twice
+        # every device still holds the account it was handed - no later checkout took it over
+        with Db() as conn:
+            conn.cur.execute("SELECT username, in_use_by FROM accounts WHERE pool = %s AND in_use_by IS NOT NULL",
+                             (TEST_POOL,))
+            holders = dict(conn.cur.fetchall())
+        assert holders == dict(handed_out)
+        # every account was handed out - fewer accounts than devices
+        assert len(handed_out) == ACCOUNTS
@@ -0,0 +1,118 @@
+"""
+EXPLAINs every statement of checkouts, releases, device lookups, stats and force releases on seeded accounts of a pool
+of their own: none may read the accounts table with a full table scan - type=ALL on MySQL/MariaDB, a SCAN without an
+index on SQLite - and the account checkouts have to read the free accounts of the pool from the checkout index in
+their ORDER BY last_use order, without sorting them.
+"""
+import re
+
+import pytest
+
+import clock
+from db_connection import DbConnection as Db
+from statements import STATEMENTS
+
+TEST_POOL = "index_test"
+DEVICE = "index_test_device"
+ACCOUNTS = 5000
+
+# the statements built in DbConnection.stats_snapshot and force_release
+STATS_ASSIGNED = "SELECT in_use_by, username FROM accounts WHERE pool = %s AND in_use_by IS NOT NULL"
+STATS_COOLING = "SELECT username, cooldown_start FROM accounts WHERE pool = %s AND cooldown_start >= %s"
+STATS_TOTAL = "SELECT count(*) FROM accounts WHERE pool = %s"
+FORCE_RELEASE_SELECT = ("SELECT username, in_use_by, last_use, last_returned, level, last_burned FROM accounts WHERE "
+                        "pool = %s AND in_use_by IS NOT NULL AND last_returned < %s ORDER BY last_returned DESC "
+                        "FOR UPDATE")
+FORCE_RELEASE_UPDATE = ("UPDATE accounts SET in_use_by = NULL, last_returned = %s, lease_expires = NULL WHERE "
+                        "pool = %s AND in_use_by IS NOT NULL AND last_returned < %s")
+
+# the statements picking the next account and the index they have to pick it from
+CHECKOUT_INDEX = {"checkout_next": "checkout", "candidates": "checkout"}
+
+# sqlite's EXPLAIN QUERY PLAN reports a full table scan as "SCAN accounts" ("SCAN TABLE accounts" before 3.36)
+SQLITE_FULL_SCAN = re.compile(r"^SCAN (TABLE )?accounts( AS \w+)?$")
+SQLITE_INDEX = re.compile(r"USING (?:COVERING )?INDEX (\w+)")
+
+
+def statements(now):
+    username = "index_test_1"
+    cooldown_ts = now - 86400
+    return [
+        # checkout
+        ("checkout_by_username", STATEMENTS["checkout_by_username"], (username, TEST_POOL)),
+        ("checkout_current", STATEMENTS["checkout_current"], (TEST_POOL, DEVICE)),
+        ("checkout_next", STATEMENTS["checkout_next"], (TEST_POOL, 30, cooldown_ts)),
+        ("candidates", STATEMENTS["candidates"], (TEST_POOL, 30, cooldown_ts, 10)),
+        ("assign", STATEMENTS["assign"], (DEVICE, now, None, username)),
+        ("claim", STATEMENTS["claim"], (DEVICE, now, None, username, 30, cooldown_ts)),
+        # release and device lookups
+        ("release", STATEMENTS["release"], (now, TEST_POOL, DEVICE)),
+        ("current_account", STATEMENTS["current_account"], (TEST_POOL, DEVICE)),
+        ("heartbeat", STATEMENTS["heartbeat"], (now, TEST_POOL, DEVICE)),
+        ("device_last_uses", STATEMENTS["device_last_uses"], (TEST_POOL,)),
+        # stats
+        ("stats assigned", STATS_ASSIGNED, (TEST_POOL,)),
+        ("stats cooling", STATS_COOLING, (TEST_POOL, cooldown_ts)),
+        ("stats count", STATS_TOTAL, (TEST_POOL,)),
+        # force release
+        ("force_release select", FORCE_RELEASE_SELECT, (TEST_POOL, cooldown_ts)),
+        ("force_release update", FORCE_RELEASE_UPDATE, (now, TEST_POOL, cooldown_ts)),
+    ]
+
+
+@pytest.fixture(scope="module")
+def now():
+    now = int(clock.now())
+    with Db() as conn:
+        conn.cur.execute("DELETE FROM accounts WHERE pool = %s", (TEST_POOL,))
+        # a realistic mix: most accounts free, a few in use, some in cooldown, spread over the levels
+        conn.cur.executemany("INSERT INTO accounts (username, password, pool, level, last_use, last_returned, "
+                             "in_use_by) VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                             [(f"index_test_{i}", "password", TEST_POOL, i % 40, now - i, now - (i % 7) * 43200,
+                               f"index_test_device_{i}" if i % 50 == 0 else None) for i in range(ACCOUNTS)])
+        # fresh index statistics on MySQL - not on SQLite, where ANALYZE would leave planner statistics of the test
+        # accounts in the database, and where the indexes have to do without statistics
+        if Db.backend().name == "mysql":
+            conn.cur.execute("ANALYZE TABLE accounts")
+            conn.cur.fetchall()
+    yield now
+    with Db() as conn:
+        conn.cur.execute("DELETE FROM accounts WHERE pool = %s", (TEST_POOL,))
+
+
+def explain(sql, params):
+    """
+    Returns [(index, full table scan?, sorted?)] of every table the statement reads.
+    """
+    with Db() as conn:
+        if Db.backend().name == "mysql":
+            conn.cur.execute("EXPLAIN " + sql, params)
+            columns = [column[0] for column in conn.cur.cursor.description]
+            plan = [dict(zip(columns, row)) for row in conn.cur.fetchall()]
+            # EXPLAIN doesn't change rows, but don't keep any locks of the explained statements
+            conn.conn.rollback()
+            return [(row["key"], row["type"] == "ALL", "Using filesort" in (row["Extra"] or "")) for row in plan]
+        conn.cur.execute("EXPLAIN QUERY PLAN " + sql, params)
+        details = [detail for *_, detail in conn.cur.fetchall()]
+    sorted_ = any(detail.startswith("USE TEMP B-TREE FOR ORDER BY") for detail in details)
+    plan = []
+    for detail in details:
+        if SQLITE_FULL_SCAN.match(detail):
+            plan.append((None, True, sorted_))
+        elif SQLITE_INDEX.search(detail):
+            plan.append((SQLITE_INDEX.search(detail).group(1), False, sorted_))
+    return plan
+
+
+@pytest.mark.parametrize("name", [name for name, _, _ in statements(0)])
+def test_no_full_table_scan(now, name):
+    _, sql, params = next(statement for statement in statements(now) if statement[0] == name)
+    plan = explain(sql, params)
+    assert plan
+    assert not [index for index, full_scan, _ in plan if full_scan]
+
+
+@pytest.mark.parametrize("name", sorted(CHECKOUT_INDEX))
+def test_checkout_reads_checkout_index_in_order(now, name):
+    _, sql, params = next(statement for statement in statements(now) if statement[0] == name)
+    assert explain(sql, params) == [(CHECKOUT_INDEX[name], False, False)]
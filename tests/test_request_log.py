@@ -0,0 +1,91 @@
+"""
+A request log compaction that crashes after renaming the journal aside - before or after replacing the snapshot -
+gets finished by the next startup, which loads every record exactly once.
+"""
+import os
+from collections import deque
+
+import pytest
+
+from request_log import RequestLog
+
+DEVICE = "request_log_test_device"
+
+
+class Crash(BaseException):
+    """
+    Stands in for the process dying - compact() doesn't catch it.
+    """
+
+
+def open_log(tmp_path):
+    return RequestLog(filename=str(tmp_path / "request_log.pickle"), journal=str(tmp_path / "request_log.journal"))
+
+
+def filled_log(tmp_path):
+    log = open_log(tmp_path)
+    for username in ("first", "second", "third"):
+        log.log(DEVICE, {"username": username})
+    log.rotate(DEVICE)
+    log.sync()
+    return log
+
+
+def fail_snapshot_replace(monkeypatch, exception):
+    """
+    Fails os.replace() of the new snapshot over the old one.
+    """
+    replace = os.replace
+
+    def failing_replace(src, dst):
+        if str(src).endswith(".pickle.tmp"):
+            raise exception
+        replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", failing_replace)
+
+
+def fail_aside_remove(monkeypatch, exception):
+    """
+    Fails os.remove() of the journal renamed aside.
+    """
+    def failing_remove(path):
+        raise exception
+
+    monkeypatch.setattr(os, "remove", failing_remove)
+
+
+@pytest.mark.parametrize("fail", [fail_snapshot_replace, fail_aside_remove])
+def test_crashed_compaction_is_finished_on_startup(tmp_path, monkeypatch, fail):
+    log = filled_log(tmp_path)
+    expected = deque(log[DEVICE])
+    fail(monkeypatch, Crash())
+    with pytest.raises(Crash):
+        log.compact()
+    monkeypatch.undo()
+    log.close()
+    assert os.path.exists(log.compacted_filename)
+
+    log = open_log(tmp_path)
+    try:
+        assert log.data == {DEVICE: expected}
+        assert not os.path.exists(log.compacted_filename)
+    finally:
+        log.close()
+
+
+def test_records_after_a_failed_compaction_are_kept(tmp_path, monkeypatch):
+    log = filled_log(tmp_path)
+    fail_snapshot_replace(monkeypatch, OSError("disk full"))
+    assert not log.compact()
+    monkeypatch.undo()
+    log.log(DEVICE, {"username": "fourth"})
+    assert log.compact()
+    expected = deque(log[DEVICE])
+    log.close()
+
+    log = open_log(tmp_path)
+    try:
+        assert log.data == {DEVICE: expected}
+    finally:
+        log.close()
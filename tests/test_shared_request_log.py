@@ -0,0 +1,60 @@
+"""
+Concurrent first logs of a device in the shared request log - before the device has any request_log row to lock -
+all succeed, each with a position of its own.
+"""
+import threading
+
+import pytest
+
+from config import Config
+from db_connection import DbConnection as Db
+from shared_state import SharedRequestLog
+
+DEVICE_PREFIX = "shared_request_log_test_"
+LOGS = 2
+ROUNDS = 20
+
+
+@pytest.fixture
+def request_log():
+    config = Config()
+    config.rate_limit_number = LOGS
+    yield SharedRequestLog(config)
+    with Db() as conn:
+        for table in ("request_log", "device_state"):
+            conn.cur.execute(f"DELETE FROM {table} WHERE device >= %s AND device < %s",
+                             (DEVICE_PREFIX, DEVICE_PREFIX + "~"))
+
+
+def first_logs(request_log, device):
+    """
+    Logs LOGS requests of the device at once, each from a thread of its own. Returns the failed logs.
+    """
+    failed = []
+    start = threading.Barrier(LOGS)
+
+    def work(i):
+        start.wait()
+        try:
+            request_log.log(device, {"username": f"account_{i}", "ts": 1000 + i})
+        except Exception as e:
+            failed.append(f"{device} #{i}: {e}")
+
+    workers = [threading.Thread(target=work, args=(i,)) for i in range(LOGS)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return failed
+
+
+def test_concurrent_first_logs_of_a_device(request_log):
+    for round_ in range(ROUNDS):
+        device = f"{DEVICE_PREFIX}{round_}"
+        assert not first_logs(request_log, device)
+        with Db() as conn:
+            conn.cur.execute("SELECT position, username FROM request_log WHERE device = %s ORDER BY position",
+                             (device,))
+            rows = conn.cur.fetchall()
+        assert [position for position, _ in rows] == list(range(1, LOGS + 1))
+        assert sorted(username for _, username in rows) == [f"account_{i}" for i in range(LOGS)]
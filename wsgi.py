@@ -0,0 +1,6 @@
+from server import AccountServer
+
+# WSGI entry point, e.g. for gunicorn: gunicorn -w 4 -b 127.0.0.1:9008 wsgi:app
+# - use shared_state = true when running more than one worker. Workers starting at the same time take turns to migrate
+# the database schema
+app = AccountServer(launch=False).create_app()